@@ -2,6 +2,8 @@
 import argparse
 import math
 import os
+import shutil
+import threading
 import warnings
 import json
 from pathlib import Path
@@ -10,6 +12,12 @@ from pathlib import Path
 from scripts.clustering_functions import *
 from scripts.consensus_methods import *
 from scripts.docking_functions import *
+from scripts.active_learning import run_active_learning
+from scripts.funnel import run_funnel
+from scripts.pipeline import Pipeline
+from scripts.profiling import aggregate_profiles
+from scripts.streaming import run_streaming
+from scripts.telemetry import start_run, write_prometheus_textfile
 from scripts.dogsitescorer import *
 from scripts.get_pocket import *
 from scripts.library_preparation import *
@@ -29,7 +37,15 @@ parser = argparse.ArgumentParser(description='Parse required arguments')
 
 # Define command line arguments for the script
 parser.add_argument('--software', required=True, type=str, help ='Path to the software folder')
-parser.add_argument('--mode', type=str, default='single', choices=['Single', 'Ensemble', 'active_learning'], help ='Specifies the mode: single, ensemble, or active_learning')
+parser.add_argument('--mode', type=str, default='single', choices=['Single', 'Ensemble', 'active_learning', 'Funnel'], help ='Specifies the mode: single, ensemble, active_learning or funnel')
+parser.add_argument('--distributed_queue', default=None, type=str, help ='Path to a shared queue folder: docking and rescoring tasks are run by workers started with "python -m scripts.distributed worker --queue_dir <folder>" on any host')
+parser.add_argument('--local_workers', default=0, type=int, help ='Number of distributed workers to start on this host (with --distributed_queue)')
+parser.add_argument('--prometheus_textfile', default=None, type=str, help ='Path to a Prometheus textfile (e.g. for the node_exporter textfile collector) summarizing the stage telemetry of each run')
+parser.add_argument('--conformer_threads', default=1, type=int, help ='Number of RDKit embedding threads per worker process when generating conformers with MMFF (ncpus / conformer_threads worker processes are used)')
+parser.add_argument('--profile', default=False, type=str2bool, help ='Whether or not to profile the Python code of each stage, in the main process and in the workers (profiles are written to <working directory>/profiles)')
+parser.add_argument('--al_batch_size', default=1000, type=int, help ='Number of compounds docked per active learning round (active_learning mode)')
+parser.add_argument('--al_max_fraction', default=0.2, type=float, help ='Maximum fraction of the library docked in active_learning mode')
+parser.add_argument('--funnel_config', default=str(Path(__file__).resolve().parent / 'scripts' / 'funnel_config.yml'), type=str, help ='Path to the funnel stages configuration file (Funnel mode)')
 
 parser.add_argument('--gen_decoys', default=False, type=str2bool, help ='Whether or not to generate decoys using DeepCoy')
 parser.add_argument('--decoy_model', default='DUDE', type=str, choices=['DUDE', 'DEKOIS', 'DUDE_P'], help ='Model to use for decoy generation')
@@ -74,6 +90,18 @@ parser.add_argument('--protonation',
                     type=str,
                     choices=['GypsumDL', 'None'],
                     help='Method to use for compound protonation')
+parser.add_argument('--deduplicate',
+                    default=True,
+                    type=str2bool,
+                    help='Whether or not to dock only one copy of compounds with the same standardized structure, results are copied to all duplicates')
+parser.add_argument('--filter_library',
+                    default=None,
+                    type=str,
+                    help='Path to a library filter configuration file (see scripts/library_filters.yml), compounds failing the filters are not docked')
+parser.add_argument('--streaming',
+                    default=False,
+                    type=str2bool,
+                    help='Whether or not to select and rescore the poses of each docked shard while the other shards are still docking')
 parser.add_argument('--docking_programs',
                     required=True,
                     type=str,
@@ -130,6 +158,23 @@ parser.add_argument('--threshold',
 # Parse arguments from command line
 args = parser.parse_args()
 
+# Send the parallel tasks to the distributed queue
+if args.distributed_queue:
+    os.environ['DOCKM8_BACKEND'] = 'distributed'
+    os.environ['DOCKM8_QUEUE_DIR'] = str(Path(args.distributed_queue).resolve())
+    os.environ['DOCKM8_LOCAL_WORKERS'] = str(args.local_workers)
+
+# Summarize the stage telemetry of each run for Prometheus
+if args.prometheus_textfile:
+    os.environ['DOCKM8_PROMETHEUS_TEXTFILE'] = str(Path(args.prometheus_textfile).resolve())
+
+# Embed the conformers of each worker process with several threads
+os.environ['DOCKM8_CONFORMER_THREADS'] = str(max(1, args.conformer_threads))
+
+# Profile each run in its working directory
+if args.profile:
+    os.environ['DOCKM8_PROFILE'] = '1'
+
 # Adjust the receptor argument based on the mode
 if args.mode == 'ensemble':
     # Treat --receptor as a list
@@ -208,11 +253,20 @@ def parse_pocket_coordinates(pocket_arg):
 def dockm8(software, receptor, pocket, ref, dogsitescorer_mode,
            docking_library, idcolumn, prepare_proteins, conformers,
            protonation, docking_programs, bust_poses, pose_selection, nposes,
-           exhaustiveness, ncpus, clustering_method, rescoring, consensus):
-    # Set working directory based on the receptor file
-    w_dir = Path(receptor).parent / Path(receptor).stem
+           exhaustiveness, ncpus, clustering_method, rescoring, consensus,
+           deduplicate=True, filter_library=None, streaming=False, w_dir=None):
+    # Set working directory based on the receptor file, unless given (e.g. funnel stages)
+    external_w_dir = w_dir is not None
+    w_dir = Path(w_dir) if w_dir else Path(receptor).parent / Path(receptor).stem
     print('The working directory has been set to:', w_dir)
-    (w_dir).mkdir(exist_ok=True)
+    (w_dir).mkdir(parents=True, exist_ok=True)
+    # Record the wall time, CPU time, throughput and memory of each stage, docking program, rescoring function and shard
+    run_report = w_dir / 'dockm8_run_report.jsonl'
+    run_id = start_run(run_report)
+    if os.environ.get('DOCKM8_PROFILE'):
+        profiles = w_dir / 'profiles'
+        shutil.rmtree(profiles, ignore_errors=True)
+        os.environ['DOCKM8_PROFILE_DIR'] = str(profiles.resolve())
 
     # Prepare the protein for docking (e.g., adding hydrogens)
     if prepare_proteins == True:
@@ -239,48 +293,109 @@ def dockm8(software, receptor, pocket, ref, dogsitescorer_mode,
 
     print("The pocket coordinates are:", pocket_definition)
 
-    # Prepare the docking library if not already prepared
-    if not os.path.isfile(w_dir / 'final_library.sdf'):
-        prepare_library(docking_library, w_dir, idcolumn, conformers,
-                        protonation, software, ncpus)
-
-    # Perform the docking operation
-    docking(w_dir, prepared_receptor, pocket_definition, software,
-            docking_programs, exhaustiveness, nposes, ncpus,
-            'concurrent_process')
-
-    # Concatenate all poses into a single file
-    concat_all_poses(w_dir, docking_programs, prepared_receptor, ncpus,
-                     bust_poses)
-
-    # Load all poses from SDF file and perform clustering
-    print('Loading all poses SDF file...')
-    tic = time.perf_counter()
-    all_poses = PandasTools.LoadSDF(str(w_dir / 'allposes.sdf'),
-                                    idName='Pose ID',
-                                    molColName='Molecule',
-                                    includeFingerprints=False,
-                                    strictParsing=True)
-    toc = time.perf_counter()
-    print(f'Finished loading all poses SDF in {toc-tic:0.4f}!')
-    for method in pose_selection:
-        if not os.path.isfile(w_dir / f'clustering/{method}_clustered.sdf'):
-            select_poses(method, clustering_method, w_dir, prepared_receptor,
-                         pocket_definition, software, all_poses, ncpus)
-
-    # Rescore poses for each selection method
-    for method in pose_selection:
-        rescore_poses(w_dir, prepared_receptor, pocket_definition, software,
-                      w_dir / 'clustering' / f'{method}_clustered.sdf',
-                      rescoring, ncpus)
+    # Build the pipeline: each stage is skipped if its parameters and input files did not change since it last completed.
+    # Independent stages (pose selection methods, rescoring functions) run concurrently, sharing the CPUs.
+    pipeline = Pipeline(w_dir, ncpus)
+    final_library = w_dir / 'final_library.sdf'
+    job_manager = os.environ.get('DOCKM8_BACKEND', 'concurrent_process')
+    library_stages = []
+    # Libraries written by the caller (funnel stages, active learning rounds) are used as they are
+    if not (external_w_dir and final_library.is_file()):
+        library_stages.append(pipeline.add('prepare_library',
+                                           lambda results: prepare_library(docking_library, w_dir, idcolumn, conformers, protonation, software, ncpus,
+                                                                           deduplicate=deduplicate, filter_config=filter_library),
+                                           inputs=[docking_library] + ([filter_library] if filter_library else []),
+                                           outputs=[final_library],
+                                           params={'idcolumn': idcolumn, 'conformers': conformers, 'protonation': protonation, 'deduplicate': deduplicate},
+                                           cpus=ncpus))
+
+    rescored_stages = {}
+    if streaming:
+        # Dock, select and rescore shard by shard, only the consensus waits for all compounds
+        pipeline.add('streaming',
+                     lambda results: run_streaming(w_dir, prepared_receptor, pocket_definition, software, docking_programs, exhaustiveness, nposes, ncpus,
+                                                   job_manager, bust_poses, pose_selection, clustering_method, rescoring),
+                     inputs=[final_library, prepared_receptor],
+                     outputs=[w_dir / 'clustering' / f'{method}_clustered.sdf' for method in pose_selection] +
+                             [w_dir / f'rescoring_{method}_clustered' / 'allposes_rescored.csv' for method in pose_selection],
+                     params={'pocket_definition': pocket_definition, 'exhaustiveness': exhaustiveness, 'nposes': nposes, 'bust_poses': bust_poses,
+                             'clustering_method': clustering_method, 'rescoring': rescoring},
+                     depends=library_stages, cpus=ncpus)
+        rescored_stages = {method: 'streaming' for method in pose_selection}
+    else:
+        # Dock with all programs on one pool
+        docking_outputs = [w_dir / program.lower() / f'{program.lower()}_poses.sdf' for program in docking_programs]
+        pipeline.add('docking',
+                     lambda results: docking(w_dir, prepared_receptor, pocket_definition, software, docking_programs, exhaustiveness, nposes, ncpus, job_manager),
+                     inputs=[final_library, prepared_receptor], outputs=docking_outputs,
+                     params={'pocket_definition': pocket_definition, 'exhaustiveness': exhaustiveness, 'nposes': nposes},
+                     depends=library_stages, cpus=ncpus,
+                     clean=[w_dir / program.lower() for program in docking_programs] + [w_dir / 'split_final_library'])
+
+        # Concatenate all poses into a single file and keep the poses table in memory for pose selection
+        pipeline.add('concat_poses',
+                     lambda results: concat_all_poses(w_dir, docking_programs, prepared_receptor, ncpus, bust_poses),
+                     inputs=docking_outputs, outputs=[w_dir / 'allposes.sdf'], params={'bust_poses': bust_poses}, depends=['docking'], cpus=ncpus)
+
+        # The poses table is read from allposes.sdf if the concatenation stage was skipped
+        poses_lock = threading.Lock()
+
+        def poses_table(results):
+            with poses_lock:
+                if results.get('concat_poses') is None:
+                    results['concat_poses'] = load_poses(w_dir / 'allposes.sdf', prepared_receptor, ncpus, False)
+            return results['concat_poses'].copy()
+
+        def rescore(function, clustered_sdf, rescoring_folder):
+            def run(results):
+                rescoring_folder.mkdir(parents=True, exist_ok=True)
+                run_rescoring_function(function, clustered_sdf, rescoring_cpus, prepared_receptor, pocket_definition, software, rescoring_folder)
+            return run
+
+        selection_cpus = max(1, ncpus // len(pose_selection))
+        rescoring_cpus = max(1, ncpus // max(1, len(rescoring)))
+        for method in pose_selection:
+            clustered_sdf = w_dir / 'clustering' / f'{method}_clustered.sdf'
+            rescoring_folder = w_dir / f'rescoring_{method}_clustered'
+            selection_stage = pipeline.add(f'selection_{method}',
+                                           lambda results, method=method: select_poses(method, clustering_method, w_dir, prepared_receptor,
+                                                                                        pocket_definition, software, poses_table(results), selection_cpus),
+                                           inputs=[w_dir / 'allposes.sdf', prepared_receptor], outputs=[clustered_sdf],
+                                           params={'clustering_method': clustering_method, 'pocket_definition': pocket_definition},
+                                           depends=['concat_poses'], cpus=selection_cpus)
+            # Rescore the selected poses with each function, a failed function is left out of the consensus
+            rescoring_stages = []
+            for function in rescoring:
+                rescoring_stages.append(pipeline.add(f'rescoring_{method}_{function}', rescore(function, clustered_sdf, rescoring_folder),
+                                                     inputs=[clustered_sdf, prepared_receptor],
+                                                     outputs=[rescoring_folder / f'{function}_rescoring' / f'{function}_scores.csv'],
+                                                     params={'pocket_definition': pocket_definition}, depends=[selection_stage],
+                                                     cpus=rescoring_cpus, clean=[rescoring_folder / f'{function}_rescoring'], optional=True))
+            score_files = [rescoring_folder / f'{function}_rescoring' / f'{function}_scores.csv' for function in rescoring]
+            merge_stage = pipeline.add(f'rescoring_{method}',
+                                       lambda results, clustered_sdf=clustered_sdf, score_files=score_files:
+                                       rescore_poses(w_dir, prepared_receptor, pocket_definition, software, clustered_sdf,
+                                                     [function for function, score_file in zip(rescoring, score_files) if score_file.is_file()], ncpus),
+                                       inputs=score_files, outputs=[rescoring_folder / 'allposes_rescored.csv'],
+                                       params={'rescoring': rescoring}, depends=rescoring_stages)
+            rescored_stages[method] = merge_stage
 
     # Apply consensus methods to the poses
+    consensus_methods = [consensus] if isinstance(consensus, str) else (consensus or [])
     for method in pose_selection:
-        apply_consensus_methods(w_dir,
-                                method,
-                                consensus,
-                                rescoring,
-                                standardization_type='min_max')
+        suffix = 'sdf' if method in ['bestpose_GNINA', 'bestpose_SMINA', 'bestpose_PLANTS', 'bestpose_QVINAW', 'bestpose_QVINA2'] + list(RESCORING_FUNCTIONS.keys()) else 'csv'
+        pipeline.add(f'consensus_{method}',
+                     lambda results, method=method: apply_consensus_methods(w_dir, method, consensus, rescoring, standardization_type='min_max'),
+                     inputs=[w_dir / f'rescoring_{method}_clustered' / 'allposes_rescored.csv'],
+                     outputs=[w_dir / 'consensus' / f'{method}_{consensus_method}_results.{suffix}' for consensus_method in consensus_methods if consensus_method != 'None'],
+                     params={'consensus': consensus_methods}, depends=[rescored_stages[method]])
+    pipeline.run()
+    printlog(f'Run report written to {run_report} (run {run_id})')
+    if os.environ.get('DOCKM8_PROMETHEUS_TEXTFILE'):
+        write_prometheus_textfile(run_report, Path(os.environ['DOCKM8_PROMETHEUS_TEXTFILE']), run_id)
+    if os.environ.get('DOCKM8_PROFILE') and profiles.is_dir():
+        aggregate_profiles(profiles)
+        printlog(f'Profiles written to {profiles} (one .prof file per stage, all_stages.prof and profile_summary.txt)')
 
 
 def run_command(**kwargs):
@@ -306,6 +421,9 @@ def run_command(**kwargs):
                    prepare_proteins=kwargs.get('prepare_proteins'),
                    conformers=kwargs.get('conformers'),
                    protonation=kwargs.get('protonation'),
+                   deduplicate=kwargs.get('deduplicate'),
+                   filter_library=kwargs.get('filter_library'),
+                   streaming=kwargs.get('streaming'),
                    docking_programs=kwargs.get('docking_programs'),
                    bust_poses=kwargs.get('bust_poses'),
                    pose_selection=kwargs.get('pose_selection'),
@@ -346,6 +464,9 @@ def run_command(**kwargs):
                    prepare_proteins=kwargs.get('prepare_proteins'),
                    conformers=kwargs.get('conformers'),
                    protonation=kwargs.get('protonation'),
+                   deduplicate=kwargs.get('deduplicate'),
+                   filter_library=kwargs.get('filter_library'),
+                   streaming=kwargs.get('streaming'),
                    docking_programs=docking_programs,
                    bust_poses=kwargs.get('bust_poses'),
                    pose_selection=list(optimal_conditions['clustering']),
@@ -375,6 +496,9 @@ def run_command(**kwargs):
                    prepare_proteins=kwargs.get('prepare_proteins'),
                    conformers=kwargs.get('conformers'),
                    protonation=kwargs.get('protonation'),
+                   deduplicate=kwargs.get('deduplicate'),
+                   filter_library=kwargs.get('filter_library'),
+                   streaming=kwargs.get('streaming'),
                    docking_programs=kwargs.get('docking_programs'),
                    bust_poses=kwargs.get('bust_poses'),
                    pose_selection=kwargs.get('pose_selection'),
@@ -421,6 +545,9 @@ def run_command(**kwargs):
                        prepare_proteins=kwargs.get('prepare_proteins'),
                        conformers=kwargs.get('conformers'),
                        protonation=kwargs.get('protonation'),
+                       deduplicate=kwargs.get('deduplicate'),
+                       filter_library=kwargs.get('filter_library'),
+                       streaming=kwargs.get('streaming'),
                        docking_programs=docking_programs,
                        bust_poses=kwargs.get('bust_poses'),
                        pose_selection=list(optimal_conditions['clustering']),
@@ -448,6 +575,9 @@ def run_command(**kwargs):
                    prepare_proteins=kwargs.get('prepare_proteins'),
                    conformers=kwargs.get('conformers'),
                    protonation=kwargs.get('protonation'),
+                   deduplicate=kwargs.get('deduplicate'),
+                   filter_library=kwargs.get('filter_library'),
+                   streaming=kwargs.get('streaming'),
                    docking_programs=kwargs.get('docking_programs'),
                    bust_poses=kwargs.get('bust_poses'),
                    pose_selection=kwargs.get('pose_selection'),
@@ -457,6 +587,57 @@ def run_command(**kwargs):
                    clustering_method=kwargs.get('clustering_method'),
                    rescoring=kwargs.get('rescoring'),
                    consensus=kwargs.get('consensus'))
+        # Funnel and active learning modes
+        if kwargs.get('mode') in ['Funnel', 'active_learning']:
+            print(f"DockM8 is running in {kwargs.get('mode')} mode...")
+            receptor = (kwargs.get('receptor'))[0]
+            dockm8_settings = dict(software=Path(kwargs.get('software')),
+                                   receptor=receptor,
+                                   pocket=kwargs.get('pocket'),
+                                   ref=(kwargs.get('reffile'))[0]
+                                   if kwargs.get('reffile') else None,
+                                   dogsitescorer_mode=kwargs.get('dogsitescorer_mode'),
+                                   docking_library=kwargs.get('docking_library'),
+                                   idcolumn=kwargs.get('idcolumn'),
+                                   prepare_proteins=kwargs.get('prepare_proteins'),
+                                   conformers=kwargs.get('conformers'),
+                                   protonation=kwargs.get('protonation'),
+                                   deduplicate=kwargs.get('deduplicate'),
+                                   filter_library=kwargs.get('filter_library'),
+                                   streaming=kwargs.get('streaming'),
+                                   docking_programs=kwargs.get('docking_programs'),
+                                   bust_poses=kwargs.get('bust_poses'),
+                                   pose_selection=kwargs.get('pose_selection'),
+                                   nposes=kwargs.get('nposes'),
+                                   exhaustiveness=kwargs.get('exhaustiveness'),
+                                   ncpus=kwargs.get('ncpus'),
+                                   clustering_method=kwargs.get('clustering_method'),
+                                   rescoring=kwargs.get('rescoring'),
+                                   consensus=kwargs.get('consensus'))
+        if kwargs.get('mode') == 'Funnel':
+            # Each stage overrides the command line settings with its own
+            run_funnel(Path(kwargs.get('funnel_config')),
+                       Path(receptor).parent / Path(receptor).stem,
+                       Path(kwargs.get('docking_library')),
+                       lambda settings, w_dir: dockm8(**{**dockm8_settings, **settings}, w_dir=w_dir),
+                       defaults=dockm8_settings)
+        if kwargs.get('mode') == 'active_learning':
+            # Prepare the whole library once, each round docks a subset of it
+            al_dir = Path(receptor).parent / Path(receptor).stem / 'active_learning'
+            al_dir.mkdir(parents=True, exist_ok=True)
+            if not (al_dir / 'final_library.sdf').is_file():
+                prepare_library(kwargs.get('docking_library'), al_dir, kwargs.get('idcolumn'), kwargs.get('conformers'),
+                                kwargs.get('protonation'), Path(kwargs.get('software')), kwargs.get('ncpus'),
+                                deduplicate=kwargs.get('deduplicate'),
+                                filter_config=kwargs.get('filter_library'))
+            run_active_learning(al_dir,
+                                kwargs.get('pose_selection')[0],
+                                kwargs.get('consensus'),
+                                lambda w_dir: dockm8(**dockm8_settings, w_dir=w_dir),
+                                kwargs.get('ncpus'),
+                                batch_size=kwargs.get('al_batch_size'),
+                                max_fraction=kwargs.get('al_max_fraction'),
+                                top_fraction=kwargs.get('threshold') / 100)
         # Ensemble mode
         if kwargs.get('mode') == 'Ensemble':
             print('DockM8 is running in ensemble mode...')
@@ -478,6 +659,9 @@ def run_command(**kwargs):
                        prepare_proteins=kwargs.get('prepare_proteins'),
                        conformers=kwargs.get('conformers'),
                        protonation=kwargs.get('protonation'),
+                       deduplicate=kwargs.get('deduplicate'),
+                       filter_library=kwargs.get('filter_library'),
+                       streaming=kwargs.get('streaming'),
                        docking_programs=kwargs.get('docking_programs'),
                        bust_poses=kwargs.get('bust_poses'),
                        pose_selection=kwargs.get('pose_selection'),
@@ -183,6 +183,14 @@ ligand_conformers = col2.selectbox(
     "GypsumDL: DockM8 will use Gypsum-DL to prepare the ligand 3D conformers.",
 )
 
+conformer_threads = col2.number_input(
+    label="Embedding threads per worker process (MMFF)",
+    min_value=1,
+    value=1,
+    step=1,
+    help="Number of threads embedding the conformers of each worker process, the number of worker processes is divided accordingly",
+)
+
 # Ligand protonation
 col2.subheader("Ligand protonation", divider="orange")
 ligand_protonation = col2.selectbox(
@@ -193,6 +201,13 @@ ligand_protonation = col2.selectbox(
     "Gypsum-DL: DockM8 will use  Gypsum-DL to protonate the ligands",
 )
 
+# Ligand deduplication
+deduplicate = col2.checkbox(
+    label="Dock duplicate ligands only once",
+    value=True,
+    help="Ligands with the same standardized structure are docked and rescored once, their results are copied to all duplicates",
+)
+
 # Docking programs
 st.header("Docking programs", divider="orange")
 docking_programs = st.multiselect(
@@ -235,6 +250,13 @@ bust_poses = st.checkbox(
     "Bust poses using PoseBusters : Will remove any poses with clashes, non-flat aromatic rings etc. WARNING may take a long time to run",
 )
 
+streaming = st.checkbox(
+    label="Select and rescore poses while docking",
+    value=False,
+    help=
+    "The poses of each docked part of the library are selected and rescored while the rest of the library is still docking, first results are available sooner",
+)
+
 # Pose selection
 st.header("Pose Selection", divider="orange")
 pose_selection = st.multiselect(
@@ -312,9 +334,12 @@ command = (f'{sys.executable} {CWD}/dockm8.py '
            f'--idcolumn {id_column} '
            f'--prepare_proteins {prepare_receptor} '
            f'--conformers {ligand_conformers} '
+           f'--conformer_threads {conformer_threads} '
            f'--protonation {ligand_protonation} '
+           f'--deduplicate {deduplicate} '
            f'--docking_programs {" ".join(docking_programs)} '
            f'--bust_poses {bust_poses} '
+           f'--streaming {streaming} '
            f'--pose_selection {" ".join(pose_selection)} '
            f'--nposes {nposes} '
            f'--exhaustiveness {exhaustiveness} '
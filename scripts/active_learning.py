@@ -0,0 +1,184 @@
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from rdkit import Chem, RDLogger
+from rdkit.Chem import rdFingerprintGenerator
+from sklearn.ensemble import RandomForestRegressor
+
+from scripts.funnel import write_stage_library
+from scripts.postprocessing import calculate_consensus, consensus_tables, fan_out_duplicates
+from scripts.utilities import iter_sdf_records, map_sdf_batches, printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+FINGERPRINT_BITS = 1024
+
+
+def fingerprint_batch(records: list):
+    """
+    Computes the Morgan fingerprints (radius 2) of a batch of SDF records.
+
+    Returns:
+        tuple: The IDs of the records and their fingerprints as a packed bit array (one row per record, all zeros for unreadable records).
+    """
+    RDLogger.DisableLog('rdApp.*')
+    generator = rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=FINGERPRINT_BITS)
+    fingerprints = np.zeros((len(records), FINGERPRINT_BITS), dtype=np.uint8)
+    for i, (_, record) in enumerate(records):
+        molecule = Chem.MolFromMolBlock(record)
+        if molecule is not None:
+            fingerprints[i] = generator.GetFingerprintAsNumPy(molecule)
+    return [compound_id for compound_id, _ in records], np.packbits(fingerprints, axis=1)
+
+
+def library_fingerprints(library_sdf: Path, ncpus: int, batch_size: int = 1000):
+    """
+    Computes the fingerprints of all the compounds of a library in parallel.
+
+    Returns:
+        tuple: The list of IDs and the packed fingerprint array, in library order.
+    """
+    ids, fingerprints = [], []
+    for _, results in map_sdf_batches(iter_sdf_records(library_sdf), fingerprint_batch, ncpus, batch_size, 'Computing fingerprints'):
+        for batch_ids, batch_fingerprints in results:
+            ids.extend(batch_ids)
+            fingerprints.append(batch_fingerprints)
+    return ids, np.concatenate(fingerprints) if fingerprints else np.zeros((0, FINGERPRINT_BITS // 8), dtype=np.uint8)
+
+
+def maxmin_sample(packed_fingerprints: np.ndarray, n_picks: int, pool_size: int = 20000, seed: int = 42) -> np.ndarray:
+    """
+    Picks a diverse sample with the MaxMin algorithm on Tanimoto distances. For large libraries the picks are made from a random pool of pool_size compounds.
+
+    Returns:
+        np.ndarray: The indices of the picked compounds.
+    """
+    rng = np.random.default_rng(seed)
+    n_compounds = len(packed_fingerprints)
+    pool = rng.choice(n_compounds, size=min(n_compounds, max(pool_size, n_picks)), replace=False)
+    bits = np.unpackbits(packed_fingerprints[pool], axis=1).astype(np.float32)
+    counts = bits.sum(axis=1)
+    picks = [int(rng.integers(len(pool)))]
+    min_distances = np.full(len(pool), np.inf)
+    for _ in range(min(n_picks, len(pool)) - 1):
+        last = bits[picks[-1]]
+        intersection = bits @ last
+        union = counts + counts[picks[-1]] - intersection
+        similarity = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+        min_distances = np.minimum(min_distances, 1 - similarity)
+        min_distances[picks] = -1
+        picks.append(int(np.argmax(min_distances)))
+    return pool[picks]
+
+
+def gather_consensus(round_dirs: list, selection_method: str, consensus_method: str) -> pd.DataFrame:
+    """
+    Calculates the consensus scores of all the compounds docked so far. The rescored poses of all rounds are standardized together so that
+    scores of different rounds are comparable.
+
+    Returns:
+        pd.DataFrame: The consensus score of each docked compound, with columns 'ID' and 'score'.
+    """
+    rescored = pd.concat([pd.read_csv(Path(w_dir) / f'rescoring_{selection_method}_clustered' / 'allposes_rescored.csv') for w_dir in round_dirs], ignore_index=True)
+    standardized, ranked = consensus_tables(rescored, 'min_max')
+    consensus = calculate_consensus(standardized, ranked, selection_method, consensus_method)
+    return consensus.rename(columns={f'{consensus_method}_{selection_method}': 'score'})[['ID', 'score']]
+
+
+def predict_with_uncertainty(model: RandomForestRegressor, packed_fingerprints: np.ndarray, chunk_size: int = 50000):
+    """
+    Predicts scores with a random forest, in chunks. The uncertainty is the standard deviation of the predictions of the individual trees.
+
+    Returns:
+        tuple: The mean and the standard deviation of the predictions.
+    """
+    means, stds = [], []
+    for i in range(0, len(packed_fingerprints), chunk_size):
+        features = np.unpackbits(packed_fingerprints[i:i + chunk_size], axis=1)
+        tree_predictions = np.stack([tree.predict(features) for tree in model.estimators_])
+        means.append(tree_predictions.mean(axis=0))
+        stds.append(tree_predictions.std(axis=0))
+    return np.concatenate(means), np.concatenate(stds)
+
+
+def run_active_learning(al_dir: Path, selection_method: str, consensus_method: str, run_round, ncpus: int,
+                        batch_size: int = 1000, max_fraction: float = 0.2, top_fraction: float = 0.01,
+                        beta: float = 1.0, tolerance: float = 0.05, patience: int = 2) -> pd.DataFrame:
+    """
+    Active-learning screen of a prepared library (al_dir/final_library.sdf). A diverse initial sample is docked, then a random forest surrogate trained on
+    the consensus scores picks the next compounds by upper confidence bound (predicted score + beta * uncertainty). The loop stops once the
+    set of top scorers stops changing (overlap with the previous round above 1 - tolerance for patience rounds) or max_fraction of the library is docked.
+
+    Args:
+        al_dir (Path): The active-learning folder, holding the prepared library. Each round runs in its own round_{n} subfolder.
+        selection_method (str): The pose selection method used for the consensus scores.
+        consensus_method (str): The consensus method used as the surrogate target.
+        run_round (function): Function running DockM8 in the given working directory, called as run_round(w_dir).
+        ncpus (int): The number of CPUs to use.
+        batch_size (int): The number of compounds docked per round (including the initial sample).
+        max_fraction (float): The maximum fraction of the library to dock.
+        top_fraction (float): The fraction of the library defining the top scorers followed for the stopping criterion.
+        beta (float): The weight of the uncertainty in the acquisition function.
+        tolerance (float): The maximum fraction of top scorers that may change between rounds for the recall to be considered plateaued.
+        patience (int): The number of consecutive plateaued rounds before stopping.
+
+    Returns:
+        pd.DataFrame: The consensus score of the docked compounds and the predicted score of the others (also written to active_learning_results.csv).
+    """
+    ids, fingerprints = library_fingerprints(al_dir / 'final_library.sdf', ncpus)
+    n_library = len(ids)
+    index = {compound_id: i for i, compound_id in enumerate(ids)}
+    max_docked = max(batch_size, int(max_fraction * n_library))
+    n_top = max(1, int(top_fraction * n_library))
+    selected = maxmin_sample(fingerprints, min(batch_size, n_library))
+    docked = np.zeros(n_library, dtype=bool)
+    round_dirs, history = [], []
+    previous_top, plateau_rounds = None, 0
+    model = None
+    round_number = 0
+    while True:
+        round_number += 1
+        tic = time.perf_counter()
+        w_dir = al_dir / f'round_{round_number}'
+        if not (w_dir / 'final_library.sdf').is_file():
+            write_stage_library(al_dir, w_dir, {ids[i] for i in selected})
+        run_round(w_dir)
+        docked[selected] = True
+        round_dirs.append(w_dir)
+        scores = gather_consensus(round_dirs, selection_method, consensus_method)
+        scores = scores[scores['ID'].isin(index) & scores['score'].notna()]
+        top = set(scores.nlargest(min(n_top, len(scores)), 'score')['ID'])
+        overlap = len(top & previous_top) / len(top) if previous_top else 0.0
+        plateau_rounds = plateau_rounds + 1 if previous_top and overlap >= 1 - tolerance else 0
+        previous_top = top
+        # Train the surrogate on all compounds docked so far
+        model = RandomForestRegressor(n_estimators=100, min_samples_leaf=2, oob_score=True, n_jobs=ncpus, random_state=42)
+        model.fit(np.unpackbits(fingerprints[[index[compound_id] for compound_id in scores['ID']]], axis=1), scores['score'].to_numpy())
+        history.append({'round': round_number, 'docked': int(docked.sum()), 'top_overlap': round(overlap, 3), 'surrogate_oob_r2': round(model.oob_score_, 3), 'time_s': round(time.perf_counter() - tic, 1)})
+        printlog(f'Active learning round {round_number}: {docked.sum()} of {n_library} compounds docked, top {len(top)} overlap with previous round {overlap:.2f}, surrogate OOB R2 {model.oob_score_:.2f}')
+        if plateau_rounds >= patience:
+            printlog('Active learning stopped: recall of the top scorers has plateaued.')
+            break
+        if docked.sum() >= max_docked or docked.all():
+            printlog('Active learning stopped: docking budget reached.')
+            break
+        # Pick the next compounds by upper confidence bound
+        undocked = np.flatnonzero(~docked)
+        mean, std = predict_with_uncertainty(model, fingerprints[undocked])
+        acquisition = mean + beta * std
+        n_next = min(batch_size, max_docked - int(docked.sum()), len(undocked))
+        selected = undocked[np.argsort(-acquisition)[:n_next]]
+    pd.DataFrame(history).to_csv(al_dir / 'active_learning_history.csv', index=False)
+    # Final results: consensus scores of docked compounds and surrogate predictions for the others
+    results = scores.assign(docked=True)
+    undocked = np.flatnonzero(~docked)
+    if len(undocked):
+        mean, std = predict_with_uncertainty(model, fingerprints[undocked])
+        results = pd.concat([results, pd.DataFrame({'ID': [ids[i] for i in undocked], 'score': mean, 'uncertainty': std, 'docked': False})], ignore_index=True)
+    results = fan_out_duplicates(results, al_dir).sort_values('score', ascending=False)
+    results.to_csv(al_dir / 'active_learning_results.csv', index=False)
+    return results
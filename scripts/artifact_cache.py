@@ -0,0 +1,255 @@
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+import warnings
+from pathlib import Path
+
+from meeko import MoleculePreparation, PDBQTWriterLegacy
+from openbabel import pybel
+from rdkit import Chem, RDLogger
+from tqdm import tqdm
+
+from scripts.profiling import profiled
+from scripts.utilities import convert_molecules, iter_sdf_records, printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+
+def ligand_cache_folder(w_dir: Path) -> Path:
+    """
+    Returns the folder holding the prepared ligand files of a DockM8 working directory.
+    """
+    return Path(w_dir) / 'ligand_cache'
+
+
+def record_hash(record: str) -> str:
+    """
+    Returns the hash of the title and molecule block of an SDF record (the SDF properties are not included).
+    """
+    end = record.find('M  END')
+    return hashlib.sha1(record[:end if end != -1 else len(record)].encode()).hexdigest()
+
+
+def ligand_to_pdbqt(record: str) -> str:
+    """
+    Converts an SDF record to a PDBQT string with Meeko.
+    """
+    mol = Chem.MolFromMolBlock(record, removeHs=False)
+    setup_list = MoleculePreparation(min_ring_size=10).prepare(Chem.AddHs(mol, addCoords=True))
+    return PDBQTWriterLegacy.write_string(setup_list[0])[0]
+
+
+def ligand_to_mol2(record: str) -> str:
+    """
+    Converts an SDF record to a mol2 string with Pybel.
+    """
+    return pybel.readstring('sdf', record).write('mol2')
+
+
+LIGAND_CONVERTERS = {'pdbqt': ligand_to_pdbqt, 'mol2': ligand_to_mol2}
+
+
+def _prepare_ligand_shard(records: list, cache_folder: Path, formats: list) -> int:
+    """
+    Writes the missing prepared files of a shard of (hash, record) pairs to the cache.
+
+    Returns:
+        int: The number of ligands that could not be prepared.
+    """
+    RDLogger.DisableLog('rdApp.*')
+    failures = 0
+    for ligand_hash, record in records:
+        title = record.split('\n', 1)[0].strip()
+        for fmt in formats:
+            cached_file = cache_folder / fmt / f'{ligand_hash}.{fmt}'
+            if cached_file.is_file():
+                continue
+            try:
+                text = LIGAND_CONVERTERS[fmt](record)
+                # Write to a temporary file first so that an interrupted run never leaves a truncated file in the cache, with a unique name
+                # as several processes may prepare the same ligand at once (e.g. docking workers, or two rescoring functions on the same poses)
+                tmp_file = cached_file.with_suffix(f'.{fmt}.{uuid.uuid4().hex}.tmp')
+                tmp_file.write_text(text)
+                tmp_file.replace(cached_file)
+            except Exception as e:
+                printlog(f'ERROR: Failed to prepare {title} in {fmt} format: {e}')
+                failures += 1
+    return failures
+
+
+def prepare_ligand_cache(sdf_file: Path, cache_folder: Path, formats: list, ncpus: int) -> None:
+    """
+    Prepares the ligands of an SDF file in the given formats, in parallel, and stores them in the cache keyed by ligand hash.
+    Ligands already present in the cache are skipped, so the files are built once and shared by all docking and rescoring programs.
+
+    Args:
+        sdf_file (Path): The path to the SDF file with the ligands (or poses).
+        cache_folder (Path): The path to the ligand cache folder.
+        formats (list): The formats to prepare ('pdbqt', 'mol2').
+        ncpus (int): The number of CPUs to use.
+    """
+    tic = time.perf_counter()
+    for fmt in formats:
+        (Path(cache_folder) / fmt).mkdir(parents=True, exist_ok=True)
+    missing = []
+    for _, record in iter_sdf_records(sdf_file):
+        ligand_hash = record_hash(record)
+        if any(not (Path(cache_folder) / fmt / f'{ligand_hash}.{fmt}').is_file() for fmt in formats):
+            missing.append((ligand_hash, record))
+    if not missing:
+        return
+    shard_size = max(1, len(missing) // (ncpus * 4))
+    shards = [missing[i:i + shard_size] for i in range(0, len(missing), shard_size)]
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus) as executor:
+        jobs = [executor.submit(profiled(_prepare_ligand_shard), shard, Path(cache_folder), formats) for shard in shards]
+        for job in tqdm(concurrent.futures.as_completed(jobs), total=len(jobs), desc=f'Preparing ligands ({", ".join(formats)})'):
+            failures += job.result()
+    toc = time.perf_counter()
+    printlog(f'Prepared {len(missing) - failures} ligands in {", ".join(formats)} format in {toc - tic:0.4f}!')
+
+
+def get_cached_ligands(sdf_file: Path, cache_folder: Path, fmt: str) -> list:
+    """
+    Returns the cached prepared files of the ligands of an SDF file, preparing any missing ligand in the current process.
+
+    Args:
+        sdf_file (Path): The path to the SDF file with the ligands (or poses).
+        cache_folder (Path): The path to the ligand cache folder.
+        fmt (str): The format of the prepared files ('pdbqt', 'mol2').
+
+    Returns:
+        list: The (ligand name, prepared file path) pairs, in the order of the SDF file. Ligands that could not be prepared are left out.
+    """
+    (Path(cache_folder) / fmt).mkdir(parents=True, exist_ok=True)
+    records = [(title, record_hash(record), record) for title, record in iter_sdf_records(sdf_file)]
+    _prepare_ligand_shard([(ligand_hash, record) for _, ligand_hash, record in records], Path(cache_folder), [fmt])
+    cached_ligands = [(title, Path(cache_folder) / fmt / f'{ligand_hash}.{fmt}') for title, ligand_hash, _ in records]
+    return [(title, path) for title, path in cached_ligands if path.is_file()]
+
+
+def write_cached_mol2(sdf_file: Path, cache_folder: Path, output_file: Path) -> Path:
+    """
+    Writes a multi-molecule mol2 file for the ligands of an SDF file by concatenating their cached mol2 files.
+
+    Returns:
+        Path: The path to the written mol2 file.
+    """
+    with open(output_file, 'w') as outfile:
+        for _, mol2_file in get_cached_ligands(sdf_file, cache_folder, 'mol2'):
+            outfile.write(mol2_file.read_text())
+    return output_file
+
+
+# Conversion recipe of each receptor format, change the version to invalidate cached files after changing the conversion
+RECEPTOR_RECIPES = {'pdbqt': 'openbabel-gasteiger-rigid-v1', 'mol2': 'openbabel-v1'}
+
+
+def dockm8_cache_folder() -> Path:
+    """
+    Returns the per-machine DockM8 cache folder (~/.cache/dockm8, or $DOCKM8_CACHE_DIR).
+    """
+    return Path(os.environ.get('DOCKM8_CACHE_DIR', Path.home() / '.cache' / 'dockm8'))
+
+
+def receptor_cache_folder() -> Path:
+    """
+    Returns the per-machine folder holding cached receptor files.
+    """
+    return dockm8_cache_folder() / 'receptors'
+
+
+def file_hash(file: Path) -> str:
+    """
+    Returns the hash of the content of a file.
+    """
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cached_artifact(key_parts: list, suffix: str, build_function) -> Path:
+    """
+    Returns a cached file derived from the given key, building it with build_function(output_path) if it is not cached yet.
+    Files are built under a temporary name unique to each build and renamed, so concurrent runs and threads never read a partially written file.
+    A build that leaves no file, or an empty one, is not cached.
+
+    Args:
+        key_parts (list): The strings identifying the file (content hashes, format, recipe).
+        suffix (str): The suffix of the cached file.
+        build_function (function): Function writing the file to the path it is given.
+
+    Returns:
+        Path: The path to the cached file.
+
+    Raises:
+        RuntimeError: If build_function did not write the file or wrote an empty file.
+    """
+    cache_folder = receptor_cache_folder()
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    cached_file = cache_folder / (hashlib.sha1('|'.join(key_parts).encode()).hexdigest() + suffix)
+    if not cached_file.is_file():
+        tmp_file = cache_folder / f'{cached_file.stem}.{uuid.uuid4().hex}.tmp{suffix}'
+        build_function(tmp_file)
+        if not tmp_file.is_file() or tmp_file.stat().st_size == 0:
+            tmp_file.unlink(missing_ok=True)
+            raise RuntimeError(f'Building the cached {suffix} file ({", ".join(key_parts)}) wrote no output or an empty file')
+        tmp_file.replace(cached_file)
+    return cached_file
+
+
+def get_receptor_artifact(protein_file: Path, fmt: str) -> Path:
+    """
+    Returns the receptor converted to the given format ('pdbqt' with Gasteiger charges, or 'mol2'), converting it once per receptor content and machine.
+
+    Args:
+        protein_file (Path): The path to the receptor (or pocket) PDB file.
+        fmt (str): The format to convert to.
+
+    Returns:
+        Path: The path to the cached converted file.
+
+    Raises:
+        RuntimeError: If the conversion failed (convert_molecules only logs OpenBabel errors).
+    """
+    try:
+        return cached_artifact([file_hash(protein_file), fmt, RECEPTOR_RECIPES[fmt]],
+                               f'.{fmt}',
+                               lambda output_file: convert_molecules(protein_file, output_file, 'pdb', fmt))
+    except RuntimeError as e:
+        raise RuntimeError(f'Failed to convert {protein_file} to {fmt} format') from e
+
+
+def prepared_ligand_database() -> sqlite3.Connection:
+    """
+    Opens the per-machine database of prepared ligands (prepared_ligands.sqlite in the DockM8 cache folder), creating it if needed.
+    Each entry maps a key (input structure and preparation settings) to the prepared 3D molblock, without its title line.
+    """
+    dockm8_cache_folder().mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(dockm8_cache_folder() / 'prepared_ligands.sqlite'), timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS prepared_ligands (key TEXT PRIMARY KEY, molblock TEXT NOT NULL)')
+    return connection
+
+
+def lookup_prepared_ligands(connection: sqlite3.Connection, keys: list) -> dict:
+    """
+    Returns the cached prepared molblocks of the given keys, as a dictionary of key to molblock. Keys not in the cache are left out.
+    """
+    unique_keys = list(set(keys))
+    found = {}
+    # Stay below the SQLite limit on the number of query parameters
+    for i in range(0, len(unique_keys), 500):
+        chunk = unique_keys[i:i + 500]
+        found.update(connection.execute(f'SELECT key, molblock FROM prepared_ligands WHERE key IN ({",".join("?" * len(chunk))})', chunk))
+    return found
+
+
+def store_prepared_ligands(connection: sqlite3.Connection, entries: list) -> None:
+    """
+    Stores (key, molblock) pairs in the prepared ligand database.
+    """
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO prepared_ligands (key, molblock) VALUES (?, ?)', entries)
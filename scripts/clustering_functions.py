@@ -15,6 +15,7 @@ from sklearn_extra.cluster import KMedoids
 from tqdm import tqdm
 
 from scripts.clustering_metrics import CLUSTERING_METRICS
+from scripts.profiling import profiled
 from scripts.rescoring_functions import RESCORING_FUNCTIONS, rescore_docking
 from scripts.utilities import printlog
 
@@ -209,7 +210,7 @@ def select_poses(selection_method : str, clustering_method : str, w_dir : Path,
                 for current_id in tqdm(id_list, desc=f'Submitting {selection_method} jobs...', unit='IDs'):
                     try:
                         # Schedule the clustering job for each ID
-                        job = executor.schedule(calculate_and_cluster, args=(selection_method, clustering_method, all_poses[all_poses['ID'] == current_id], protein_file), timeout=120)
+                        job = executor.schedule(profiled(calculate_and_cluster), args=(selection_method, clustering_method, all_poses[all_poses['ID'] == current_id], protein_file), timeout=120)
                         jobs.append(job)
                     except pebble.TimeoutError as e:
                         printlog("Timeout error in pebble job creation: " + str(e))
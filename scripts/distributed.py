@@ -0,0 +1,221 @@
+import argparse
+import multiprocessing
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+import warnings
+from pathlib import Path
+
+from tqdm import tqdm
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Filesystem task queue shared by a coordinator and any number of workers, on one or several hosts (the queue folder and the
+# working directories must be on a filesystem mounted at the same path on all hosts). Layout of the queue folder:
+#   tasks/<job>-<n>.task            pending tasks, claimed by a worker by renaming them to running/
+#   running/<job>-<n>.<claim>.task  claimed tasks, the worker touches the file regularly to keep its lease
+#   results/<job>-<n>.result        pickled ('ok', result) or ('error', traceback) of each task
+# A worker only writes the result of a task it still holds: it deletes its claim file first, and drops the result if the task was requeued.
+# Leases are measured on the coordinator's clock, from the last change of the claim file's modification time, so host clocks need not be in sync.
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 30
+
+
+def queue_folders(queue_dir: Path):
+    """
+    Returns the tasks, running and results folders of a queue, creating them if needed.
+    """
+    folders = [Path(queue_dir) / name for name in ['tasks', 'running', 'results']]
+    for folder in folders:
+        folder.mkdir(parents=True, exist_ok=True)
+    return folders
+
+
+def write_atomic(path: Path, data: bytes):
+    """
+    Writes a file under a temporary name and renames it, so that readers never see a partially written file.
+    """
+    tmp_path = path.with_name(f'.{path.name}.{socket.gethostname()}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+
+
+def start_local_workers(queue_dir: Path, n_workers: int) -> list:
+    """
+    Starts worker processes on this host, e.g. to run a distributed job without any remote host.
+
+    Returns:
+        list: The worker processes (subprocess.Popen).
+    """
+    root = Path(__file__).resolve().parent.parent
+    return [subprocess.Popen([sys.executable, '-m', 'scripts.distributed', 'worker', '--queue_dir', str(queue_dir), '--idle_timeout', '60'], cwd=root)
+            for _ in range(n_workers)]
+
+
+def distributed_map(function, list_of_objects: list, queue_dir: Path, local_workers: int = 0, poll_interval: float = 0.5, on_result=None, **kwargs) -> list:
+    """
+    Runs function(obj, **kwargs) for each object through the filesystem task queue and waits for the results.
+    Tasks whose worker stopped renewing its lease (crashed host or process) are put back in the queue.
+
+    Args:
+        function (function): The function to run, must be importable by the workers (module-level function of the scripts package).
+        list_of_objects (list): The objects to run the function on.
+        queue_dir (Path): The queue folder, shared with the workers.
+        local_workers (int): The number of workers to start on this host for the duration of the job.
+        poll_interval (float): Seconds between checks for finished tasks.
+        on_result (function): Optional function called with each result as it arrives.
+        **kwargs: Additional keyword arguments passed to the function.
+
+    Returns:
+        list: The results, in completion order.
+
+    Raises:
+        RuntimeError: If a task raised an exception in its worker.
+    """
+    tasks_folder, running_folder, results_folder = queue_folders(queue_dir)
+    job_id = uuid.uuid4().hex[:12]
+    task_names = [f'{job_id}-{i:06d}' for i in range(len(list_of_objects))]
+    for task_name, obj in zip(task_names, list_of_objects):
+        write_atomic(tasks_folder / f'{task_name}.task', pickle.dumps((function, obj, kwargs)))
+    workers = start_local_workers(queue_dir, local_workers) if local_workers else []
+    results = []
+    remaining = set(task_names)
+    # Last modification time of each claim file and the time it was first seen
+    leases = {}
+    try:
+        with tqdm(total=len(task_names), desc=f'Running {function.__name__} (distributed)') as progress:
+            while remaining:
+                for result_file in results_folder.glob(f'{job_id}-*.result'):
+                    task_name = result_file.stem
+                    status, payload = pickle.loads(result_file.read_bytes())
+                    result_file.unlink(missing_ok=True)
+                    if task_name not in remaining:
+                        continue
+                    if status != 'ok':
+                        raise RuntimeError(f'Task {task_name} of {function.__name__} failed:\n{payload}')
+                    results.append(payload)
+                    if on_result is not None:
+                        on_result(payload)
+                    remaining.discard(task_name)
+                    progress.update(1)
+                # Requeue the tasks of workers that stopped sending heartbeats
+                for running_file in running_folder.glob(f'{job_id}-*.task'):
+                    try:
+                        mtime = running_file.stat().st_mtime
+                        if leases.get(running_file.name, (None,))[0] != mtime:
+                            leases[running_file.name] = (mtime, time.monotonic())
+                        elif time.monotonic() - leases[running_file.name][1] > LEASE_SECONDS:
+                            running_file.replace(tasks_folder / f'{task_id(running_file)}.task')
+                            del leases[running_file.name]
+                    except FileNotFoundError:
+                        continue
+                if remaining:
+                    time.sleep(poll_interval)
+    finally:
+        # Remove the tasks left when the job fails or is interrupted, and the results of tasks that are no longer waited for
+        for folder in [tasks_folder, running_folder]:
+            for task_file in folder.glob(f'{job_id}-*.task'):
+                task_file.unlink(missing_ok=True)
+        for result_file in results_folder.glob(f'{job_id}-*.result'):
+            result_file.unlink(missing_ok=True)
+        for worker in workers:
+            worker.terminate()
+    return results
+
+
+def task_id(task_file: Path) -> str:
+    """
+    Returns the identifier (<job>-<n>) of a pending or claimed task file.
+    """
+    return task_file.name.split('.', 1)[0]
+
+
+def claim_task(tasks_folder: Path, running_folder: Path):
+    """
+    Claims the oldest pending task. The rename is atomic, so only one worker can claim each task. The claim file has a unique name,
+    so that a worker whose task was requeued and claimed again cannot mistake the new claim for its own.
+
+    Returns:
+        Path: The claimed task file, or None if no task is pending.
+    """
+    for task_file in sorted(tasks_folder.glob('*.task')):
+        claimed = running_folder / f'{task_id(task_file)}.{uuid.uuid4().hex[:12]}.task'
+        try:
+            task_file.replace(claimed)
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        claimed.touch()
+        return claimed
+    return None
+
+
+def run_worker(queue_dir: Path, poll_interval: float = 1.0, idle_timeout: float = None):
+    """
+    Pulls tasks from the queue and runs them until stopped, or until no task was found for idle_timeout seconds.
+    """
+    tasks_folder, running_folder, results_folder = queue_folders(queue_dir)
+    idle_since = time.time()
+    while True:
+        claimed = claim_task(tasks_folder, running_folder)
+        if claimed is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                return
+            time.sleep(poll_interval)
+            continue
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(HEARTBEAT_SECONDS):
+                try:
+                    claimed.touch()
+                except FileNotFoundError:
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            function, obj, kwargs = pickle.loads(claimed.read_bytes())
+            result = ('ok', function(obj, **kwargs))
+        except Exception:
+            result = ('error', f'{socket.gethostname()}: {traceback.format_exc()}')
+        finally:
+            stop_heartbeat.set()
+        try:
+            data = pickle.dumps(result)
+        except Exception:
+            data = pickle.dumps(('error', f'{socket.gethostname()}: result could not be pickled\n{traceback.format_exc()}'))
+        try:
+            # Release the claim: this fails if the lease expired and the task was requeued (or the job ended), the result is then dropped
+            claimed.unlink()
+        except FileNotFoundError:
+            idle_since = time.time()
+            continue
+        write_atomic(results_folder / f'{task_id(claimed)}.result', data)
+        idle_since = time.time()
+
+
+def _worker_process(queue_dir: str, poll_interval: float, idle_timeout: float):
+    run_worker(Path(queue_dir), poll_interval, idle_timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DockM8 distributed worker: runs tasks published to a shared queue folder')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='Start workers on this host')
+    worker_parser.add_argument('--queue_dir', required=True, type=str, help='Path to the shared queue folder')
+    worker_parser.add_argument('--workers', default=1, type=int, help='Number of worker processes to start on this host')
+    worker_parser.add_argument('--poll_interval', default=1.0, type=float, help='Seconds between checks for new tasks')
+    worker_parser.add_argument('--idle_timeout', default=None, type=float, help='Stop after this many seconds without tasks (default: run until stopped)')
+    args = parser.parse_args()
+    processes = [multiprocessing.Process(target=_worker_process, args=(args.queue_dir, args.poll_interval, args.idle_timeout)) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -1,3 +1,4 @@
+import heapq
 import os
 import shutil
 import subprocess
@@ -10,18 +11,26 @@ import traceback
 
 import pandas as pd
 from meeko import PDBQTMolecule, RDKitMolCreate
-from posebusters import PoseBusters
 from rdkit import Chem
 from rdkit.Chem import PandasTools
 from tqdm import tqdm
-from yaml import safe_load
 from rdkit import RDLogger
 
 
+from scripts.artifact_cache import (
+    get_cached_ligands,
+    get_receptor_artifact,
+    ligand_cache_folder,
+    prepare_ligand_cache,
+    write_cached_mol2,
+)
+from scripts.pose_validation import validate_poses
+from scripts.telemetry import count_records, cpu_seconds, record
 from scripts.utilities import (
     convert_molecules,
     delete_files,
     parallel_executor,
+    iter_sdf_records,
     printlog,
     split_sdf_str
 )
@@ -48,28 +57,21 @@ def qvinaw_docking(w_dir : Path, protein_file: Path, pocket_definition : dict, s
     # Create required directories
     library = w_dir / 'final_library.sdf'
     qvinaw_folder = w_dir / 'qvinaw'
-    pdbqt_files_folder = qvinaw_folder / 'pdbqt_files'
-    pdbqt_files_folder.mkdir(parents=True, exist_ok=True)
     results_path = qvinaw_folder / 'docked'
     results_path.mkdir(parents=True, exist_ok=True)
 
     # Convert the protein file to .pdbqt format
-    protein_file_pdbqt = convert_molecules(str(protein_file).replace('.pdb', '_pocket.pdb'), str(protein_file).replace('.pdb', '_pocket.pdbqt'), 'pdb', 'pdbqt')
-    # Convert the ligand files to .pdbqt format
-    try:
-        convert_molecules(library, str(pdbqt_files_folder), 'sdf', 'pdbqt')
-    except Exception as e:
-        print('Failed to convert sdf file to .pdbqt')
-        print(e)
-    pdbqt_files = list(pdbqt_files_folder.glob('*.pdbqt'))
+    protein_file_pdbqt = get_receptor_artifact(str(protein_file).replace('.pdb', '_pocket.pdb'), 'pdbqt')
+    # Prepared ligands are shared with the other docking programs through the ligand cache
+    pdbqt_files = get_cached_ligands(library, ligand_cache_folder(w_dir), 'pdbqt')
 
     # Dock each ligand in the library using QVINAW
-    for pdbqt_file in tqdm(pdbqt_files, desc='Docking with QVINAW', total=len(pdbqt_files)):
+    for ligand_name, pdbqt_file in tqdm(pdbqt_files, desc='Docking with QVINAW', total=len(pdbqt_files)):
         qvinaw_cmd = (
             f"{software / 'qvina-w'}"
             f" --receptor {protein_file_pdbqt}"
             f" --ligand {pdbqt_file}"
-            f" --out {str(pdbqt_file).replace('pdbqt_files', 'docked')}"
+            f" --out {results_path / f'{ligand_name}.pdbqt'}"
             f" --center_x {pocket_definition['center'][0]}"
             f" --center_y {pocket_definition['center'][1]}"
             f" --center_z {pocket_definition['center'][2]}"
@@ -146,7 +148,6 @@ def qvinaw_docking(w_dir : Path, protein_file: Path, pocket_definition : dict, s
         printlog('ERROR: Failed to combine QVINAW SDF file!')
         printlog(e)
     else:
-        shutil.rmtree(pdbqt_files_folder, ignore_errors=True)
         shutil.rmtree(results_path, ignore_errors=True)
 
     return str(qvinaw_docking_results)
@@ -172,30 +173,21 @@ def qvina2_docking(w_dir: Path, protein_file: str, pocket_definition: dict,
     # Create required directories
     library = w_dir / 'final_library.sdf'
     qvina2_folder = w_dir / 'qvina2'
-    pdbqt_files_folder = qvina2_folder / 'pdbqt_files'
-    pdbqt_files_folder.mkdir(parents=True, exist_ok=True)
     results_path = qvina2_folder / 'docked'
     results_path.mkdir(parents=True, exist_ok=True)
     # Convert the protein file to .pdbqt format
-    protein_file_pdbqt = convert_molecules(
-        str(protein_file).replace('.pdb', '_pocket.pdb'),
-        str(protein_file).replace('.pdb', '_pocket.pdbqt'), 'pdb', 'pdbqt')
-    # Convert the ligand files to .pdbqt format
-    try:
-        convert_molecules(library, str(pdbqt_files_folder), 'sdf', 'pdbqt')
-    except Exception as e:
-        print('Failed to convert sdf file to .pdbqt')
-        print(e)
-    pdbqt_files = list(pdbqt_files_folder.glob('*.pdbqt'))
+    protein_file_pdbqt = get_receptor_artifact(str(protein_file).replace('.pdb', '_pocket.pdb'), 'pdbqt')
+    # Prepared ligands are shared with the other docking programs through the ligand cache
+    pdbqt_files = get_cached_ligands(library, ligand_cache_folder(w_dir), 'pdbqt')
     # Perform docking using QVINA2 for each ligand in the library
-    for pdbqt_file in tqdm(pdbqt_files,
-                           desc='Docking with QVINA2',
-                           total=len(pdbqt_files)):
+    for ligand_name, pdbqt_file in tqdm(pdbqt_files,
+                                        desc='Docking with QVINA2',
+                                        total=len(pdbqt_files)):
         qvina2_cmd = (
             f"{software / 'qvina2.1'}"
             f" --receptor {protein_file_pdbqt}"
             f" --ligand {pdbqt_file}"
-            f" --out {str(pdbqt_file).replace('pdbqt_files', 'docked')}"
+            f" --out {results_path / f'{ligand_name}.pdbqt'}"
             f" --center_x {pocket_definition['center'][0]}"
             f" --center_y {pocket_definition['center'][1]}"
             f" --center_z {pocket_definition['center'][2]}"
@@ -272,7 +264,6 @@ def qvina2_docking(w_dir: Path, protein_file: str, pocket_definition: dict,
         printlog('ERROR: Failed to combine QVINA2 SDF file!')
         printlog(e)
     else:
-        shutil.rmtree(pdbqt_files_folder, ignore_errors=True)
         shutil.rmtree(results_path, ignore_errors=True)
 
     return str(qvina2_docking_results)
@@ -475,13 +466,12 @@ def plants_docking(w_dir: Path, protein_file, pocket_definition, software,
     # Create required directories
     plants_folder = w_dir / 'plants'
     plants_folder.mkdir(parents=True, exist_ok=True)
-    # Convert protein file to .mol2 using open babel
-    plants_protein_mol2 = w_dir / 'plants' / 'protein.mol2'
-    convert_molecules(protein_file, plants_protein_mol2, 'pdb', 'mol2')
-    # Convert prepared ligand file to .mol2 using open babel
+    # Receptor in .mol2 format, converted once per receptor
+    plants_protein_mol2 = get_receptor_artifact(protein_file, 'mol2')
+    # Build the ligand mol2 file from the ligand cache
     library = w_dir / 'final_library.sdf'
     plants_library_mol2 = plants_folder / 'ligands.mol2'
-    convert_molecules(library, plants_library_mol2, 'sdf', 'mol2')
+    write_cached_mol2(library, ligand_cache_folder(w_dir), plants_library_mol2)
     # Generate plants config file
     plants_docking_config_path = plants_folder / 'config.config'
     plants_config = [
@@ -698,6 +688,8 @@ def plants_docking_splitted(split_file: Path, w_dir: Path, n_poses: int,
     """
     plants_docking_results_dir = w_dir / 'plants' / ('results_' +
                                                      split_file.stem)
+    # Build the ligand mol2 file of the split from the ligand cache
+    write_cached_mol2(split_file, ligand_cache_folder(w_dir), split_file.with_suffix('.mol2'))
     # Generate plants config file
     plants_docking_config_path = w_dir / 'plants' / (
         'config_' + split_file.stem + '.config')
@@ -748,6 +740,42 @@ def plants_docking_splitted(split_file: Path, w_dir: Path, n_poses: int,
     return None
 
 
+def write_vina_poses(results_path: Path, program: str, output_sdf: Path) -> Path:
+    """
+    Converts the multi-model PDBQT files written by QVINA2/QVINAW into a single SDF file.
+    Each PDBQT file is read once: the RDKit poses are built from all its models in one go and the affinities are read from the REMARK VINA RESULT lines.
+
+    Args:
+        results_path (Path): The folder containing the docked PDBQT files (one per ligand).
+        program (str): The name of the docking program, used in the Pose IDs and the affinity property.
+        output_sdf (Path): The path to the SDF file to write.
+
+    Returns:
+        Path: The path to the written SDF file.
+    """
+    writer = Chem.SDWriter(str(output_sdf))
+    for pdbqt_file in results_path.glob('*.pdbqt'):
+        try:
+            with open(pdbqt_file, 'r') as f:
+                pdbqt_string = f.read()
+            lines = pdbqt_string.splitlines()
+            affinities = [line.split()[3] for line in lines if line.startswith('REMARK VINA RESULT:')]
+            model_numbers = [int(line.split()[-1]) for line in lines if line.startswith('MODEL')] or range(1, len(affinities) + 1)
+            pdbqt_mol = PDBQTMolecule(pdbqt_string, name=pdbqt_file.stem, skip_typing=True)
+            mol = RDKitMolCreate.from_pdbqt_mol(pdbqt_mol)[0]
+            for conformer, model_number, affinity in zip(mol.GetConformers(), model_numbers, affinities):
+                pose = Chem.Mol(mol, confId=conformer.GetId())
+                pose.SetProp('_Name', f'{pdbqt_file.stem}_{program}_{model_number}')
+                pose.SetProp(f'{program}_Affinity', affinity)
+                pose.SetProp('ID', pdbqt_file.stem.split('_')[0])
+                writer.write(pose)
+        except Exception as e:
+            printlog(f'ERROR: Failed to read {program} poses from {pdbqt_file}!')
+            printlog(e)
+    writer.close()
+    return output_sdf
+
+
 def qvinaw_docking_splitted(split_file: Path, w_dir: Path,
                             protein_file_pdbqt: Path,
                             pocket_definition: Dict[str, list], software: Path,
@@ -769,23 +797,16 @@ def qvinaw_docking_splitted(split_file: Path, w_dir: Path,
 
     # Create necessary folders for QVINAW docking
     qvinaw_folder = w_dir / 'qvinaw'
-    pdbqt_files_folder = qvinaw_folder / Path(split_file).stem / 'pdbqt_files'
-    pdbqt_files_folder.mkdir(parents=True, exist_ok=True)
     results_path = qvinaw_folder / Path(split_file).stem / 'docked'
     results_path.mkdir(parents=True, exist_ok=True)
-    try:
-        # Convert split file to pdbqt format
-        convert_molecules(split_file, str(pdbqt_files_folder), 'sdf', 'pdbqt')
-    except Exception as e:
-        print('Failed to convert sdf file to .pdbqt')
-        print(e)
-    pdbqt_files = list(pdbqt_files_folder.glob('*.pdbqt'))
+    # Prepared ligands are shared with the other docking programs through the ligand cache
+    pdbqt_files = get_cached_ligands(split_file, ligand_cache_folder(w_dir), 'pdbqt')
     # Dock each ligand using QVINAW
-    for pdbqt_file in pdbqt_files:
+    for ligand_name, pdbqt_file in pdbqt_files:
         qvina_cmd = (
             f"{software / 'qvina-w'}" + f" --receptor {protein_file_pdbqt}" +
             f" --ligand {pdbqt_file}" +
-            f" --out {str(pdbqt_file).replace('pdbqt_files', 'docked')}" +
+            f" --out {results_path / f'{ligand_name}.pdbqt'}" +
             f" --center_x {pocket_definition['center'][0]}" +
             f" --center_y {pocket_definition['center'][1]}" +
             f" --center_z {pocket_definition['center'][2]}" +
@@ -806,52 +827,8 @@ def qvinaw_docking_splitted(split_file: Path, w_dir: Path,
             printlog('QVINAW docking failed: ' + e)
     qvinaw_docking_results = qvinaw_folder / (Path(split_file).stem +
                                               '_qvinaw.sdf')
-    # Process the docked poses
-    results_pdbqt_files = list(results_path.glob('*.pdbqt'))
     try:
-        for file in results_pdbqt_files:
-            with open(file, 'r') as f:
-                lines = f.readlines()
-            models = []
-            current_model = []
-            for line in lines:
-                current_model.append(line)
-                if line.startswith('ENDMDL'):
-                    models.append(current_model)
-                    current_model = []
-            for i, model in enumerate(models):
-                for line in model:
-                    if line.startswith('MODEL'):
-                        model_number = int(line.split()[-1])
-                        break
-                output_filename = file.with_name(
-                    f"{file.stem}_QVINAW_{model_number}.pdbqt")
-                with open(output_filename, 'w') as output_file:
-                    output_file.writelines(model)
-            os.remove(file)
-        qvinaw_poses = pd.DataFrame(
-            columns=['Pose ID', 'Molecule', 'QVINAW_Affinity'])
-        for pose_file in results_path.glob('*.pdbqt'):
-            pdbqt_mol = PDBQTMolecule.from_file(pose_file,
-                                                name=pose_file.stem,
-                                                skip_typing=True)
-            rdkit_mol = RDKitMolCreate.from_pdbqt_mol(pdbqt_mol)
-            # Extracting QVINAW_Affinity from the file
-            with open(pose_file) as file:
-                affinity = next(line.split()[3] for line in file
-                                if 'REMARK VINA RESULT:' in line)
-            # Use loc to append a new row to the DataFrame
-            qvinaw_poses.loc[qvinaw_poses.shape[0]] = {
-                'Pose ID': pose_file.stem,
-                'Molecule': rdkit_mol[0],
-                'QVINAW_Affinity': affinity,
-                'ID': pose_file.stem.split('_')[0]
-            }
-        PandasTools.WriteSDF(qvinaw_poses,
-                             str(qvinaw_docking_results),
-                             molColName='Molecule',
-                             idName='Pose ID',
-                             properties=list(qvinaw_poses.columns))
+        write_vina_poses(results_path, 'QVINAW', qvinaw_docking_results)
     except Exception as e:
         printlog('ERROR: Failed to combine QVINAW SDF file!')
         printlog(e)
@@ -883,27 +860,18 @@ def qvina2_docking_splitted(split_file: Path, w_dir: Path,
 
     # Create necessary folders for docking results
     qvina2_folder = w_dir / 'qvina2'
-    pdbqt_files_folder = qvina2_folder / Path(split_file).stem / 'pdbqt_files'
-    pdbqt_files_folder.mkdir(parents=True, exist_ok=True)
     results_path = qvina2_folder / Path(split_file).stem / 'docked'
     results_path.mkdir(parents=True, exist_ok=True)
 
-    try:
-        # Convert ligands from split file to pdbqt format
-        convert_molecules(split_file, str(pdbqt_files_folder), 'sdf', 'pdbqt')
-    except Exception as e:
-        print('Failed to convert sdf file to .pdbqt')
-        print(e)
-
-    # Get a list of pdbqt files
-    pdbqt_files = list(pdbqt_files_folder.glob('*.pdbqt'))
+    # Prepared ligands are shared with the other docking programs through the ligand cache
+    pdbqt_files = get_cached_ligands(split_file, ligand_cache_folder(w_dir), 'pdbqt')
 
-    for pdbqt_file in pdbqt_files:
+    for ligand_name, pdbqt_file in pdbqt_files:
         # Prepare the command to run QVina2
         qvina_cmd = (
             f"{software / 'qvina2.1'}" + f" --receptor {protein_file_pdbqt}" +
             f" --ligand {pdbqt_file}" +
-            f" --out {str(pdbqt_file).replace('pdbqt_files', 'docked')}" +
+            f" --out {results_path / f'{ligand_name}.pdbqt'}" +
             f" --center_x {pocket_definition['center'][0]}" +
             f" --center_y {pocket_definition['center'][1]}" +
             f" --center_z {pocket_definition['center'][2]}" +
@@ -924,48 +892,8 @@ def qvina2_docking_splitted(split_file: Path, w_dir: Path,
         except Exception as e:
             printlog('QVINA2 docking failed: ' + e)
     qvina2_docking_results = qvina2_folder / (Path(split_file).stem + '_qvina2.sdf')
-    # Process QVINA results
-    results_pdbqt_files = list(results_path.glob('*.pdbqt'))
     try:
-        # Split PDBQT files by model
-        for file in results_pdbqt_files:
-            with open(file, 'r') as f:
-                lines = f.readlines()
-            models = []
-            current_model = []
-            for line in lines:
-                current_model.append(line)
-                if line.startswith('ENDMDL'):
-                    models.append(current_model)
-                    current_model = []
-            for i, model in enumerate(models):
-                for line in model:
-                    if line.startswith('MODEL'):
-                        model_number = int(line.split()[-1])
-                        break
-                output_filename = file.with_name(f"{file.stem}_QVINA2_{model_number}.pdbqt")
-                with open(output_filename, 'w') as output_file:
-                    output_file.writelines(model)
-            os.remove(file)
-            qvina2_poses = pd.DataFrame(columns=['Pose ID', 'Molecule', 'QVINA2_Affinity'])
-        for pose_file in results_path.glob('*.pdbqt'):
-            pdbqt_mol = PDBQTMolecule.from_file(pose_file, name=pose_file.stem, skip_typing=True)
-            rdkit_mol = RDKitMolCreate.from_pdbqt_mol(pdbqt_mol)
-            # Extracting QVINAW_Affinity from the file
-            with open(pose_file) as file:
-                affinity = next(line.split()[3] for line in file if 'REMARK VINA RESULT:' in line)
-            # Use loc to append a new row to the DataFrame
-            qvina2_poses.loc[qvina2_poses.shape[0]] = {
-                'Pose ID': pose_file.stem,
-                'Molecule': rdkit_mol[0],
-                'QVINA2_Affinity': affinity,
-                'ID': pose_file.stem.split('_')[0]
-            }
-            PandasTools.WriteSDF(qvina2_poses,
-                            str(qvina2_docking_results),
-                            molColName='Molecule',
-                            idName='Pose ID',
-                            properties=list(qvina2_poses.columns))
+        write_vina_poses(results_path, 'QVINA2', qvina2_docking_results)
     except Exception as e:
         printlog('ERROR: Failed to combine QVINA2 SDF file!')
         printlog(e)
@@ -974,7 +902,250 @@ def qvina2_docking_splitted(split_file: Path, w_dir: Path,
     return qvina2_docking_results
 
 DOCKING_PROGRAMS = ['PLANTS', 'SMINA', 'GNINA', 'QVINA2', 'QVINAW']
-def docking(w_dir : str or Path, protein_file : str or Path, pocket_definition: Dict[str, list], software : str or Path, docking_programs : list, exhaustiveness : int, n_poses : int, ncpus : int, job_manager='concurrent_process'):
+def format_pose_records(poses: pd.DataFrame, properties: list) -> str:
+    """
+    Builds the SDF text of docked poses from their original records, using the 'Pose ID' as title and appending the given columns as SDF properties.
+
+    Args:
+        poses (pd.DataFrame): The poses, with 'record', 'Pose ID' and the property columns.
+        properties (list): The columns to append as SDF properties.
+
+    Returns:
+        str: The SDF text of the poses.
+    """
+    records = []
+    for row in poses[['record', 'Pose ID'] + properties].itertuples(index=False):
+        body = row[0].split('\n', 1)[1]
+        body = body[:body.rindex('$$$$')]
+        fields = ''.join(f'>  <{name}>\n{value}\n\n' for name, value in zip(properties, row[2:]))
+        records.append(f'{row[1]}\n{body}{fields}$$$$\n')
+    return ''.join(records)
+
+
+def harvest_docking_results(results_file: Path, program: str, renamed_properties: dict) -> str:
+    """
+    Harvests the poses of a docked split file (SMINA, GNINA), where poses of each ligand are written in rank order.
+
+    Args:
+        results_file (Path): The path to the docking results SDF file.
+        program (str): The name of the docking program, used in the Pose IDs.
+        renamed_properties (dict): SDF properties to rename (e.g. minimizedAffinity to SMINA_Affinity).
+
+    Returns:
+        str: The SDF text of the poses, titled with their Pose ID.
+    """
+    poses = pd.DataFrame(list(iter_sdf_records(results_file)), columns=['ID', 'record'])
+    if poses.empty:
+        return ''
+    poses['Pose ID'] = poses['ID'] + f'_{program}_' + (poses.groupby('ID', sort=False).cumcount() + 1).astype(str)
+    text = format_pose_records(poses, ['ID'])
+    for old_name, new_name in renamed_properties.items():
+        text = text.replace(f'<{old_name}>', f'<{new_name}>')
+    return text
+
+
+def harvest_plants_results(results_folder: Path) -> str:
+    """
+    Harvests the poses of a PLANTS results folder: converts docked_ligands.mol2 to SDF and adds the CHEMPLP scores from ranking.csv.
+    Poses of each ligand are numbered by increasing CHEMPLP score.
+
+    Args:
+        results_folder (Path): The path to the PLANTS results folder of a split file.
+
+    Returns:
+        str: The SDF text of the poses, titled with their Pose ID.
+    """
+    docked_ligands = results_folder / 'docked_ligands.mol2'
+    if not docked_ligands.is_file():
+        return ''
+    convert_molecules(docked_ligands, docked_ligands.with_suffix('.sdf'), 'mol2', 'sdf')
+    scores = pd.read_csv(results_folder / 'ranking.csv').set_index('LIGAND_ENTRY')['TOTAL_SCORE']
+    poses = pd.DataFrame(list(iter_sdf_records(docked_ligands.with_suffix('.sdf'))), columns=['LIGAND_ENTRY', 'record'])
+    poses['CHEMPLP'] = poses['LIGAND_ENTRY'].map(scores)
+    poses = poses.dropna(subset=['CHEMPLP'])
+    poses['ID'] = poses['LIGAND_ENTRY'].str.split('_').str[0]
+    poses = poses.sort_values(['ID', 'CHEMPLP'], kind='stable')
+    poses['Pose ID'] = poses['ID'] + '_PLANTS_' + (poses.groupby('ID', sort=False).cumcount() + 1).astype(str)
+    return format_pose_records(poses, ['ID', 'CHEMPLP'])
+
+
+def dock_shard(task: tuple, w_dir: Path, protein_file: Path, protein_file_pdbqt: Path, pocket_definition: Dict[str, list],
+               software: Path, exhaustiveness: int, n_poses: int) -> tuple:
+    """
+    Docks a split file with one docking program and harvests its poses, so that harvesting runs in the same worker slot as docking.
+
+    Args:
+        task (tuple): The docking program and the split file to dock.
+        The other arguments are those of the *_docking_splitted functions (protein_file_pdbqt is only used by QVINAW and QVINA2).
+
+    Returns:
+        tuple: The docking program, the split file, the SDF text of the poses titled with their Pose ID, the docking time and the harvesting time (in seconds),
+        the CPU time (including the docking program) and the number of compounds of the split file.
+    """
+    program, split_file = task
+    tic = time.perf_counter()
+    cpu_tic = cpu_seconds()
+    if program == 'PLANTS':
+        plants_docking_splitted(split_file, w_dir, n_poses, pocket_definition, software)
+    elif program == 'SMINA':
+        smina_docking_splitted(split_file, w_dir, protein_file, pocket_definition, software, exhaustiveness, n_poses)
+    elif program == 'GNINA':
+        gnina_docking_splitted(split_file, w_dir, protein_file, pocket_definition, software, exhaustiveness, n_poses)
+    elif program == 'QVINAW':
+        qvinaw_docking_splitted(split_file, w_dir, protein_file_pdbqt, pocket_definition, software, exhaustiveness, n_poses)
+    elif program == 'QVINA2':
+        qvina2_docking_splitted(split_file, w_dir, protein_file_pdbqt, pocket_definition, software, exhaustiveness, n_poses)
+    docked = time.perf_counter()
+    try:
+        if program == 'PLANTS':
+            text = harvest_plants_results(w_dir / 'plants' / f'results_{split_file.stem}')
+        elif program == 'SMINA':
+            text = harvest_docking_results(w_dir / 'smina' / f'{split_file.stem}_smina.sdf', 'SMINA', {'minimizedAffinity': 'SMINA_Affinity'})
+        elif program == 'GNINA':
+            text = harvest_docking_results(w_dir / 'gnina' / f'{split_file.stem}_gnina.sdf', 'GNINA',
+                                           {'minimizedAffinity': 'GNINA_Affinity', 'CNNscore': 'CNN-Score', 'CNNaffinity': 'CNN-Affinity'})
+        else:
+            # QVINAW and QVINA2 results are already titled with their Pose ID
+            results_file = w_dir / program.lower() / f'{split_file.stem}_{program.lower()}.sdf'
+            text = results_file.read_text() if results_file.is_file() else ''
+    except Exception as e:
+        printlog(f'ERROR: Failed to fetch {program} docking poses for {split_file.stem}!')
+        printlog(e)
+        text = ''
+    else:
+        # The raw results of the shard are no longer needed once harvested
+        if program == 'PLANTS':
+            shutil.rmtree(w_dir / 'plants' / f'results_{split_file.stem}', ignore_errors=True)
+        else:
+            (w_dir / program.lower() / f'{split_file.stem}_{program.lower()}.sdf').unlink(missing_ok=True)
+    cpu_time = cpu_seconds() - cpu_tic
+    n_compounds = count_records(split_file)
+    record('shard', program, time.perf_counter() - tic, cpu_time, n_compounds, failures=int(not text), shard=split_file.stem,
+           docking_s=round(docked - tic, 4), harvest_s=round(time.perf_counter() - docked, 4))
+    return program, split_file, text, docked - tic, time.perf_counter() - docked, cpu_time, n_compounds
+
+
+def estimate_makespan(durations: list, ncpus: int) -> float:
+    """
+    Estimates the wall time of running tasks of the given durations, in order, on ncpus worker slots.
+    """
+    slots = [0.0] * ncpus
+    for duration in durations:
+        heapq.heapreplace(slots, slots[0] + duration)
+    return max(slots)
+
+
+def dock_shards(w_dir: Path, protein_file: Path, pocket_definition: Dict[str, list], software: Path, programs: list,
+                exhaustiveness: int, n_poses: int, ncpus: int, job_manager: str, on_shard_docked=None):
+    """
+    Docks the split library with several docking programs on one pool. The (program, split file) tasks are queued program after program, so the
+    last shards of a program overlap with the first shards of the next one, and the poses of each shard are harvested by the worker that docked it.
+    With on_shard_docked, the tasks are queued split file after split file instead, so that each shard is complete as early as possible.
+    The poses file of each program is written as soon as all its shards are done.
+
+    Args:
+        w_dir (Path): The working directory.
+        protein_file (Path): The path to the protein file.
+        pocket_definition (Dict[str, list]): The pocket center and size.
+        software (Path): The path to the software folder.
+        programs (list): The docking programs to run.
+        exhaustiveness (int): The exhaustiveness of the docking programs.
+        n_poses (int): The number of poses to generate for each ligand.
+        ncpus (int): The number of CPUs to use.
+        job_manager (str): The parallel_executor backend.
+        on_shard_docked (function): Optional function called as on_shard_docked(split_file, poses) once all programs have docked a split file,
+            where poses is the SDF text of the split file's poses from all programs.
+    """
+    tic = time.perf_counter()
+    split_files_sdfs = prepare_docking_inputs(w_dir, programs, ncpus)
+    for program in programs:
+        # Remove the results of an interrupted run
+        shutil.rmtree(w_dir / program.lower(), ignore_errors=True)
+        (w_dir / program.lower()).mkdir(parents=True, exist_ok=True)
+    if 'PLANTS' in programs:
+        # Receptor in .mol2 format, converted once per receptor
+        shutil.copyfile(get_receptor_artifact(protein_file, 'mol2'), w_dir / 'plants' / 'protein.mol2')
+    protein_file_pdbqt = None
+    if 'QVINAW' in programs or 'QVINA2' in programs:
+        protein_file_pdbqt = get_receptor_artifact(str(protein_file).replace('.pdb', '_pocket.pdb'), 'pdbqt')
+    outfiles = {program: open(w_dir / program.lower() / f'{program.lower()}_poses.sdf', 'w') for program in programs}
+    remaining = {program: len(split_files_sdfs) for program in programs}
+    durations = {program: [] for program in programs}
+    started = {program: tic for program in programs}
+    shard_poses = {}
+    totals = {program: {'cpu': 0.0, 'compounds': 0, 'failures': 0} for program in programs}
+
+    def shard_done(result):
+        program, split_file, text, docking_time, harvest_time, cpu_time, n_compounds = result
+        outfiles[program].write(text)
+        totals[program]['cpu'] += cpu_time
+        totals[program]['compounds'] += n_compounds
+        totals[program]['failures'] += int(not text)
+        if on_shard_docked is not None:
+            shard_poses.setdefault(split_file, []).append(text)
+            if len(shard_poses[split_file]) == len(programs):
+                on_shard_docked(split_file, ''.join(shard_poses.pop(split_file)))
+        durations[program].append(docking_time + harvest_time)
+        remaining[program] -= 1
+        if remaining[program] == 0:
+            outfiles[program].close()
+            if program == 'PLANTS':
+                for file in Path(software).glob('*.pid'):
+                    file.unlink()
+            # Keep the raw results of the shards without poses (dock_shard keeps them when harvesting fails)
+            if not totals[program]['failures']:
+                delete_files(w_dir / program.lower(), f'{program.lower()}_poses.sdf')
+            record('program', program, time.perf_counter() - started[program], totals[program]['cpu'], totals[program]['compounds'], totals[program]['failures'])
+            printlog(f'Docking with {program} complete in {time.perf_counter() - started[program]:0.4f}!')
+
+    if on_shard_docked is None:
+        tasks = [(program, split_file) for program in programs for split_file in split_files_sdfs]
+    else:
+        # Queue the programs of each split file together, so that the first shards are handed over while the others are docking
+        tasks = [(program, split_file) for split_file in split_files_sdfs for program in programs]
+    try:
+        parallel_executor(dock_shard, tasks, ncpus, job_manager, on_result=shard_done, w_dir=w_dir, protein_file=protein_file,
+                          protein_file_pdbqt=protein_file_pdbqt, pocket_definition=pocket_definition, software=software,
+                          exhaustiveness=exhaustiveness, n_poses=n_poses)
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
+    toc = time.perf_counter()
+    if len(programs) > 1:
+        # Wall time the programs would take one after another: each program's shards on ncpus slots, its tail and harvest not overlapped
+        sequential = sum(estimate_makespan(program_durations, ncpus) for program_durations in durations.values())
+        printlog(f'Docking with {", ".join(programs)} complete in {toc - tic:0.4f} (estimated {sequential:0.4f} one program after another, '
+                 f'{100 * (1 - (toc - tic) / sequential) if sequential else 0:0.1f}% wall time reduction)')
+    else:
+        printlog(f'Docking complete in {toc - tic:0.4f}!')
+
+
+def prepare_docking_inputs(w_dir : Path, docking_programs : list, ncpus : int) -> list:
+    """
+    Splits the final library for parallel docking and prepares the ligand files needed by the docking programs that have not run yet.
+    Both steps are skipped if already done.
+
+    Returns:
+    list: The paths to the split SDF files.
+    """
+    split_final_library_path = w_dir / 'split_final_library'
+    if not split_final_library_path.is_dir():
+        split_files_folder = split_sdf_str(str(w_dir), str(w_dir / 'final_library.sdf'), ncpus)
+    else:
+        printlog('Split final library folder already exists...')
+        split_files_folder = split_final_library_path
+    split_files_sdfs = [(split_files_folder / f) for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
+    # Prepare the ligand files needed by the docking programs once, in parallel
+    ligand_formats = []
+    if any(program in docking_programs and not (w_dir / program.lower()).is_dir() for program in ['QVINAW', 'QVINA2']):
+        ligand_formats.append('pdbqt')
+    if 'PLANTS' in docking_programs and not (w_dir / 'plants').is_dir():
+        ligand_formats.append('mol2')
+    if ligand_formats:
+        prepare_ligand_cache(w_dir / 'final_library.sdf', ligand_cache_folder(w_dir), ligand_formats, ncpus)
+    return split_files_sdfs
+
+def docking(w_dir : str or Path, protein_file : str or Path, pocket_definition: Dict[str, list], software : str or Path, docking_programs : list, exhaustiveness : int, n_poses : int, ncpus : int, job_manager='concurrent_process', on_shard_docked=None):
     """
     Dock ligands into a protein binding site using one or more docking programs.
 
@@ -996,334 +1167,117 @@ def docking(w_dir : str or Path, protein_file : str or Path, pocket_definition:
         Number of poses to generate for each ligand.
     ncpus : int
         Number of CPUs to use for parallel execution.
+    job_manager : str
+        The parallel_executor backend used for the docking tasks.
+    on_shard_docked : function
+        Optional function called with each split file and its poses once all programs have docked it (see dock_shards).
 
     Returns:
     --------
     None
     """
     RDLogger.DisableLog('rdApp.*')
+    # Programs are (re)run unless their poses file was written, a folder without it is left by an interrupted run
+    programs = [program for program in ['PLANTS', 'SMINA', 'GNINA', 'QVINAW', 'QVINA2']
+                if program in docking_programs and not (w_dir / program.lower() / f'{program.lower()}_poses.sdf').is_file()]
     if ncpus == 1:
         tic = time.perf_counter()
-        if 'SMINA' in docking_programs and not (w_dir / 'smina').is_dir():
+        for program in programs:
+            shutil.rmtree(w_dir / program.lower(), ignore_errors=True)
+        if 'SMINA' in programs:
             smina_docking(w_dir, protein_file, pocket_definition, software,  exhaustiveness, n_poses)
-        if 'GNINA' in docking_programs and not (w_dir / 'gnina').is_dir():
+        if 'GNINA' in programs:
             gnina_docking(w_dir, protein_file, pocket_definition, software,  exhaustiveness, n_poses)
-        if 'PLANTS' in docking_programs and not (w_dir / 'plants').is_dir():
+        if 'PLANTS' in programs:
             plants_docking(w_dir, protein_file, pocket_definition, software, n_poses)
-        if 'QVINAW' in docking_programs and not (w_dir / 'qvinaw').is_dir():
+        if 'QVINAW' in programs:
             qvinaw_docking(w_dir, protein_file, pocket_definition, software,  exhaustiveness, n_poses)
-        if 'QVINA2' in docking_programs and not (w_dir / 'qvina2').is_dir():
+        if 'QVINA2' in programs:
             qvina2_docking(w_dir, protein_file, pocket_definition, software,  exhaustiveness, n_poses)
         toc = time.perf_counter()
         printlog(f'Finished docking in {toc-tic:0.4f}!')
 
-    else:
-        split_final_library_path = w_dir / 'split_final_library'
-        if not split_final_library_path.is_dir():
-            split_files_folder = split_sdf_str(str(w_dir), str(w_dir / 'final_library.sdf'), ncpus)
-        else:
-            printlog('Split final library folder already exists...')
-            split_files_folder = split_final_library_path
-        split_files_sdfs = [(split_files_folder / f) for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
-        # Docking split files using PLANTS
-        if 'PLANTS' in docking_programs and not (w_dir / 'plants').is_dir():
-            tic = time.perf_counter()
-            plants_folder = w_dir / 'plants'
-            plants_folder.mkdir(parents=True, exist_ok=True)
-            # Convert protein file to .mol2 using open babel
-            plants_protein_mol2 = plants_folder / 'protein.mol2'
-            convert_molecules(protein_file, plants_protein_mol2, 'pdb', 'mol2')
-            # Convert prepared ligand file to .mol2 using open babel
-            for file_path in split_files_folder.iterdir():
-                if file_path.suffix == '.sdf':
-                    convert_molecules(file_path, file_path.with_suffix('.mol2'), 'sdf', 'mol2')
-
-            parallel_executor(plants_docking_splitted, split_files_sdfs, ncpus, job_manager, w_dir=w_dir, n_poses=n_poses, pocket_definition=pocket_definition, software=software)
-            toc = time.perf_counter()
-            printlog(f'Docking with PLANTS complete in {toc - tic:0.4f}!')
-        # Fetch PLANTS poses
-        if 'PLANTS' in docking_programs and (w_dir / 'plants').is_dir() and not (w_dir / 'plants' / 'plants_poses.sdf').is_file():
-            plants_dataframes = []
-            results_folders = [item for item in os.listdir(w_dir / 'plants')]
-            for item in tqdm(results_folders, desc='Fetching PLANTS docking poses'):
-                if item.startswith('results'):
-                    file_path = w_dir / 'plants' / item / 'docked_ligands.mol2'
-                    if file_path.is_file():
-                        try:
-                            convert_molecules(file_path, file_path.with_suffix('.sdf'),'mol2','sdf')
-                            plants_poses = PandasTools.LoadSDF(str(file_path.with_suffix('.sdf')),
-                                                                idName='ID',
-                                                                molColName='Molecule',
-                                                                includeFingerprints=False,
-                                                                embedProps=False,
-                                                                removeHs=False,
-                                                                strictParsing=True)
-                            plants_scores = pd.read_csv(str(file_path).replace('docked_ligands.mol2', 'ranking.csv')).rename(columns={'LIGAND_ENTRY': 'ID', 'TOTAL_SCORE': 'CHEMPLP'})[['ID', 'CHEMPLP']]
-                            plants_df = pd.merge(plants_scores, plants_poses, on='ID')
-                            plants_df['ID'] = plants_df['ID'].str.split('_').str[0]
-                            list_ = [*range(1, int(n_poses) + 1, 1)]
-                            ser = list_ * (len(plants_df) // len(list_))
-                            plants_df['Pose ID'] = [f'{row["ID"]}_PLANTS_{num}' for num, (_, row) in zip(ser + list_[:len(plants_df) - len(ser)], plants_df.iterrows())]
-                            plants_dataframes.append(plants_df)
-                        except Exception as e:
-                            printlog(
-                                'ERROR: Failed to convert PLANTS docking results file to .sdf!')
-                            printlog(e)
-                else:
-                    Path(w_dir / 'plants', item).unlink(missing_ok=True)
-            try:
-                plants_df = pd.concat(plants_dataframes)
-                PandasTools.WriteSDF(plants_df,
-                                     str(w_dir / 'plants' / 'plants_poses.sdf'),
-                                     molColName='Molecule',
-                                     idName='Pose ID',
-                                     properties=list(plants_df.columns))
-                files = Path(software).glob('*.pid')
-                for file in files:
-                    file.unlink()
-            except Exception as e:
-                printlog('ERROR: Failed to write combined PLANTS docking poses')
-                printlog(e)
-            else:
-                delete_files(w_dir / 'plants', 'plants_poses.sdf')
-        # Docking split files using SMINA
-        if 'SMINA' in docking_programs and not (w_dir / 'smina').is_dir():
-            printlog('Docking split files using SMINA...')
-            tic = time.perf_counter()
-
-
-            parallel_executor(smina_docking_splitted, split_files_sdfs, ncpus, job_manager, w_dir = w_dir, protein_file=protein_file, pocket_definition = pocket_definition, software = software, exhaustiveness = exhaustiveness, n_poses = n_poses)
-
-            toc = time.perf_counter()
-            printlog(f'Docking with SMINA complete in {toc - tic:0.4f}!')
-        # Fetch SMINA poses
-        if 'SMINA' in docking_programs and (w_dir / 'smina').is_dir() and not (w_dir / 'smina' / 'smina_poses.sdf').is_file():
-            try:
-                smina_dataframes = []
-                for file in tqdm(os.listdir(w_dir / 'smina'), desc='Loading SMINA poses'):
-                    if file.startswith('split'):
-                        df = PandasTools.LoadSDF(str(w_dir / 'smina' / file),
-                                                idName='ID',
-                                                molColName='Molecule',
-                                                includeFingerprints=False,
-                                                embedProps=False,
-                                                removeHs=False,
-                                                strictParsing=True)
-                        smina_dataframes.append(df)
-                smina_df = pd.concat(smina_dataframes)
-                list_ = [*range(1, int(n_poses) + 1, 1)]
-                ser = list_ * (len(smina_df) // len(list_))
-                smina_df['Pose ID'] = [f'{row["ID"]}_SMINA_{num}' for num, (_,row) in zip(ser + list_[ :len(smina_df) - len(ser)],smina_df.iterrows())]
-                smina_df.rename(columns={'minimizedAffinity': 'SMINA_Affinity'}, inplace=True)
-            except Exception as e:
-                printlog('ERROR: Failed to Load SMINA poses SDF file!')
-                printlog(e)
-            try:
-                PandasTools.WriteSDF(smina_df,
-                                     str(w_dir / 'smina' / 'smina_poses.sdf'),
-                                     molColName='Molecule',
-                                     idName='Pose ID',
-                                     properties=list(smina_df.columns))
-            except Exception as e:
-                printlog('ERROR: Failed to write combined SMINA poses SDF file!')
-                printlog(e)
-            else:
-                delete_files(w_dir / 'smina', 'smina_poses.sdf')
-        # Docking split files using GNINA
-        if 'GNINA' in docking_programs and not (w_dir / 'gnina').is_dir():
-            printlog('Docking split files using GNINA...')
-            tic = time.perf_counter()
-
-            parallel_executor(gnina_docking_splitted, split_files_sdfs, ncpus, job_manager, w_dir = w_dir, protein_file=protein_file, pocket_definition = pocket_definition, software = software, exhaustiveness = exhaustiveness, n_poses = n_poses)
-
-            toc = time.perf_counter()
-            printlog(f'Docking with GNINA complete in {toc - tic:0.4f}!')
-        # Fetch GNINA poses
-        if 'GNINA' in docking_programs and (w_dir / 'gnina').is_dir() and not (w_dir / 'gnina' / 'gnina_poses.sdf').is_file():
-            try:
-                gnina_dataframes = []
-                for file in tqdm(os.listdir(w_dir / 'gnina'), desc='Loading GNINA poses'):
-                    if file.startswith('split'):
-                        df = PandasTools.LoadSDF(str(w_dir / 'gnina' / file),
-                                                idName='ID',
-                                                molColName='Molecule',
-                                                includeFingerprints=False,
-                                                embedProps=False,
-                                                removeHs=False,
-                                                strictParsing=True)
-                        gnina_dataframes.append(df)
-                gnina_df = pd.concat(gnina_dataframes)
-                list_ = [*range(1, int(n_poses) + 1, 1)]
-                ser = list_ * (len(gnina_df) // len(list_))
-                gnina_df['Pose ID'] = [f'{row["ID"]}_GNINA_{num}' for num, (_, row) in zip( ser + list_[ :len(gnina_df) - len(ser)], gnina_df.iterrows())]
-                gnina_df.rename(columns={'minimizedAffinity': 'GNINA_Affinity', 'CNNscore':'CNN-Score', 'CNNaffinity':'CNN-Affinity'}, inplace=True)
-            except Exception as e:
-                printlog('ERROR: Failed to Load GNINA poses SDF file!')
-                printlog(e)
-            try:
-                PandasTools.WriteSDF(gnina_df,
-                                     str(w_dir / 'gnina' / 'gnina_poses.sdf'),
-                                     molColName='Molecule',
-                                     idName='Pose ID',
-                                     properties=list(gnina_df.columns))
-            except Exception as e:
-                printlog('ERROR: Failed to write combined GNINA docking poses')
-                printlog(e)
-            else:
-                delete_files(w_dir / 'gnina', 'gnina_poses.sdf')
-        # Docking split files using QVINAW
-        if 'QVINAW' in docking_programs and not (w_dir / 'qvinaw').is_dir():
-            printlog('Docking split files using QVINAW...')
-            tic = time.perf_counter()
-            protein_file_pdbqt = convert_molecules(str(protein_file).replace('.pdb', '_pocket.pdb'), str(protein_file).replace('.pdb', '_pocket.pdbqt'), 'pdb', 'pdbqt')
-
-            parallel_executor(qvinaw_docking_splitted, split_files_sdfs, ncpus, job_manager, w_dir = w_dir, protein_file_pdbqt=protein_file_pdbqt, pocket_definition = pocket_definition, software = software, exhaustiveness = exhaustiveness, n_poses = n_poses)
-
-            toc = time.perf_counter()
-            printlog(f'Docking with QVINAW complete in {toc - tic:0.4f}!')
-        # Fetch QVINAW poses
-        if 'QVINAW' in docking_programs and (w_dir / 'qvinaw').is_dir() and not (w_dir / 'qvinaw' / 'qvinaw_poses.sdf').is_file():
-            try:
-                qvinaw_dataframes = []
-                for file in tqdm(os.listdir(w_dir / 'qvinaw'), desc='Loading QVINAW poses'):
-                    if file.startswith('split') and file.endswith('.sdf'):
-                        df = PandasTools.LoadSDF(str(w_dir / 'qvinaw' / file),
-                                                idName='Pose ID',
-                                                molColName='Molecule',
-                                                includeFingerprints=False,
-                                                embedProps=False,
-                                                removeHs=False,
-                                                strictParsing=True)
-                        qvinaw_dataframes.append(df)
-                qvinaw_df = pd.concat(qvinaw_dataframes)
-            except Exception as e:
-                printlog('ERROR: Failed to Load QVINAW poses SDF file!')
-                printlog(e)
-            try:
-                PandasTools.WriteSDF(qvinaw_df,
-                                     str(w_dir / 'qvinaw' / 'qvinaw_poses.sdf'),
-                                     molColName='Molecule',
-                                     idName='Pose ID',
-                                     properties=list(qvinaw_df.columns))
-            except Exception as e:
-                printlog('ERROR: Failed to write combined QVINAW poses SDF file!')
-                printlog(e)
-            else:
-                delete_files(w_dir / 'qvinaw', 'qvinaw_poses.sdf')
-        # Docking split files using QVINA2
-        if 'QVINA2' in docking_programs and not (w_dir / 'qvina2').is_dir():
-            printlog('Docking split files using QVINA2...')
-            tic = time.perf_counter()
-            protein_file_pdbqt = convert_molecules(str(protein_file).replace('.pdb', '_pocket.pdb'), str(protein_file).replace('.pdb', '_pocket.pdbqt'), 'pdb', 'pdbqt')
-
-            parallel_executor(qvina2_docking_splitted, split_files_sdfs, ncpus, job_manager, w_dir = w_dir, protein_file_pdbqt=protein_file_pdbqt, pocket_definition = pocket_definition, software = software, exhaustiveness = exhaustiveness, n_poses = n_poses)
-
-            toc = time.perf_counter()
-            printlog(f'Docking with QVINA2 complete in {toc - tic:0.4f}!')
-        # Fetch QVINA2 poses
-        if 'QVINA2' in docking_programs and (w_dir / 'qvina2').is_dir() and not (w_dir / 'qvina2' / 'qvina2_poses.sdf').is_file():
-            try:
-                qvina2_dataframes = []
-                for file in tqdm(os.listdir(w_dir / 'qvina2'), desc='Loading QVINA2 poses'):
-                    if file.startswith('split') and file.endswith('.sdf'):
-                        df = PandasTools.LoadSDF(str(w_dir / 'qvina2' / file),
-                                                idName='Pose ID',
-                                                molColName='Molecule',
-                                                includeFingerprints=False,
-                                                embedProps=False,
-                                                removeHs=False,
-                                                strictParsing=True)
-                        qvina2_dataframes.append(df)
-                qvina2_df = pd.concat(qvina2_dataframes)
-            except Exception as e:
-                printlog('ERROR: Failed to Load QVINA2 poses SDF file!')
-                printlog(e)
-            try:
-                PandasTools.WriteSDF(qvina2_df,
-                                     str(w_dir / 'qvina2' / 'qvina2_poses.sdf'),
-                                     molColName='Molecule',
-                                     idName='Pose ID',
-                                     properties=list(qvina2_df.columns))
-            except Exception as e:
-                printlog('ERROR: Failed to write combined QVINA2 poses SDF file!')
-                printlog(e)
-            else:
-                delete_files(w_dir / 'qvina2', 'qvina2_poses.sdf')
+    elif programs:
+        dock_shards(w_dir, protein_file, pocket_definition, software, programs, exhaustiveness, n_poses, ncpus, job_manager, on_shard_docked)
     shutil.rmtree(w_dir / 'split_final_library', ignore_errors=True)
     return
 
-def concat_all_poses(w_dir : Path, docking_programs : list, protein_file : Path, ncpus : int, bust_poses : bool):
+def read_poses(sdf : Path, ncpus : int) -> pd.DataFrame:
     """
-    Concatenates all poses from the specified docking programs and checks them for quality using PoseBusters.
-    
+    Reads an SDF file of poses into a table with 'Pose ID', 'Molecule' and the SDF properties as columns.
+    """
+    data = []
+    for mol in Chem.MultithreadedSDMolSupplier(str(sdf), numWriterThreads=ncpus, removeHs=False, strictParsing=True):
+        if mol is None:
+            continue
+        mol_props = {'Pose ID': mol.GetProp('_Name')}
+        for prop in mol.GetPropNames():
+            mol_props[prop] = mol.GetProp(prop)
+        mol_props['Molecule'] = mol
+        data.append(mol_props)
+    return pd.DataFrame(data) if data else pd.DataFrame(columns=['Pose ID', 'Molecule'])
+
+def load_poses(allposes_file : Path, protein_file : Path, ncpus : int, bust_poses : bool) -> pd.DataFrame:
+    """
+    Builds the poses table used for pose selection from a combined pose file, optionally removing the poses failing the PoseBusters checks
+    from both the table and the file.
+
     Args:
-    w_dir (str): Working directory where the docking program output files are located.
-    docking_programs (list): List of strings specifying the names of the docking programs used.
-    protein_file (str): Path to the protein file used for docking.
-    
+    allposes_file (Path): Path to the combined pose file.
+    protein_file (Path): Path to the protein file used for docking.
+    ncpus (int): Number of CPUs to use.
+    bust_poses (bool): Whether to remove problematic poses with PoseBusters.
+
     Returns:
-    None
+    pd.DataFrame: The poses, with 'Pose ID', 'Molecule' (without explicit hydrogens) and the SDF properties as columns.
     """
-    # Create an empty DataFrame to store all poses
-    all_poses = pd.DataFrame()
-    for program in docking_programs:
-        try:
-            # Load the poses from the SDF file of the current docking program
-            mols = [m for m in Chem.MultithreadedSDMolSupplier((f"{w_dir}/{program.lower()}/{program.lower()}_poses.sdf"),
-                                                            numWriterThreads=ncpus,
-                                                            removeHs=False,
-                                                            strictParsing=True) if m is not None]
-            data = []
-            # Iterate over each molecule
-            for mol in mols:
-                # Get the properties of the molecule
-                mol_props = {'Pose ID': mol.GetProp('_Name')}
-                for prop in mol.GetPropNames():
-                    mol_props[prop] = mol.GetProp(prop)
-                    mol_props['Molecule'] = mol
-                # Append the properties to the list
-                data.append(mol_props)
-            # Create a DataFrame from the list of dictionaries
-            df = pd.DataFrame(data)
-            all_poses = pd.concat([all_poses, df])
-        except Exception:
-            printlog(f'ERROR: Failed to load {program} SDF file!')
-            printlog(traceback.format_exc())
+    # Parse each pose once to build the poses table
+    all_poses = read_poses(allposes_file, ncpus)
     if bust_poses:
         try:
-            tic = time.perf_counter()
-            printlog("Busting poses...")
-            # Initialize PoseBusters with the configuration file
-            buster = PoseBusters(config=safe_load(open('./scripts/posebusters_config.yml')))
-            # Add the protein file path as a column in all_poses DataFrame
-            all_poses['mol_cond'] = str(protein_file)
-            # Rename the 'Molecule' column to 'mol_pred'
-            all_poses = all_poses.rename(columns={'Molecule':'mol_pred'})
-            # Check the quality of poses using PoseBusters
-            df = buster.bust_table(all_poses)
-            # Remove rows where any of the specified columns is 'False'
-            cols_to_check = ['all_atoms_connected', 'bond_lengths', 'bond_angles', 'internal_steric_clash', 'aromatic_ring_flatness', 'double_bond_flatness', 'protein-ligand_maximum_distance']
-            df = df.loc[(df[cols_to_check] is not False).all(axis=1)]
-            df.reset_index(inplace=True)
-            # Filter the all_poses DataFrame based on the valid poses identified by PoseBusters
-            all_poses = all_poses[all_poses['Pose ID'].isin(df['molecule'])].rename(columns={'mol_pred':'Molecule'})
-            toc = time.perf_counter()
-            printlog(f"PoseBusters checking completed in {toc - tic:.2f} seconds.")
+            all_poses = validate_poses(all_poses, protein_file, ncpus)
+            # Keep only the records of the valid poses in the combined file
+            valid_ids = set(all_poses['Pose ID'])
+            filtered_file = allposes_file.with_suffix('.tmp')
+            with open(filtered_file, 'w') as outfile:
+                for title, record in iter_sdf_records(allposes_file):
+                    if title in valid_ids:
+                        outfile.write(record)
+            filtered_file.replace(allposes_file)
         except Exception as e:
             printlog('ERROR: Failed to check poses with PoseBusters!')
             printlog(e)
-    else:
-        pass
-    try:
-        # Write the combined poses to an SDF file
-        PandasTools.WriteSDF(all_poses,
-                            f"{w_dir}/allposes.sdf",
-                            molColName='Molecule',
-                            idName='Pose ID',
-                            properties=list(all_poses.columns))
-        printlog('All poses succesfully checked and combined!')
-    except Exception as e:
-        printlog('ERROR: Failed to write all_poses SDF file!')
-        printlog(e)
+    # Pose selection works on molecules without explicit hydrogens
+    all_poses['Molecule'] = [Chem.RemoveHs(mol, sanitize=False) for mol in all_poses['Molecule']]
+    return all_poses
 
-    return
+def concat_all_poses(w_dir : Path, docking_programs : list, protein_file : Path, ncpus : int, bust_poses : bool) -> pd.DataFrame:
+    """
+    Concatenates all poses from the specified docking programs and checks them for quality using PoseBusters.
+    The per-program pose files are merged by copying their records, the combined file is then parsed once to build the poses table.
+
+    Args:
+    w_dir (str): Working directory where the docking program output files are located.
+    docking_programs (list): List of strings specifying the names of the docking programs used.
+    protein_file (str): Path to the protein file used for docking.
+    ncpus (int): Number of CPUs to use.
+    bust_poses (bool): Whether to remove problematic poses with PoseBusters.
+
+    Returns:
+    pd.DataFrame: The combined poses, with 'Pose ID', 'Molecule' and the SDF properties as columns.
+    """
+    tic = time.perf_counter()
+    allposes_file = Path(w_dir) / 'allposes.sdf'
+    # Copy the records of the per-program pose files into the combined file
+    with open(allposes_file, 'w') as outfile:
+        for program in docking_programs:
+            try:
+                with open(Path(w_dir) / program.lower() / f'{program.lower()}_poses.sdf', 'r') as infile:
+                    shutil.copyfileobj(infile, outfile)
+            except Exception:
+                printlog(f'ERROR: Failed to load {program} SDF file!')
+                printlog(traceback.format_exc())
+    all_poses = load_poses(allposes_file, protein_file, ncpus, bust_poses)
+    toc = time.perf_counter()
+    printlog(f'All {len(all_poses)} poses succesfully checked and combined in {toc - tic:0.4f}!')
+    return all_poses
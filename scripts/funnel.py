@@ -0,0 +1,163 @@
+import shutil
+import time
+import warnings
+from pathlib import Path
+
+import pandas as pd
+from yaml import safe_load
+
+from scripts.clustering_metrics import CLUSTERING_METRICS
+from scripts.library_preparation import normalize_id
+from scripts.utilities import iter_sdf_records, printlog, read_sdf_properties
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Settings a funnel stage can override
+STAGE_SETTINGS = ['docking_programs', 'exhaustiveness', 'nposes', 'pose_selection', 'clustering_method', 'rescoring', 'consensus', 'bust_poses']
+
+
+def load_funnel_config(config_file: Path, defaults: dict = None) -> list:
+    """
+    Reads a funnel configuration file (see scripts/funnel_config.yml) and returns the list of stages,
+    each with the default settings (the command line arguments) completed by the settings given for the stage.
+
+    Args:
+        config_file (Path): The path to the funnel configuration file.
+        defaults (dict): The settings used for the settings a stage does not give.
+
+    Returns:
+        list: The settings of each stage, with the 'keep' fraction.
+    """
+    with open(config_file) as f:
+        stages = safe_load(f)['stages']
+    defaults = {key: value for key, value in (defaults or {}).items() if key in STAGE_SETTINGS}
+    merged_stages = []
+    for i, stage in enumerate(stages):
+        unknown = [key for key in stage if key not in STAGE_SETTINGS + ['keep']]
+        if unknown:
+            raise ValueError(f'Invalid setting(s) for funnel stage {i + 1} : {", ".join(unknown)}')
+        if not 0 < stage.get('keep', 1) <= 1:
+            raise ValueError(f'Invalid keep fraction for funnel stage {i + 1} : {stage["keep"]}. Must be between 0 and 1.')
+        stage = {**defaults, **stage}
+        validate_stage(stage, i, last=i == len(stages) - 1)
+        merged_stages.append(stage)
+    return merged_stages
+
+
+def validate_stage(stage: dict, i: int, last: bool):
+    """
+    Checks that the settings of a funnel stage, completed with the default settings, can run and rank the compounds passed to the next stage.
+    """
+    if not stage.get('pose_selection'):
+        raise ValueError(f'Funnel stage {i + 1} needs a pose selection method.')
+    if not stage.get('consensus') and not last:
+        raise ValueError(f'Funnel stage {i + 1} needs a consensus method to rank the compounds passed to the next stage.')
+    if any(method in CLUSTERING_METRICS for method in stage['pose_selection']) and stage.get('clustering_method') in [None, 'None']:
+        raise ValueError(f'Funnel stage {i + 1} needs a clustering method for pose selection method(s) {", ".join(stage["pose_selection"])}.')
+    for method in stage['pose_selection']:
+        if method.startswith('bestpose_') and method.replace('bestpose_', '') not in stage.get('docking_programs', []):
+            raise ValueError(f'Funnel stage {i + 1} needs {method.replace("bestpose_", "")} in its docking programs for pose selection method {method}.')
+
+
+def read_stage_ranking(w_dir: Path, selection_method: str, consensus_method: str) -> pd.DataFrame:
+    """
+    Reads the consensus results of a stage and returns the compounds ranked by consensus score, best first.
+    The duplicates the results were fanned out to (listed in duplicate_map.csv) are left out, so that each unique compound is ranked once.
+    """
+    score_column = f'{consensus_method}_{selection_method}'
+    results_file = Path(w_dir) / 'consensus' / f'{selection_method}_{consensus_method}_results'
+    if results_file.with_suffix('.csv').is_file():
+        ranking = pd.read_csv(results_file.with_suffix('.csv'), dtype={'ID': str})
+    else:
+        ranking = read_sdf_properties(results_file.with_suffix('.sdf'), [score_column], idName='ID')
+    ranking[score_column] = pd.to_numeric(ranking[score_column], errors='coerce')
+    ranking = ranking.sort_values(score_column, ascending=False).drop_duplicates(subset='ID')
+    duplicate_map_file = Path(w_dir) / 'duplicate_map.csv'
+    if duplicate_map_file.is_file():
+        ranking = ranking[~ranking['ID'].isin(pd.read_csv(duplicate_map_file, dtype=str)['ID'])]
+    return ranking[['ID', score_column]].rename(columns={score_column: 'score'}).reset_index(drop=True)
+
+
+def read_activities(docking_library: Path) -> dict:
+    """
+    Returns the activity of each compound of the library (by normalized ID) if the library has an 'Activity' field (e.g. decoy sets), otherwise an empty dictionary.
+    """
+    library = read_sdf_properties(docking_library, ['Activity'], idName='ID')
+    if library['Activity'].isna().all():
+        return {}
+    library['ID'] = library['ID'].apply(normalize_id)
+    return dict(zip(library['ID'], pd.to_numeric(library['Activity'], errors='coerce').fillna(0).astype(int)))
+
+
+def write_stage_library(previous_w_dir: Path, w_dir: Path, ids: set) -> int:
+    """
+    Writes the prepared compounds of the previous stage with the given IDs to the final library of the next stage, so that they are not prepared again.
+
+    Returns:
+        int: The number of compounds written.
+    """
+    w_dir.mkdir(parents=True, exist_ok=True)
+    n_written = 0
+    with open(w_dir / 'final_library.sdf', 'w') as outfile:
+        for title, record in iter_sdf_records(previous_w_dir / 'final_library.sdf'):
+            if title in ids:
+                outfile.write(record)
+                n_written += 1
+    if (previous_w_dir / 'duplicate_map.csv').is_file():
+        shutil.copy(previous_w_dir / 'duplicate_map.csv', w_dir / 'duplicate_map.csv')
+    return n_written
+
+
+def run_funnel(config_file: Path, base_w_dir: Path, docking_library: Path, run_stage, defaults: dict = None) -> pd.DataFrame:
+    """
+    Runs a multi-stage funnel screen: the first stage screens the whole library, each later stage screens only the top compounds of the previous stage.
+    If the library has an 'Activity' field, the actives retained by each stage and the enrichment of each cut are reported.
+
+    Args:
+        config_file (Path): The path to the funnel configuration file.
+        base_w_dir (Path): The working directory, each stage runs in its own funnel_stage_{n} subfolder.
+        docking_library (Path): The path to the docking library.
+        run_stage (function): Function running DockM8 with the given stage settings in the given working directory, called as run_stage(settings, w_dir).
+        defaults (dict): The settings (e.g. the command line arguments) used for the settings a stage does not give.
+
+    Returns:
+        pd.DataFrame: The funnel report, one row per stage (also written to funnel_report.csv).
+    """
+    stages = load_funnel_config(config_file, defaults)
+    activities = read_activities(docking_library)
+    n_actives_total = sum(activities.values())
+    report = []
+    previous_w_dir = None
+    passed_ids = None
+    for i, stage in enumerate(stages):
+        tic = time.perf_counter()
+        w_dir = Path(base_w_dir) / f'funnel_stage_{i + 1}'
+        printlog(f'Running funnel stage {i + 1} of {len(stages)} in {w_dir}...')
+        if previous_w_dir is not None and not (w_dir / 'final_library.sdf').is_file():
+            write_stage_library(previous_w_dir, w_dir, passed_ids)
+        settings = {key: value for key, value in stage.items() if key != 'keep'}
+        run_stage(settings, w_dir)
+        ranking = read_stage_ranking(w_dir, settings['pose_selection'][0], settings['consensus']) if settings.get('consensus') else None
+        n_in = sum(1 for _ in iter_sdf_records(w_dir / 'final_library.sdf'))
+        row = {'stage': i + 1, 'docking_programs': '_'.join(settings.get('docking_programs', [])), 'rescoring': '_'.join(settings.get('rescoring', [])), 'compounds_in': n_in}
+        if ranking is not None:
+            n_keep = max(1, round(stage.get('keep', 1) * len(ranking)))
+            kept = ranking.head(n_keep)
+            passed_ids = set(kept['ID'])
+            row['compounds_out'] = len(kept)
+            if activities:
+                actives_in = sum(activities.get(compound_id, 0) for compound_id in ranking['ID'])
+                actives_out = sum(activities.get(compound_id, 0) for compound_id in kept['ID'])
+                row['actives_in'] = actives_in
+                row['actives_out'] = actives_out
+                row['actives_retained_%'] = round(100 * actives_out / n_actives_total, 2) if n_actives_total else None
+                # Enrichment of the cut: active rate among the kept compounds relative to the active rate among the stage's compounds
+                row['EF_cut'] = round((actives_out / len(kept)) / (actives_in / len(ranking)), 2) if actives_in else None
+        row['time_s'] = round(time.perf_counter() - tic, 1)
+        report.append(row)
+        printlog(f'Funnel stage {i + 1}: ' + ', '.join(f'{key} {value}' for key, value in row.items() if key != 'stage'))
+        previous_w_dir = w_dir
+    report = pd.DataFrame(report)
+    report.to_csv(Path(base_w_dir) / 'funnel_report.csv', index=False)
+    return report
@@ -1,4 +1,5 @@
 import os
+import shutil
 from pathlib import Path
 from random import randint
 
@@ -8,6 +9,7 @@ from biopandas.pdb import PandasPdb
 from rdkit import Chem
 from rdkit.Chem import Descriptors3D
 
+from scripts.artifact_cache import cached_artifact, file_hash
 from scripts.utilities import load_molecule, printlog
 
 pd.options.mode.chained_assignment = None
@@ -37,16 +39,12 @@ def get_pocket(ligand_file: Path, protein_file: Path, radius: int):
     printlog(f'Extracting pocket from {protein_file.stem} using {ligand_file.stem} as reference ligand')
     # Load the reference ligand molecule
     ligand_mol = load_molecule(str(ligand_file))
-    if not os.path.exists(str(protein_file).replace('.pdb', '_pocket.pdb')):
-        # Process the protein and ligand to extract the pocket
-        pocket_mol, temp_file = process_protein_and_ligand(str(protein_file), ligand_mol, radius)
-        pocket_path = str(protein_file).replace('.pdb', '_pocket.pdb')
-        # Convert the pocket molecule to PDB file format and save it
-        Chem.MolToPDBFile(pocket_mol, pocket_path)
-        os.remove(temp_file)
-        printlog(f'Finished extracting pocket from {protein_file.stem} using {ligand_file.stem} as reference ligand')
-    else:
-        pass
+    # The pocket is extracted once per receptor, reference ligand and radius, and copied next to the protein file
+    cached_pocket = cached_artifact([file_hash(protein_file), file_hash(ligand_file), f'pocket-radius-{radius}'],
+                                    '.pdb',
+                                    lambda output_file: write_pocket(protein_file, ligand_mol, radius, output_file))
+    shutil.copyfile(cached_pocket, str(protein_file).replace('.pdb', '_pocket.pdb'))
+    printlog(f'Finished extracting pocket from {protein_file.stem} using {ligand_file.stem} as reference ligand')
     # Calculate the center coordinates of the pocket
     ligu = get_ligand_coordinates(ligand_mol)
     center_x = ligu['x_coord'].mean().round(2)
@@ -77,16 +75,14 @@ def get_pocket_RoG(ligand_file : Path, protein_file : Path):
     # Load the reference ligand molecule and calculate its radius of gyration
     ligand_mol = load_molecule(str(ligand_file))
     radius_of_gyration = Descriptors3D.RadiusOfGyration(ligand_mol)
-    if not os.path.exists(str(protein_file).replace('.pdb', '_pocket.pdb')):
-        printlog(f'Radius of Gyration of reference ligand is: {radius_of_gyration}')
-        # Process the protein and ligand to extract the pocket
-        pocket_mol, temp_file = process_protein_and_ligand(str(protein_file), ligand_mol, round(0.5 * 2.857 * float(radius_of_gyration), 2))
-        pocket_path = str(protein_file).replace('.pdb', '_pocket.pdb')
-        Chem.MolToPDBFile(pocket_mol, pocket_path)
-        os.remove(temp_file)
-        printlog(f'Finished extracting pocket from {protein_file.stem} using {ligand_file.stem} as reference ligand')
-    else:
-        pass
+    printlog(f'Radius of Gyration of reference ligand is: {radius_of_gyration}')
+    radius = round(0.5 * 2.857 * float(radius_of_gyration), 2)
+    # The pocket is extracted once per receptor, reference ligand and radius, and copied next to the protein file
+    cached_pocket = cached_artifact([file_hash(protein_file), file_hash(ligand_file), f'pocket-radius-{radius}'],
+                                    '.pdb',
+                                    lambda output_file: write_pocket(protein_file, ligand_mol, radius, output_file))
+    shutil.copyfile(cached_pocket, str(protein_file).replace('.pdb', '_pocket.pdb'))
+    printlog(f'Finished extracting pocket from {protein_file.stem} using {ligand_file.stem} as reference ligand')
     # Calculate the center coordinates of the pocket
     ligu = get_ligand_coordinates(ligand_mol)
     center_x = ligu['x_coord'].mean().round(2)
@@ -98,6 +94,24 @@ def get_pocket_RoG(ligand_file : Path, protein_file : Path):
         "size": [round(2.857 * float(radius_of_gyration), 2), round(2.857 * float(radius_of_gyration), 2), round(2.857 * float(radius_of_gyration), 2)]}
     return pocket_coordinates
 
+def write_pocket(protein_file: Path, ligand_molecule, cutoff: float, output_file: Path) -> Path:
+    """
+    Extracts the residues of the protein within the cutoff of the ligand and writes them to a PDB file.
+
+    Args:
+        protein_file (Path): Path to the protein file in PDB format.
+        ligand_molecule (Chem.Mol): Ligand molecule.
+        cutoff (float): Cutoff distance for selecting residues near the ligand.
+        output_file (Path): Path to the pocket PDB file to write.
+
+    Returns:
+        Path: The path to the pocket PDB file.
+    """
+    pocket_mol, temp_file = process_protein_and_ligand(str(protein_file), ligand_molecule, cutoff)
+    Chem.MolToPDBFile(pocket_mol, str(output_file))
+    os.remove(temp_file)
+    return output_file
+
 def process_protein_and_ligand(protein_file, ligand_molecule, cutoff):
     """
     Process the protein and ligand to select cutoff residues and generate a pocket file.
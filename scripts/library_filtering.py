@@ -0,0 +1,149 @@
+import json
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from rdkit import Chem, RDLogger
+from rdkit.Chem import Descriptors
+from rdkit.Chem.FilterCatalog import FilterCatalog, FilterCatalogParams
+from yaml import safe_load
+
+from scripts.utilities import iter_sdf_records, map_sdf_batches, printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Compiled SMARTS patterns and PAINS catalog of each filter configuration, built once per worker process
+_COMPILED_FILTERS = {}
+
+
+def load_filter_config(config_file: Path) -> dict:
+    """
+    Reads a library filter configuration file (see scripts/library_filters.yml).
+    """
+    with open(config_file) as f:
+        config = safe_load(f)
+    config.setdefault('action', 'drop')
+    config.setdefault('estimated_cpu_seconds_per_compound', 60)
+    config.setdefault('descriptors', {})
+    config.setdefault('pains', False)
+    config.setdefault('alerts', {})
+    if config['action'] not in ['drop', 'divert']:
+        raise ValueError(f'Invalid filter action : {config["action"]}. Must be either "drop" or "divert".')
+    for name in config['descriptors']:
+        if not hasattr(Descriptors, name):
+            raise ValueError(f'Invalid descriptor in library filters : {name}')
+    return config
+
+
+def compiled_filters(config: dict):
+    """
+    Returns the compiled SMARTS alerts and PAINS catalog of a filter configuration, compiling them on the first call in each process.
+    """
+    key = json.dumps(config, sort_keys=True)
+    if key not in _COMPILED_FILTERS:
+        alerts = {name: Chem.MolFromSmarts(smarts) for name, smarts in config['alerts'].items()}
+        invalid = [name for name, pattern in alerts.items() if pattern is None]
+        if invalid:
+            raise ValueError(f'Invalid SMARTS in library filters : {", ".join(invalid)}')
+        pains = None
+        if config['pains']:
+            params = FilterCatalogParams()
+            params.AddCatalog(FilterCatalogParams.FilterCatalogs.PAINS)
+            pains = FilterCatalog(params)
+        _COMPILED_FILTERS[key] = (alerts, pains)
+    return _COMPILED_FILTERS[key]
+
+
+def filter_batch(records: list, config: dict):
+    """
+    Applies the library filters to a batch of SDF records. The descriptors of the batch are computed first and compared to their limits as arrays.
+
+    Args:
+        records (list): The (ID, SDF record) pairs of the batch.
+        config (dict): The filter configuration.
+
+    Returns:
+        tuple: The SDF text of the compounds passing all filters, the SDF text of the removed compounds (with the rules they failed in a 'Filters' property),
+        the number of compounds failing each rule and the number of compounds kept.
+    """
+    RDLogger.DisableLog('rdApp.*')
+    alerts, pains = compiled_filters(config)
+    molecules = []
+    for _, record in records:
+        molecule = Chem.MolFromMolBlock(record)
+        molecules.append(Chem.RemoveHs(molecule) if molecule is not None else None)
+    parsed = np.array([molecule is not None for molecule in molecules], dtype=bool)
+    failures = {'unreadable': ~parsed}
+    for name, limits in config['descriptors'].items():
+        function = getattr(Descriptors, name)
+        values = np.array([function(molecule) if molecule is not None else np.nan for molecule in molecules], dtype=float)
+        failed = np.zeros(len(molecules), dtype=bool)
+        if 'min' in limits:
+            failed |= values < limits['min']
+        if 'max' in limits:
+            failed |= values > limits['max']
+        failures[name] = failed & parsed
+    for name, pattern in alerts.items():
+        failures[name] = np.array([molecule is not None and molecule.HasSubstructMatch(pattern) for molecule in molecules], dtype=bool)
+    if pains is not None:
+        failures['PAINS'] = np.array([molecule is not None and pains.HasMatch(molecule) for molecule in molecules], dtype=bool)
+    rules = list(failures.keys())
+    failure_matrix = np.column_stack([failures[rule] for rule in rules])
+    kept, removed = [], []
+    for (_, record), failed_rules in zip(records, failure_matrix):
+        if not failed_rules.any():
+            kept.append(record)
+        elif config['action'] == 'divert':
+            failed_names = ', '.join(rule for rule, failed in zip(rules, failed_rules) if failed)
+            removed.append(record[:record.rindex('$$$$')] + f'>  <Filters>\n{failed_names}\n\n$$$$\n')
+    counts = {rule: int(failures[rule].sum()) for rule in rules}
+    return ''.join(kept), ''.join(removed), counts, len(kept)
+
+
+def filter_library(library_sdf: Path, output_dir: Path, config_file: Path, ncpus: int, batch_size: int = 1000):
+    """
+    Removes the compounds failing the library filters from an SDF file, in place.
+    Diverted compounds are appended to filtered_library.sdf. The number of compounds removed by each rule and the estimated CPU-hours saved are reported.
+    The compounds of batches that could not be filtered are kept unfiltered and reported separately.
+
+    Args:
+        library_sdf (Path): The path to the SDF file to filter.
+        output_dir (Path): The path to the output directory.
+        config_file (Path): The path to the filter configuration file.
+        ncpus (int): The number of CPUs to use.
+        batch_size (int): The number of records per batch.
+    """
+    printlog('Filtering library...')
+    tic = time.perf_counter()
+    config = load_filter_config(config_file)
+    # Compile once in the main process to report configuration errors before starting the workers
+    compiled_filters(config)
+    tmp_file = library_sdf.with_suffix('.filtered.tmp')
+    n_in, n_kept, n_unfiltered = 0, 0, 0
+    counts = {}
+    with open(tmp_file, 'w') as kept_file, open(output_dir / 'filtered_library.sdf', 'a') as removed_file:
+        for batch, results in map_sdf_batches(iter_sdf_records(library_sdf), filter_batch, ncpus, batch_size, 'Filtering library', config=config):
+            n_in += len(batch)
+            if not results:
+                # The batch failed (the error is logged by map_sdf_batches), keep its compounds rather than losing them
+                kept_file.write(''.join(record for _, record in batch))
+                n_kept += len(batch)
+                n_unfiltered += len(batch)
+            for kept_text, removed_text, batch_counts, n_batch_kept in results:
+                kept_file.write(kept_text)
+                removed_file.write(removed_text)
+                n_kept += n_batch_kept
+                for rule, count in batch_counts.items():
+                    counts[rule] = counts.get(rule, 0) + count
+    tmp_file.replace(library_sdf)
+    toc = time.perf_counter()
+    n_removed = n_in - n_kept
+    cpu_hours = n_removed * config['estimated_cpu_seconds_per_compound'] / 3600
+    printlog(f'Library filtering finished in {toc - tic:0.4f}: kept {n_kept} of {n_in} compounds, removed {n_removed} (estimated {cpu_hours:0.1f} CPU-hours saved)')
+    for rule, count in counts.items():
+        if count:
+            printlog(f'    {rule}: {count} compounds')
+    if n_unfiltered:
+        printlog(f'WARNING: {n_unfiltered} compounds could not be filtered and were kept unfiltered')
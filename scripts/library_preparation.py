@@ -1,237 +1,341 @@
 import concurrent.futures
-import math
+import hashlib
 import os
 import shutil
 import subprocess
+import tempfile
+import time
 import warnings
 from pathlib import Path
 from subprocess import DEVNULL, STDOUT
 
+import chembl_structure_pipeline
 import pandas as pd
 from chembl_structure_pipeline import standardizer
-from rdkit import Chem
-from rdkit.Chem import AllChem, PandasTools
-from tqdm import tqdm
+from rdkit import Chem, RDLogger, rdBase
+from rdkit.Chem import AllChem
 
-from scripts.utilities import parallel_executor, printlog, split_sdf_str
+from scripts.artifact_cache import lookup_prepared_ligands, prepared_ligand_database, store_prepared_ligands
+from scripts.library_filtering import filter_library
+from scripts.utilities import iter_sdf_records, map_sdf_batches, printlog
 
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# Title of the record GypsumDL writes at the start of its output files to describe its parameters
+GYPSUM_HEADER_TITLE = 'EMPTY MOLECULE DESCRIBING GYPSUM-DL PARAMETERS'
+
+# Maximum number of MMFF minimization iterations per conformer
+MMFF_MAX_ITERATIONS = 200
+
+
 def standardize_molecule(molecule):
     standardized_molecule = standardizer.standardize_mol(molecule)
     standardized_molecule = standardizer.get_parent_mol(standardized_molecule)
     return standardized_molecule
 
 
+def normalize_id(compound_id: str) -> str:
+    """
+    Normalizes a compound ID for DockM8: 'DOCKM8-' is added in front of IDs that contain only numbers and underscores are replaced by hyphens
+    (underscores are used as separators in Pose IDs).
+    """
+    compound_id = str(compound_id)
+    if compound_id.isdigit():
+        compound_id = 'DOCKM8-' + compound_id
+    return compound_id.replace('_', '-')
+
+
+def process_sdf_in_batches(input_sdf: Path, output_sdf: Path, batch_function, ncpus: int, batch_size: int, desc: str, records=None, timeout: float = None, **kwargs):
+    """
+    Streams the records of an SDF file through a batch function in worker processes and writes the results incrementally, in input order.
+
+    Args:
+        input_sdf (Path): The path to the input SDF file.
+        output_sdf (Path): The path to the output SDF file.
+        batch_function (function): Function taking a list of (title, record) pairs and returning the SDF text of its results and their number.
+        ncpus (int): The number of worker processes.
+        batch_size (int): The number of records per batch.
+        desc (str): The description of the progress bar.
+        records (iterator): The (title, record) pairs to process, defaults to the records of the input SDF file.
+        timeout (float): Time limit in seconds per record, see map_sdf_batches.
+        **kwargs: Additional keyword arguments passed to the batch function.
+
+    Returns:
+        tuple: The number of input records and the number of output molecules.
+    """
+    n_in, n_out = 0, 0
+    records = records if records is not None else iter_sdf_records(input_sdf)
+    with open(output_sdf, 'w') as outfile:
+        for batch, results in map_sdf_batches(records, batch_function, ncpus, batch_size, desc, timeout=timeout, **kwargs):
+            n_in += len(batch)
+            for text, n_results in results:
+                outfile.write(text)
+                n_out += n_results
+    return n_in, n_out
+
+
+def standardize_batch(records: list):
+    """
+    Standardizes a batch of SDF records with the ChemBL Structure Pipeline. Molecules are rebuilt from their SMILES before standardization.
+
+    Args:
+        records (list): The (ID, SDF record) pairs of the batch.
+
+    Returns:
+        tuple: The SDF text of the standardized molecules, titled with their ID, and their number.
+    """
+    RDLogger.DisableLog('rdApp.*')
+    output = []
+    for compound_id, record in records:
+        try:
+            molecule = Chem.MolFromSmiles(Chem.MolToSmiles(Chem.MolFromMolBlock(record)))
+            molecule = standardize_molecule(molecule)[0]
+            molecule.SetProp('_Name', compound_id)
+            output.append(Chem.MolToMolBlock(molecule) + '$$$$\n')
+        except Exception:
+            continue
+    return ''.join(output), len(output)
+
+
+def normalized_records(input_sdf: Path):
+    """
+    Iterates over the records of an SDF file with their normalized ID.
+    """
+    for title, record in iter_sdf_records(input_sdf):
+        yield normalize_id(title), record
+
+
 # This function standardizes a docking library using the ChemBL Structure Pipeline.
-def standardize_library(input_sdf: Path, output_dir: Path, id_column: str, ncpus: int):
+def standardize_library(input_sdf: Path, output_dir: Path, id_column: str, ncpus: int, batch_size: int = 1000):
     """
     Standardizes a docking library using the ChemBL Structure Pipeline.
+    The library is streamed in batches through the worker processes and the standardized molecules are written as they are ready.
 
     Args:
         input_sdf (Path): The path to the input SDF file containing the docking library.
         output_dir (Path): The directory where the standardized SDF file will be saved.
         id_column (str): The name of the column in the SDF file that contains the compound IDs.
         ncpus (int): The number of CPUs to use for parallel processing.
+        batch_size (int): The number of molecules sent to a worker at once.
 
     Returns:
         None. The function writes the standardized molecules to a new SDF file.
 
     Raises:
-        Exception: If there is an error loading the library SDF file.
-        Exception: If there is an error converting SMILES to RDKit molecules.
-        Exception: If there is an error writing the standardized library SDF file.
+        Exception: If there is an error standardizing the library SDF file.
     """
     printlog('Standardizing docking library using ChemBL Structure Pipeline...')
-    # Load Original Library SDF into Pandas
-    try:
-        df = PandasTools.LoadSDF(str(input_sdf),
-                                idName=id_column,
-                                molColName='Molecule',
-                                includeFingerprints=False,
-                                embedProps=True,
-                                removeHs=True,
-                                strictParsing=True,
-                                smilesName='SMILES')
-        df.rename(columns={id_column: 'ID'}, inplace=True)
-        # Add 'DOCKM8-' in front of IDs that contain only numbers
-        df['ID'] = ['DOCKM8-' + str(id) if str(id).isdigit() else id for id in df['ID']]
-        # Replace underscore characters with hyphen in ID column
-        df['ID'] = df['ID'].str.replace('_', '-')
-        n_cpds_start = len(df)
-    except BaseException:
-        printlog('ERROR: Failed to Load library SDF file!')
-        raise Exception('Failed to Load library SDF file!')
-    try:
-        # Convert SMILES to RDKit molecules
-        df.drop(columns='Molecule', inplace=True)
-        df['Molecule'] = [Chem.MolFromSmiles(smiles) for smiles in df['SMILES']]
-    except Exception as e:
-        printlog('ERROR: Failed to convert SMILES to RDKit molecules!' + e)
-    # Standardize molecules using ChemBL Pipeline
-    if ncpus == 1:
-        # Standardize molecules sequentially
-        df['Molecule'] = [standardizer.get_parent_mol(standardizer.standardize_mol(mol)) for mol in df['Molecule']]
-    else:
-        # Standardize molecules in parallel using multiple CPUs
-        with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus) as executor:
-            df['Molecule'] = list(tqdm(executor.map(standardize_molecule, df['Molecule']), total=len(df['Molecule']), desc='Standardizing molecules', unit='mol'))
-    # Clean up the DataFrame
-    df[['Molecule', 'flag']] = pd.DataFrame(df['Molecule'].tolist(), index=df.index)
-    df = df.drop(columns='flag')
-    df = df.loc[:, ~df.columns.duplicated()].copy()
-    n_cpds_end = len(df)
-    printlog(f'Standardization of compound library finished: Started with {n_cpds_start}, ended with {n_cpds_end}: {n_cpds_start-n_cpds_end} compounds lost')
-    # Write standardized molecules to standardized SDF file
+    tic = time.perf_counter()
     output_sdf = output_dir / 'standardized_library.sdf'
     try:
-        PandasTools.WriteSDF(df,
-                            str(output_sdf),
-                            molColName='Molecule',
-                            idName='ID',
-                            allNumeric=True)
-    except BaseException:
-        raise Exception('Failed to write standardized library SDF file!')
+        n_cpds_start, n_cpds_end = process_sdf_in_batches(input_sdf, output_sdf, standardize_batch, ncpus, batch_size, 'Standardizing molecules', records=normalized_records(input_sdf))
+    except Exception as e:
+        output_sdf.unlink(missing_ok=True)
+        printlog('ERROR: Failed to standardize library SDF file!')
+        raise Exception(f'Failed to standardize library SDF file: {e}')
+    toc = time.perf_counter()
+    printlog(f'Standardization of compound library finished in {toc - tic:0.4f}: Started with {n_cpds_start}, ended with {n_cpds_end}: {n_cpds_start-n_cpds_end} compounds lost')
 
-def conf_gen_RDKit(molecule):
+def conf_gen_RDKit(molecule, timeout: float = None):
     """
     Generates 3D conformers using RDKit.
 
     Args:
         molecule (RDKit molecule): The input molecule.
+        timeout (float): Time limit in seconds of each embedding attempt, enforced by RDKit (requires EmbedParameters.timeout, see generate_conformers_RDKit).
 
     Returns:
         molecule (RDKit molecule): The molecule with 3D conformers.
     """
     if not molecule.GetConformer().Is3D():
         molecule = Chem.AddHs(molecule)
-        AllChem.EmbedMolecule(molecule)
-        AllChem.MMFFOptimizeMolecule(molecule)
+        params = AllChem.ETKDGv3()
+        if timeout and hasattr(params, 'timeout'):
+            params.timeout = max(1, int(timeout))
+        if AllChem.EmbedMolecule(molecule, params) == -1:
+            # Fall back to random starting coordinates for molecules the default embedding cannot handle
+            params.useRandomCoords = True
+            if AllChem.EmbedMolecule(molecule, params) == -1:
+                raise ValueError('Embedding failed')
+        AllChem.MMFFOptimizeMolecule(molecule, maxIters=MMFF_MAX_ITERATIONS)
         AllChem.SanitizeMol(molecule)
     return molecule
-def generate_conformers_RDKit(input_sdf: str, output_dir: str, ncpus: int):
+
+
+def conf_gen_batch(records: list, threads: int = 1, embedding_timeout: float = None):
+    """
+    Generates 3D conformers for a batch of SDF records using RDKit. The GypsumDL parameters record is skipped.
+    With threads > 1 the molecules of the batch are embedded by a thread pool (RDKit releases the GIL during embedding and force field optimization).
+
+    Args:
+        records (list): The (ID, SDF record) pairs of the batch.
+        threads (int): The number of threads used to embed the batch.
+        embedding_timeout (float): Time limit in seconds of each embedding attempt, molecules running over it are skipped.
+
+    Returns:
+        tuple: The SDF text of the 3D molecules, titled with their ID, and their number.
+    """
+    RDLogger.DisableLog('rdApp.*')
+    molecules = []
+    for compound_id, record in records:
+        if compound_id == GYPSUM_HEADER_TITLE:
+            continue
+        molecule = Chem.MolFromMolBlock(record, removeHs=False)
+        if molecule is not None:
+            molecules.append((compound_id, molecule))
+
+    def embed(item):
+        try:
+            return item[0], conf_gen_RDKit(item[1], embedding_timeout)
+        except Exception:
+            return item[0], None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(embed, molecules))
+    output = []
+    for compound_id, molecule in results:
+        if molecule is not None:
+            molecule.SetProp('_Name', compound_id)
+            output.append(Chem.MolToMolBlock(molecule) + '$$$$\n')
+    return ''.join(output), len(output)
+
+
+def generate_conformers_RDKit(input_sdf: str, output_dir: str, ncpus: int, batch_size: int = 100, threads_per_worker: int = None, timeout: float = 60):
     """
     Generates 3D conformers using RDKit.
+    Molecules are sent to the workers in batches and written to the output file as the batches complete.
 
     Args:
         input_sdf (str): Path to the input SDF file.
         output_dir (str): Path to the output directory.
+        ncpus (int): Number of CPUs to use.
+        batch_size (int): Number of molecules per worker task.
+        threads_per_worker (int): Number of embedding threads per worker process, ncpus // threads_per_worker processes are used.
+            Defaults to $DOCKM8_CONFORMER_THREADS (set by --conformer_threads), or 1.
+        timeout (float): Time limit in seconds per molecule, molecules running over it are skipped. It is enforced by RDKit during embedding
+            (the MMFF minimization is bounded by MMFF_MAX_ITERATIONS). With RDKit versions without EmbedParameters.timeout, the molecules are sent
+            to the workers one by one instead, each with its own time limit in the pool.
 
     Returns:
         None
     """
     printlog('Generating 3D conformers using RDKit...')
+    tic = time.perf_counter()
+    # The input can be the GypsumDL output itself, write to a temporary file and rename it once done
+    output_file = output_dir / 'gypsum_dl_success.sdf'
+    tmp_file = output_dir / 'rdkit_conformers.sdf.tmp'
     try:
-        df = PandasTools.LoadSDF(str(input_sdf),
-                                idName='ID',
-                                molColName='Molecule',
-                                includeFingerprints=False,
-                                removeHs=False,
-                                smilesName='SMILES')
-        df = df.iloc[1:]  # Filter the dataframe to keep all rows except the first one
-        with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus) as executor:
-            df['Molecule'] = list(tqdm(executor.map(conf_gen_RDKit, df['Molecule']), total=len(df['Molecule']), desc='Minimizing molecules', unit='mol'))
-
-        # Write the conformers to the output SDF file using PandasTools.WriteSDF()
-        output_file = output_dir / 'gypsum_dl_success.sdf'
-        PandasTools.WriteSDF(df, str(output_file), molColName='Molecule', idName='ID')
+        threads_per_worker = threads_per_worker or int(os.environ.get('DOCKM8_CONFORMER_THREADS', 1))
+        if timeout and not hasattr(AllChem.ETKDGv3(), 'timeout'):
+            # The time limit can only be enforced by the pool, per task: one molecule per task, embedded by a single thread
+            printlog('RDKit does not support embedding time limits, sending the molecules to the workers one by one...')
+            batch_size, threads_per_worker = 1, 1
+        n_workers = max(1, ncpus // threads_per_worker)
+        n_in, n_out = process_sdf_in_batches(input_sdf, tmp_file, conf_gen_batch, n_workers, batch_size, 'Minimizing molecules',
+                                             timeout=timeout, threads=threads_per_worker, embedding_timeout=timeout)
+        tmp_file.replace(output_file)
     except Exception as e:
-        printlog('ERROR: Failed to generate conformers using RDKit!' + e)
+        tmp_file.unlink(missing_ok=True)
+        printlog('ERROR: Failed to generate conformers using RDKit!' + str(e))
+        return
+    toc = time.perf_counter()
+    printlog(f'Generated 3D conformers for {n_out} molecules in {toc - tic:0.4f} ({n_out / max(toc - tic, 1e-9):0.1f} mol/s)')
     return
 
 
-def generate_conformers_GypsumDL_withprotonation(input_sdf, output_dir, software, ncpus):
+def gypsum_dl_batch(records: list, software: Path, options: str, shard_folder: Path, retries: int = 2):
     """
-    Generates protonation states and 3D conformers using GypsumDL.
+    Runs GypsumDL on a shard of SDF records, retrying the shard if GypsumDL does not produce an output file.
 
     Args:
-        input_sdf (str): Path to the input SDF file.
-        output_dir (str): Path to the output directory.
-        software (str): Path to the GypsumDL software.
-        ncpus (int): Number of CPUs to use for the calculation.
+        records (list): The (ID, SDF record) pairs of the shard.
+        software (Path): Path to the software folder.
+        options (str): The GypsumDL command line options.
+        shard_folder (Path): The folder in which the temporary shard folders are created.
+        retries (int): The number of times a failed shard is retried.
 
-    Raises:
-        Exception: If failed to generate protomers and conformers.
+    Returns:
+        tuple: The SDF text of the GypsumDL molecules (without the parameters record and SDF properties) and their number.
+    """
+    with tempfile.TemporaryDirectory(dir=shard_folder) as tmp_dir:
+        shard_sdf = Path(tmp_dir) / 'shard.sdf'
+        shard_sdf.write_text(''.join(record for _, record in records))
+        results_dir = Path(tmp_dir) / 'results'
+        for attempt in range(retries + 1):
+            shutil.rmtree(results_dir, ignore_errors=True)
+            gypsum_dl_command = f'python {software}/gypsum_dl-1.2.1/run_gypsum_dl.py -s {shard_sdf} -o {results_dir} --job_manager serial -p 1 {options}'
+            subprocess.call(gypsum_dl_command, shell=True, stdout=DEVNULL, stderr=STDOUT)
+            results_sdf = results_dir / 'gypsum_dl_success.sdf'
+            if results_sdf.is_file():
+                output = [record[:record.index('M  END')] + 'M  END\n$$$$\n'
+                          for title, record in iter_sdf_records(results_sdf)
+                          if title != GYPSUM_HEADER_TITLE and 'M  END' in record]
+                return ''.join(output), len(output)
+    raise RuntimeError(f'GypsumDL failed on a shard of {len(records)} molecules after {retries + 1} attempts')
+
+
+def run_GypsumDL(input_sdf: Path, output_dir: Path, software: Path, ncpus: int, options: str, desc: str, shard_size: int = 100, retries: int = 2):
+    """
+    Runs GypsumDL on a library as a stream of shards, one single-process GypsumDL run per shard and ncpus shards at a time.
+    Completed shards are appended to gypsum_dl_success.sdf as they finish, in input order.
 
+    Args:
+        input_sdf (Path): Path to the input SDF file.
+        output_dir (Path): Path to the output directory.
+        software (Path): Path to the software folder.
+        ncpus (int): Number of CPUs to use.
+        options (str): The GypsumDL command line options.
+        desc (str): The description of the progress bar.
+        shard_size (int): Number of molecules per shard.
+        retries (int): Number of times a failed shard is retried.
     """
-    printlog('Calculating protonation states and generating 3D conformers using GypsumDL...')
-    printlog('Splitting input SDF file into smaller files for parallel processing...')
-    n_splits = 10
-    split_files_folder = split_sdf_str(output_dir / 'GypsumDL_split', input_sdf, n_splits)
-    split_files_sdfs = [split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
-
-    global gypsum_dl_run
-    def gypsum_dl_run(split_file, output_dir, cpus):
-        results_dir = output_dir / 'GypsumDL_results'
-        try:
-            gypsum_dl_command = f'python {software}/gypsum_dl-1.2.1/run_gypsum_dl.py -s {split_file} -o {results_dir} --job_manager multiprocessing -p {cpus} -m 1 -t 10 --min_ph 6.5 --max_ph 7.5 --pka_precision 1 --skip_alternate_ring_conformations --skip_making_tautomers --skip_enumerate_chiral_mol --skip_enumerate_double_bonds --max_variants_per_compound 1 --separate_output_files'
-            subprocess.call(
-                gypsum_dl_command,
-                shell=True,
-                stdout=DEVNULL,
-                stderr=STDOUT,
-            )
-        except Exception as e:
-            printlog('ERROR: Failed to generate protomers and conformers!')
-            printlog(e)
+    tic = time.perf_counter()
+    shard_folder = output_dir / 'GypsumDL_shards'
+    shard_folder.mkdir(parents=True, exist_ok=True)
+    try:
+        n_in, n_out = process_sdf_in_batches(input_sdf, output_dir / 'gypsum_dl_success.sdf', gypsum_dl_batch, ncpus, shard_size, desc,
+                                             software=software, options=options, shard_folder=shard_folder, retries=retries)
+    except Exception as e:
+        printlog('ERROR: Failed to run GypsumDL!')
+        printlog(e)
         return
+    finally:
+        shutil.rmtree(shard_folder, ignore_errors=True)
+    toc = time.perf_counter()
+    printlog(f'GypsumDL finished in {toc - tic:0.4f}: {n_in} molecules in, {n_out} molecules out')
 
-    printlog('Running GypsumDL in parallel...')
-    n_workers = 3
-    parallel_executor(gypsum_dl_run,
-                      split_files_sdfs,
-                      n_workers,
-                      output_dir=output_dir,
-                      cpus=math.ceil(ncpus // n_workers))
 
-    results_dfs = []
+GYPSUM_COMMON_OPTIONS = '-m 1 -t 10 --skip_alternate_ring_conformations --skip_making_tautomers --skip_enumerate_chiral_mol --skip_enumerate_double_bonds --max_variants_per_compound 1'
+GYPSUM_PROTONATION_OPTIONS = '--min_ph 6.5 --max_ph 7.5 --pka_precision 1'
 
-    for file in os.listdir(output_dir / 'GypsumDL_results'):
-        if file.endswith('.sdf'):
-            sdf_df = PandasTools.LoadSDF(str(output_dir / 'GypsumDL_results' /
-                                             file),
-                                         molColName='Molecule',
-                                         idName='ID',
-                                         removeHs=False)
-            results_dfs.append(sdf_df)
 
-    final_df = pd.concat(results_dfs)
+def generate_conformers_GypsumDL_withprotonation(input_sdf, output_dir, software, ncpus):
+    """
+    Generates protonation states and 3D conformers using GypsumDL.
 
-    PandasTools.WriteSDF(final_df,
-                         str(output_dir / 'gypsum_dl_success.sdf'),
-                         molColName='Molecule',
-                         idName='ID')
-    shutil.rmtree(output_dir / 'GypsumDL_results')
-    shutil.rmtree(output_dir / 'GypsumDL_split')
+    Args:
+        input_sdf (str): Path to the input SDF file.
+        output_dir (str): Path to the output directory.
+        software (str): Path to the GypsumDL software.
+        ncpus (int): Number of CPUs to use for the calculation.
+    """
+    printlog('Calculating protonation states and generating 3D conformers using GypsumDL...')
+    run_GypsumDL(input_sdf, output_dir, software, ncpus, f'{GYPSUM_PROTONATION_OPTIONS} {GYPSUM_COMMON_OPTIONS}', 'Running GypsumDL')
 
 
 def GypsumDL_onlyprotonation(input_sdf, output_dir, software, ncpus):
     """
-    Generates protonation states and 3D conformers using GypsumDL.
+    Generates protonation states using GypsumDL.
 
     Args:
         input_sdf (str): Path to the input SDF file.
         output_dir (str): Path to the output directory.
         software (str): Path to the GypsumDL software.
         ncpus (int): Number of CPUs to use for the calculation.
-
-    Raises:
-        Exception: If failed to generate protomers and conformers.
-
     """
     printlog('Calculating protonation states using GypsumDL...')
-    try:
-        gypsum_dl_command = f'python {software}/gypsum_dl-1.2.1/run_gypsum_dl.py -s {input_sdf} -o {output_dir} --job_manager multiprocessing -p {ncpus} -m 1 -t 10 --min_ph 6.5 --max_ph 7.5 --pka_precision 1 --skip_alternate_ring_conformations --skip_making_tautomers --skip_enumerate_chiral_mol --skip_enumerate_double_bonds --max_variants_per_compound 1 --2d_output_only'
-        subprocess.call(
-            gypsum_dl_command,
-            shell=True,
-            stdout=DEVNULL,
-            stderr=STDOUT,
-        )
-    except Exception as e:
-        printlog('ERROR: Failed to generate protomers!')
-        printlog(e)
+    run_GypsumDL(input_sdf, output_dir, software, ncpus, f'{GYPSUM_PROTONATION_OPTIONS} {GYPSUM_COMMON_OPTIONS} --2d_output_only', 'Protonating molecules')
 
 
 def generate_conformers_GypsumDL_noprotonation(input_sdf, output_dir, software,
@@ -244,98 +348,243 @@ def generate_conformers_GypsumDL_noprotonation(input_sdf, output_dir, software,
         output_dir (str): Path to the output directory.
         software (str): Path to the GypsumDL software.
         ncpus (int): Number of CPUs to use for multiprocessing.
-
-    Returns:
-        None
     """
     printlog('Generating 3D conformers using GypsumDL...')
-    try:
-        gypsum_dl_command = f'python {software}/gypsum_dl-1.2.1/run_gypsum_dl.py -s {input_sdf} -o {output_dir} --job_manager multiprocessing -p {ncpus} -m 1 -t 10 --skip_adding_hydrogen --skip_alternate_ring_conformations --skip_making_tautomers --skip_enumerate_chiral_mol --skip_enumerate_double_bonds --max_variants_per_compound 1'
-        subprocess.call(
-            gypsum_dl_command,
-            shell=True,
-            stdout=DEVNULL,
-            stderr=STDOUT,
-        )
-    except Exception as e:
-        printlog('ERROR: Failed to generate conformers!')
-        printlog(e)
+    run_GypsumDL(input_sdf, output_dir, software, ncpus, f'--skip_adding_hydrogen {GYPSUM_COMMON_OPTIONS}', 'Running GypsumDL')
+
 
-def cleanup(input_sdf: str, output_dir: Path) -> pd.DataFrame:
+def cleanup(input_sdf: str, output_dir: Path):
     """
-    Cleans up the temporary files generated during the library preparation process.
+    Finalizes the library: gypsum_dl_success.sdf, which the conformer generation steps write incrementally with only the ID and molecule of each compound,
+    is renamed to final_library.sdf in one atomic step and the temporary files are deleted.
 
     Args:
         input_sdf (str): The path to the input SDF file containing the compound library.
+        output_dir (Path): The path to the output directory.
+    """
+    printlog('Cleaning up files...')
+    n_cpds_end = sum(1 for _ in iter_sdf_records(output_dir / 'gypsum_dl_success.sdf'))
+    (output_dir / 'gypsum_dl_success.sdf').replace(output_dir / 'final_library.sdf')
+
+    # Delete the temporary files generated during the library preparation process
+    (output_dir / 'standardized_library.sdf').unlink(missing_ok=True)
+    (output_dir / 'gypsum_dl_failed.smi').unlink(missing_ok=True)
+
+    printlog(f'Preparation of compound library finished: ended with {n_cpds_end} compounds')
+
+    return
+
+
+def structure_key_batch(records: list) -> list:
+    """
+    Computes the deduplication key (InChIKey, or canonical SMILES if no InChIKey can be generated) of a batch of standardized SDF records.
 
     Returns:
-        pd.DataFrame: The final DataFrame containing the cleaned-up library with only the 'Molecule' and 'ID' columns.
+        list: The key of each record, None for records that cannot be parsed.
     """
-    printlog('Cleaning up files...')
+    RDLogger.DisableLog('rdApp.*')
+    keys = []
+    for _, record in records:
+        try:
+            molecule = Chem.MolFromMolBlock(record)
+            keys.append(Chem.MolToInchiKey(molecule) or Chem.MolToSmiles(molecule))
+        except Exception:
+            keys.append(None)
+    return keys
 
-    # Load the successfully generated conformers from the GypsumDL process into a pandas DataFrame
-    gypsum_df = PandasTools.LoadSDF(str(output_dir / 'gypsum_dl_success.sdf'), molColName='Molecule',idName='ID', removeHs=False)
 
-    # Sanitize all the molecules in the DataFrame
-    #for mol in gypsum_df['Molecule']:
-    #    AllChem.SanitizeMol(mol)
+def deduplicate_library(standardized_sdf: Path, ncpus: int, batch_size: int = 1000) -> list:
+    """
+    Removes duplicate structures (same standardized parent) from the standardized library, keeping the first occurrence of each structure.
 
-    # END: abpxx6d04wxr
+    Args:
+        standardized_sdf (Path): The path to the standardized library, which is replaced by the deduplicated library.
+        ncpus (int): The number of CPUs to use.
+        batch_size (int): The number of records per batch.
 
-    # Remove the first row of the DataFrame, which contains the original input molecule
-    final_df = gypsum_df.iloc[1:, :]
+    Returns:
+        list: The (ID, Representative ID) pairs of the removed duplicates.
+    """
+    tic = time.perf_counter()
+    representatives = {}
+    duplicates = []
+    tmp_file = standardized_sdf.with_suffix('.dedup.tmp')
+    with open(tmp_file, 'w') as outfile:
+        for batch, results in map_sdf_batches(iter_sdf_records(standardized_sdf), structure_key_batch, ncpus, batch_size, 'Deduplicating library'):
+            keys = results[0] if results else [None] * len(batch)
+            for (compound_id, record), key in zip(batch, keys):
+                if key is not None and key in representatives:
+                    duplicates.append((compound_id, representatives[key]))
+                    continue
+                if key is not None:
+                    representatives[key] = compound_id
+                outfile.write(record)
+    tmp_file.replace(standardized_sdf)
+    toc = time.perf_counter()
+    printlog(f'Deduplication finished in {toc - tic:0.4f}: removed {len(duplicates)} duplicates, {len(representatives)} unique structures left')
+    return duplicates
+
+
+# Change the recipe version to invalidate the prepared ligand cache after changing the preparation steps
+PREPARATION_RECIPE = 'dockm8-preparation-v2'
+
+
+def preparation_settings(conformers: str, protonation: str) -> str:
+    """
+    Returns the string describing the preparation settings and software versions, part of the prepared ligand cache keys.
+    """
+    return '|'.join([f'conformers={conformers}',
+                     f'protonation={protonation}',
+                     f'rdkit={rdBase.rdkitVersion}',
+                     f'chembl_structure_pipeline={getattr(chembl_structure_pipeline, "__version__", "unknown")}',
+                     'gypsum_dl=1.2.1',
+                     PREPARATION_RECIPE])
 
-    # Select only the 'Molecule' and 'ID' columns from the DataFrame
-    final_df = final_df[['Molecule', 'ID']]
 
-    # Get the number of compounds in the final DataFrame
-    n_cpds_end = len(final_df)
+def preparation_key_batch(records: list, settings: str) -> list:
+    """
+    Computes the prepared ligand cache keys (hash of the canonical SMILES of the standardized parent and the preparation settings) of a batch of standardized SDF records.
 
-    # Write the final DataFrame to a new SDF file
-    PandasTools.WriteSDF(final_df, str(output_dir / 'final_library.sdf'), molColName='Molecule', idName='ID')
+    Returns:
+        list: The key of each record, None for records that cannot be parsed.
+    """
+    RDLogger.DisableLog('rdApp.*')
+    keys = []
+    for _, record in records:
+        try:
+            smiles = Chem.MolToSmiles(Chem.MolFromMolBlock(record))
+            keys.append(hashlib.sha1(f'{smiles}|{settings}'.encode()).hexdigest())
+        except Exception:
+            keys.append(None)
+    return keys
 
-    # Delete the temporary files generated during the library preparation process
-    (output_dir / 'gypsum_dl_success.sdf').unlink(missing_ok=True)
-    (output_dir / 'standardized_library.sdf').unlink(missing_ok=True)
-    (output_dir / 'gypsum_dl_failed.smi').unlink(missing_ok=True)
 
-    printlog(f'Preparation of compound library finished: ended with {n_cpds_end} compounds')
+def split_cached_ligands(standardized_sdf: Path, output_dir: Path, settings: str, ncpus: int, batch_size: int = 1000):
+    """
+    Splits the standardized library into the compounds already in the prepared ligand cache and the new compounds.
+    Compounds are looked up by their standardized parent, so salt forms and alternative input representations of a cached compound are not prepared again.
 
-    return
+    Args:
+        standardized_sdf (Path): The path to the standardized library, titled with the normalized IDs.
+        output_dir (Path): The path to the output directory.
+        settings (str): The preparation settings, see preparation_settings.
+        ncpus (int): The number of CPUs to use.
+        batch_size (int): The number of records per batch.
 
+    Returns:
+        tuple: The path to the SDF file with the standardized new compounds, the path to the SDF file with the prepared cached compounds (titled with their normalized ID)
+        and a dictionary of normalized ID to cache key for the new compounds.
+    """
+    new_sdf = output_dir / 'uncached_library.sdf'
+    cached_sdf = output_dir / 'cached_library.sdf'
+    new_keys = {}
+    connection = prepared_ligand_database()
+    try:
+        with open(new_sdf, 'w') as new_file, open(cached_sdf, 'w') as cached_file:
+            for batch, results in map_sdf_batches(iter_sdf_records(standardized_sdf), preparation_key_batch, ncpus, batch_size, 'Looking up prepared ligands', settings=settings):
+                keys = results[0] if results else [None] * len(batch)
+                found = lookup_prepared_ligands(connection, [key for key in keys if key])
+                for (compound_id, record), key in zip(batch, keys):
+                    if key in found:
+                        cached_file.write(f'{compound_id}\n{found[key]}')
+                    else:
+                        new_file.write(record)
+                        # Only cache compounds whose ID identifies a single input structure
+                        new_keys[compound_id] = key if compound_id not in new_keys else None
+    finally:
+        connection.close()
+    n_cached = sum(1 for _ in iter_sdf_records(cached_sdf))
+    printlog(f'Found {n_cached} prepared compounds in the ligand cache, {len(new_keys)} compounds need to be prepared')
+    return new_sdf, cached_sdf, new_keys
+
+
+def store_prepared_library(prepared_sdf: Path, new_keys: dict):
+    """
+    Stores the prepared molblocks of the new compounds in the prepared ligand cache.
 
-def prepare_library(input_sdf: str, output_dir: Path, id_column: str, conformers: str, protonation: str, software: Path, ncpus: int):
+    Args:
+        prepared_sdf (Path): The path to the SDF file with the prepared compounds, titled with their normalized ID.
+        new_keys (dict): The cache key of each normalized ID.
+    """
+    entries = [(new_keys[title], record.split('\n', 1)[1])
+               for title, record in iter_sdf_records(prepared_sdf)
+               if new_keys.get(title)]
+    connection = prepared_ligand_database()
+    try:
+        store_prepared_ligands(connection, entries)
+    finally:
+        connection.close()
+    printlog(f'Stored {len(entries)} prepared compounds in the ligand cache')
+
+
+def generate_conformers(standardized_sdf: Path, output_dir: Path, conformers: str, protonation: str, software: Path, ncpus: int):
+    """
+    Protonates the standardized library and generates its 3D conformers with the selected methods, the results are written to gypsum_dl_success.sdf.
+    """
+    if conformers == 'RDKit' or conformers == 'MMFF':
+        if protonation == 'GypsumDL':
+            GypsumDL_onlyprotonation(standardized_sdf, output_dir, software, ncpus)
+            generate_conformers_RDKit(output_dir / 'gypsum_dl_success.sdf', output_dir, ncpus)
+        else:
+            generate_conformers_RDKit(standardized_sdf, output_dir, ncpus)
+    elif protonation == 'GypsumDL':
+        generate_conformers_GypsumDL_withprotonation(standardized_sdf, output_dir, software, ncpus)
+    else:
+        generate_conformers_GypsumDL_noprotonation(standardized_sdf, output_dir, software, ncpus)
+
+
+def prepare_library(input_sdf: str, output_dir: Path, id_column: str, conformers: str, protonation: str, software: Path, ncpus: int, use_cache: bool = True, deduplicate: bool = True, filter_config: Path = None):
     """
     Prepares a docking library for further analysis.
-    
+    Compounds already prepared with the same settings in a previous run are taken from the prepared ligand cache, only new compounds are prepared.
+
     Args:
         input_sdf (str): The path to the input SDF file containing the docking library.
         id_column (str): The name of the column in the SDF file that contains the compound IDs.
         protonation (str): The method to use for protonation. Can be 'GypsumDL', or 'None' for no protonation.
         ncpus (int): The number of CPUs to use for parallelization.
+        use_cache (bool): Whether to use the prepared ligand cache.
+        deduplicate (bool): Whether to prepare only one copy of compounds with the same standardized parent (new and cached compounds alike),
+            the removed duplicates are listed in duplicate_map.csv.
+        filter_config (Path): The path to a library filter configuration file (see scripts/library_filters.yml), compounds failing the filters are removed
+            before conformer generation. No filtering if None.
     """
+    if conformers not in ['RDKit', 'MMFF', 'GypsumDL']:
+        raise ValueError(f'Invalid conformer method specified : {conformers}. Must be either "RDKit", "MMFF" or "GypsumDL".')
+    if protonation not in ['GypsumDL', 'None']:
+        raise ValueError(f'Invalid protonation method specified : {protonation}. Must be either "None" or "GypsumDL".')
     standardized_sdf = output_dir / 'standardized_library.sdf'
+    (output_dir / 'filtered_library.sdf').unlink(missing_ok=True)
+
+    # The whole library is standardized and deduplicated on every run, so cached and new compounds are deduplicated together
+    # and a standardized library left by an interrupted run is overwritten
+    standardize_library(Path(input_sdf), output_dir, id_column, ncpus)
+    duplicates = deduplicate_library(standardized_sdf, ncpus) if deduplicate else []
+    # Cached and new compounds are filtered on the same standardized structures, before the cache lookup
+    if filter_config:
+        filter_library(standardized_sdf, output_dir, filter_config, ncpus)
+
+    if use_cache:
+        library_sdf, cached_sdf, new_keys = split_cached_ligands(standardized_sdf, output_dir, preparation_settings(conformers, protonation), ncpus)
+    else:
+        library_sdf, cached_sdf, new_keys = standardized_sdf, None, {}
+
+    if use_cache and not new_keys:
+        (output_dir / 'gypsum_dl_success.sdf').write_text('')
+    else:
+        generate_conformers(library_sdf, output_dir, conformers, protonation, software, ncpus)
 
-    if not standardized_sdf.is_file():
-        standardize_library(input_sdf, output_dir, id_column, ncpus)
+    if use_cache:
+        store_prepared_library(output_dir / 'gypsum_dl_success.sdf', new_keys)
+        with open(output_dir / 'gypsum_dl_success.sdf', 'a') as outfile, open(cached_sdf) as infile:
+            shutil.copyfileobj(infile, outfile)
+        cached_sdf.unlink()
+        library_sdf.unlink()
 
-    if conformers == 'RDKit' or conformers == 'MMFF':
-        if protonation == 'GypsumDL':
-            GypsumDL_onlyprotonation(standardized_sdf, output_dir, software, ncpus)
-            generate_conformers_RDKit(str(output_dir / 'gypsum_dl_success.sdf'), output_dir, ncpus)
-        elif protonation == 'None':
-            generate_conformers_RDKit(standardized_sdf, output_dir, ncpus)
-        else:
-            raise ValueError(f'Invalid protonation method specified : {protonation}. Must be either "None" or "GypsumDL".')
-    elif conformers == 'GypsumDL':
-        if protonation == 'GypsumDL':
-            generate_conformers_GypsumDL_withprotonation(standardized_sdf, output_dir, software, ncpus)
-        elif protonation == 'None':
-            generate_conformers_GypsumDL_noprotonation(standardized_sdf, output_dir, software, ncpus)
-        else:
-            raise ValueError(f'Invalid protonation method specified : {protonation}. Must be either "None" or "GypsumDL".')
+    if deduplicate:
+        pd.DataFrame(duplicates, columns=['ID', 'Representative ID']).to_csv(output_dir / 'duplicate_map.csv', index=False)
     else:
-        raise ValueError(f'Invalid conformer method specified : {conformers}. Must be either "RDKit", "MMFF" or "GypsumDL".')
+        (output_dir / 'duplicate_map.csv').unlink(missing_ok=True)
 
     cleanup(input_sdf, output_dir)
     return
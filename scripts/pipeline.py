@@ -0,0 +1,212 @@
+import concurrent.futures
+import hashlib
+import json
+import shutil
+import threading
+import time
+import traceback
+import warnings
+from pathlib import Path
+
+from scripts.profiling import profile_stage
+from scripts.telemetry import count_records, measure
+from scripts.utilities import printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Name of the file, in the working directory, recording the key and the outputs of each completed stage
+STATE_FILE = '.dockm8_stages.json'
+
+
+class Stage:
+    """
+    A step of the pipeline. The stage key is a hash of its parameters and of the content of its input files, so the stage
+    is skipped when neither changed since it last completed and its outputs are still there.
+
+    Args:
+        name (str): The unique name of the stage.
+        function (function): The function running the stage, called as function(results) where results holds the return values of the stages run so far.
+        inputs (list): The files the stage reads (e.g. the outputs of upstream stages).
+        outputs (list): The files the stage writes. A stage without outputs is always run.
+        params (dict): The parameters of the stage, must be JSON serializable (non-serializable values are hashed by their string).
+        depends (list): The names of the stages that must complete first.
+        cpus (int): The number of CPUs the stage uses, counted against the CPU budget of the pipeline.
+        clean (list): Files or folders deleted before the stage runs, in addition to its outputs (e.g. folders the stage function skips if present).
+        optional (bool): Whether the stages depending on this stage still run if it fails.
+    """
+    def __init__(self, name, function, inputs=(), outputs=(), params=None, depends=(), cpus=1, clean=(), optional=False):
+        self.name = name
+        self.function = function
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.params = params or {}
+        self.depends = list(depends)
+        self.cpus = max(1, int(cpus))
+        self.clean = [Path(path) for path in clean]
+        self.optional = optional
+
+
+class Pipeline:
+    """
+    Runs a DAG of stages. Stages whose dependencies are complete run concurrently in threads, as long as the sum of their
+    CPUs fits in the CPU budget; each stage runs its own parallel pool with its share of the CPUs.
+
+    Args:
+        w_dir (Path): The working directory, holding the stage state file.
+        ncpus (int): The CPU budget shared by the concurrently running stages.
+    """
+    def __init__(self, w_dir, ncpus):
+        self.w_dir = Path(w_dir)
+        self.ncpus = max(1, int(ncpus))
+        self.stages = {}
+        self.state_file = self.w_dir / STATE_FILE
+        self.state = json.loads(self.state_file.read_text()) if self.state_file.is_file() else {}
+        self.state.setdefault('stages', {})
+        self.state.setdefault('files', {})
+        self.lock = threading.Lock()
+
+    def add(self, name, function, **kwargs) -> str:
+        """
+        Adds a stage (see Stage for the arguments) and returns its name.
+        """
+        if name in self.stages:
+            raise ValueError(f'Duplicate pipeline stage : {name}')
+        unknown = [dependency for dependency in kwargs.get('depends', []) if dependency not in self.stages]
+        if unknown:
+            raise ValueError(f'Pipeline stage {name} depends on unknown stage(s) : {", ".join(unknown)}')
+        self.stages[name] = Stage(name, function, **kwargs)
+        return name
+
+    def file_digest(self, path: Path) -> str:
+        """
+        Returns the SHA-1 of a file's content. Digests are memoized by size and modification time, so unchanged files are not read again.
+        """
+        path = Path(path)
+        if not path.is_file():
+            return None
+        stat = path.stat()
+        key = str(path.resolve())
+        with self.lock:
+            cached = self.state['files'].get(key)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.state['files'][key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def stage_key(self, stage: Stage) -> str:
+        """
+        Returns the hash of the parameters, the input file contents and the dependencies of a stage.
+        """
+        payload = {'params': stage.params,
+                   'inputs': {str(path): self.file_digest(path) for path in stage.inputs},
+                   'depends': sorted(stage.depends)}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def outputs_unchanged(self, stage: Stage, record: dict) -> bool:
+        """
+        Checks that the outputs of a stage are still those written when it completed.
+        """
+        for path in stage.outputs:
+            if not path.is_file() or self.file_digest(path) != record.get('outputs', {}).get(str(path)):
+                return False
+        return True
+
+    def save_state(self):
+        with self.lock:
+            tmp_file = self.state_file.with_suffix('.tmp')
+            tmp_file.write_text(json.dumps(self.state, indent=1))
+            tmp_file.replace(self.state_file)
+
+    def record(self, stage: Stage, key: str):
+        outputs = {str(path): self.file_digest(path) for path in stage.outputs}
+        with self.lock:
+            self.state['stages'][stage.name] = {'key': key, 'outputs': outputs}
+        self.save_state()
+
+    def run_stage(self, stage: Stage, results: dict):
+        """
+        Runs a stage unless its key and outputs are unchanged.
+
+        Returns:
+            tuple: The status of the stage ('skipped' or 'done') and the return value of its function.
+        """
+        key = self.stage_key(stage)
+        record = self.state['stages'].get(stage.name)
+        if stage.outputs:
+            if record and record['key'] == key and self.outputs_unchanged(stage, record):
+                printlog(f'Stage {stage.name} is up to date, skipping...')
+                return 'skipped', None
+            if record is None and all(path.is_file() for path in stage.outputs):
+                # Outputs of a run made before stages were recorded
+                printlog(f'Stage {stage.name}: using the existing outputs...')
+                self.record(stage, key)
+                return 'skipped', None
+        for path in stage.outputs + stage.clean:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            elif path.exists():
+                path.unlink()
+        printlog(f'Running stage {stage.name}...')
+        tic = time.perf_counter()
+        with measure('stage', stage.name) as metrics, profile_stage(stage.name):
+            result = stage.function(results)
+            missing = [str(path) for path in stage.outputs if not path.is_file()]
+            if missing:
+                raise RuntimeError(f'Stage {stage.name} did not write : {", ".join(missing)}')
+            # Items processed: the records of the SDF outputs (compounds or poses)
+            sdf_outputs = [path for path in stage.outputs if path.suffix == '.sdf']
+            metrics['items'] = sum(count_records(path) for path in sdf_outputs) if sdf_outputs else None
+        self.record(stage, key)
+        toc = time.perf_counter()
+        printlog(f'Stage {stage.name} finished in {toc - tic:0.4f}!')
+        return 'done', result
+
+    def run(self) -> dict:
+        """
+        Runs all the stages in dependency order. Stages depending on a failed stage are not run, unless that stage is optional.
+
+        Returns:
+            dict: The status of each stage ('done', 'skipped', 'failed' or 'not run').
+        """
+        tic = time.perf_counter()
+        pending = dict(self.stages)
+        status = {}
+        results = {}
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(status.get(dependency) in ['failed', 'not run'] and not self.stages[dependency].optional for dependency in stage.depends):
+                        printlog(f'Stage {name} not run: an upstream stage failed.')
+                        status[name] = 'not run'
+                        del pending[name]
+                # Start the ready stages, in insertion order, while the CPU budget allows (a single stage may use the whole budget)
+                for name, stage in list(pending.items()):
+                    if not all(dependency in status for dependency in stage.depends):
+                        continue
+                    used_cpus = sum(self.stages[running_name].cpus for running_name in running.values())
+                    if running and used_cpus + stage.cpus > self.ncpus:
+                        continue
+                    running[executor.submit(self.run_stage, stage, results)] = name
+                    del pending[name]
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name], results[name] = future.result()
+                    except Exception:
+                        printlog(f'ERROR: Stage {name} failed!')
+                        printlog(traceback.format_exc())
+                        status[name] = 'failed'
+        toc = time.perf_counter()
+        counts = {value: list(status.values()).count(value) for value in ['done', 'skipped', 'failed', 'not run']}
+        printlog(f'Pipeline finished in {toc - tic:0.4f}: ' + ', '.join(f'{count} {value}' for value, count in counts.items() if count))
+        return status
@@ -0,0 +1,151 @@
+import concurrent.futures
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from posebusters import PoseBusters
+from rdkit import Chem, RDLogger
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+from yaml import safe_load
+
+from scripts.profiling import profiled
+from scripts.utilities import printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+POSEBUSTERS_CONFIG = Path(__file__).resolve().parent / 'posebusters_config.yml'
+
+# PoseBusters checks a pose has to pass to be kept
+POSEBUSTERS_CHECKS = ['all_atoms_connected', 'bond_lengths', 'bond_angles', 'internal_steric_clash', 'aromatic_ring_flatness', 'double_bond_flatness', 'protein-ligand_maximum_distance']
+
+
+def load_protein_heavy_atoms(protein_file: Path) -> np.ndarray:
+    """
+    Returns the coordinates of the heavy atoms of the protein residues (waters and hetero groups are excluded).
+    """
+    protein = Chem.MolFromPDBFile(str(protein_file), sanitize=False, removeHs=False, proximityBonding=False)
+    positions = protein.GetConformer().GetPositions()
+    keep = [atom.GetAtomicNum() > 1 and not atom.GetPDBResidueInfo().GetIsHeteroAtom() for atom in protein.GetAtoms()]
+    return positions[np.array(keep, dtype=bool)]
+
+
+def prefilter_poses(molecules: list, protein_file: Path, max_distance: float = 5.0, bond_tolerance: float = 0.35) -> np.ndarray:
+    """
+    Cheap vectorized geometry checks used to discard obviously broken poses before running PoseBusters.
+    Only checks matching POSEBUSTERS_CHECKS are run (protein-ligand maximum distance and bond lengths), with thresholds deliberately looser than
+    the PoseBusters ones so that no pose that PoseBusters would accept is removed.
+
+    Args:
+        molecules (list): The RDKit molecules of the poses.
+        protein_file (Path): The path to the protein file.
+        max_distance (float): Maximum allowed distance (A) between the ligand and the closest protein heavy atom.
+        bond_tolerance (float): Allowed relative deviation of bond lengths from the sum of the covalent radii.
+
+    Returns:
+        np.ndarray: A boolean mask, True for the poses passing all checks.
+    """
+    periodic_table = Chem.GetPeriodicTable()
+    tree = cKDTree(load_protein_heavy_atoms(protein_file))
+    n_poses = len(molecules)
+    heavy_coords, heavy_owner = [], []
+    bond_lengths, bond_references, bond_owner = [], [], []
+    for i, mol in enumerate(molecules):
+        positions = mol.GetConformer().GetPositions()
+        atomic_numbers = np.array([atom.GetAtomicNum() for atom in mol.GetAtoms()])
+        heavy = atomic_numbers > 1
+        heavy_coords.append(positions[heavy])
+        heavy_owner.append(np.full(heavy.sum(), i))
+        if mol.GetNumBonds():
+            bonds = np.array([(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in mol.GetBonds()])
+            radii = np.array([periodic_table.GetRcovalent(int(n)) for n in atomic_numbers])
+            bond_lengths.append(np.linalg.norm(positions[bonds[:, 0]] - positions[bonds[:, 1]], axis=1))
+            bond_references.append(radii[bonds[:, 0]] + radii[bonds[:, 1]])
+            bond_owner.append(np.full(len(bonds), i))
+    # Protein-ligand distances: one KD-tree query for the heavy atoms of all poses
+    nearest = np.full(n_poses, np.inf)
+    if heavy_coords:
+        distances, _ = tree.query(np.concatenate(heavy_coords))
+        np.minimum.at(nearest, np.concatenate(heavy_owner), distances)
+    passed = nearest <= max_distance
+    # Bond lengths compared to the sum of the covalent radii of the bonded atoms
+    if bond_lengths:
+        ratios = np.concatenate(bond_lengths) / np.concatenate(bond_references)
+        bad_bond = (ratios < 1 - bond_tolerance) | (ratios > 1 + bond_tolerance)
+        bad_pose = np.zeros(n_poses, dtype=bool)
+        bad_pose[np.concatenate(bond_owner)[bad_bond]] = True
+        passed &= ~bad_pose
+    return passed
+
+
+# PoseBusters instance and receptor kept resident in each worker process
+_BUSTER = None
+_PROTEIN = None
+
+
+def _init_buster_worker(config_file: Path, protein_file: Path):
+    """
+    Initializes a PoseBusters worker process: reads the configuration and loads the receptor once.
+    """
+    global _BUSTER, _PROTEIN
+    RDLogger.DisableLog('rdApp.*')
+    config = safe_load(open(config_file))
+    # Parallelism is handled by DockM8, keep PoseBusters single-process
+    config['max_workers'] = 0
+    _BUSTER = PoseBusters(config=config)
+    _PROTEIN = Chem.MolFromPDBFile(str(protein_file), sanitize=False, removeHs=False, proximityBonding=False)
+
+
+def _bust_shard(poses: list) -> list:
+    """
+    Runs the PoseBusters checks on a shard of (Pose ID, molecule) pairs.
+
+    Returns:
+        list: The Pose IDs of the poses passing all the checks in POSEBUSTERS_CHECKS.
+    """
+    molecules = []
+    for pose_id, mol in poses:
+        mol.SetProp('_Name', pose_id)
+        molecules.append(mol)
+    df = _BUSTER.bust_table(pd.DataFrame({'mol_pred': molecules, 'mol_cond': [_PROTEIN] * len(molecules)}))
+    # Missing results are not counted as failures, only explicit False values are
+    passed = ~df[POSEBUSTERS_CHECKS].eq(False).any(axis=1)
+    return list(df.index.get_level_values('molecule')[passed.to_numpy()])
+
+
+def validate_poses(all_poses: pd.DataFrame, protein_file: Path, ncpus: int) -> pd.DataFrame:
+    """
+    Removes problematic poses: runs the vectorized pre-filter and then the full PoseBusters checks, sharded across ncpus workers.
+
+    Args:
+        all_poses (pd.DataFrame): The poses, with 'Pose ID' and 'Molecule' columns.
+        protein_file (Path): The path to the protein file.
+        ncpus (int): The number of CPUs to use.
+
+    Returns:
+        pd.DataFrame: The poses passing all the checks.
+    """
+    tic = time.perf_counter()
+    printlog("Busting poses...")
+    prefiltered = all_poses[prefilter_poses(all_poses['Molecule'].tolist(), protein_file)]
+    printlog(f'Pre-filter removed {len(all_poses) - len(prefiltered)} of {len(all_poses)} poses in {time.perf_counter() - tic:.2f} seconds.')
+    poses = list(zip(prefiltered['Pose ID'], prefiltered['Molecule']))
+    shard_size = max(1, len(poses) // (ncpus * 4))
+    shards = [poses[i:i + shard_size] for i in range(0, len(poses), shard_size)]
+    valid_ids = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus,
+                                                initializer=_init_buster_worker,
+                                                initargs=(POSEBUSTERS_CONFIG, protein_file)) as executor:
+        jobs = [executor.submit(profiled(_bust_shard), shard) for shard in shards]
+        for job in tqdm(concurrent.futures.as_completed(jobs), total=len(jobs), desc='Busting poses'):
+            try:
+                valid_ids.update(job.result())
+            except Exception as e:
+                printlog(f'ERROR: PoseBusters failed on a shard of poses: {e}')
+    validated = prefiltered[prefiltered['Pose ID'].isin(valid_ids)]
+    toc = time.perf_counter()
+    printlog(f'PoseBusters removed {len(prefiltered) - len(validated)} of {len(prefiltered)} poses, checking completed in {toc - tic:.2f} seconds.')
+    return validated
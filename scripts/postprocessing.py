@@ -64,6 +64,60 @@ def rank_scores(df):
     df = df.assign(**{col: df[col].rank(method='average', ascending=False) for col in df.columns if col not in ['Pose ID', 'ID']})
     return df
 
+def fan_out_duplicates(df: pd.DataFrame, w_dir: Path) -> pd.DataFrame:
+    """
+    Copies the results of each compound to the duplicates that were removed from the library during preparation (listed in duplicate_map.csv).
+
+    Args:
+    df (pd.DataFrame): The results, with an 'ID' column.
+    w_dir (Path): The working directory.
+
+    Returns:
+    pd.DataFrame: The results with one row for every original ID.
+    """
+    duplicate_map_file = Path(w_dir) / 'duplicate_map.csv'
+    if not duplicate_map_file.is_file():
+        return df
+    duplicate_map = pd.read_csv(duplicate_map_file, dtype=str)
+    if duplicate_map.empty:
+        return df
+    duplicates = pd.merge(duplicate_map, df.rename(columns={'ID': 'Representative ID'}), on='Representative ID', how='inner').drop(columns='Representative ID')
+    return pd.concat([df, duplicates], ignore_index=True).sort_values(by='ID')
+
+def consensus_tables(rescored_dataframe: pd.DataFrame, standardization_type: str):
+    """
+    Returns the standardized and the ranked scores of rescored poses, with an added 'ID' column, as used by the consensus methods.
+    """
+    # Standardize the scores and add the 'ID' column
+    standardized_dataframe = standardize_scores(rescored_dataframe, standardization_type)
+    standardized_dataframe['ID'] = standardized_dataframe['Pose ID'].str.split('_').str[0]
+    # Rank the scores and add the 'ID' column
+    ranked_dataframe = rank_scores(standardized_dataframe)
+    ranked_dataframe['ID'] = ranked_dataframe['Pose ID'].str.split('_').str[0]
+    return standardized_dataframe, ranked_dataframe
+
+def calculate_consensus(standardized_dataframe: pd.DataFrame, ranked_dataframe: pd.DataFrame, selection_method: str, consensus_method: str) -> pd.DataFrame:
+    """
+    Applies a consensus method to the standardized or ranked scores (see consensus_tables).
+
+    Returns:
+    pd.DataFrame: The consensus score of each compound, with columns 'ID' and '{consensus_method}_{selection_method}'.
+    """
+    # Check if consensus_method is valid
+    if consensus_method not in CONSENSUS_METHODS:
+        raise ValueError(f"Invalid consensus method: {consensus_method}")
+    # Get the method information from the dictionary
+    conensus_info = CONSENSUS_METHODS[consensus_method]
+    conensus_type = conensus_info['type']
+    conensus_function = conensus_info['function']
+    # Apply the selected consensus method to the data
+    if conensus_type == 'rank':
+        return conensus_function(ranked_dataframe, selection_method, [col for col in ranked_dataframe.columns if col not in ['Pose ID', 'ID']])
+    elif conensus_type == 'score':
+        return conensus_function(standardized_dataframe, selection_method, [col for col in standardized_dataframe.columns if col not in ['Pose ID', 'ID']])
+    else:
+        raise ValueError(f"Invalid consensus method type: {conensus_type}")
+
 def apply_consensus_methods(w_dir : str, selection_method : str, consensus_methods : str, rescoring_functions : list, standardization_type : str):
     """
     Applies consensus methods to rescored data and saves the results to a CSV file.
@@ -88,32 +142,14 @@ def apply_consensus_methods(w_dir : str, selection_method : str, consensus_metho
         # Read the rescored data from the CSV file
         rescoring_folder = f'rescoring_{selection_method}_clustered'
         rescored_dataframe = pd.read_csv(Path(w_dir) / rescoring_folder / 'allposes_rescored.csv')
-        # Standardize the scores and add the 'ID' column
-        standardized_dataframe = standardize_scores(rescored_dataframe, standardization_type)
-        standardized_dataframe['ID'] = standardized_dataframe['Pose ID'].str.split('_').str[0]
-        # Rank the scores and add the 'ID' column
-        ranked_dataframe = rank_scores(standardized_dataframe)
-        ranked_dataframe['ID'] = ranked_dataframe['Pose ID'].str.split('_').str[0]
+        standardized_dataframe, ranked_dataframe = consensus_tables(rescored_dataframe, standardization_type)
         # Ensure consensus_methods is a list even if it's a single string
         if isinstance(consensus_methods, str):
             consensus_methods = [consensus_methods]
         for consensus_method in consensus_methods:
             # Create the 'consensus' directory if it doesn't exist
             (Path(w_dir) / 'consensus').mkdir(parents=True, exist_ok=True)
-            # Check if consensus_method is valid
-            if consensus_method not in CONSENSUS_METHODS:
-                raise ValueError(f"Invalid consensus method: {consensus_method}")
-            # Get the method information from the dictionary
-            conensus_info = CONSENSUS_METHODS[consensus_method]
-            conensus_type = conensus_info['type']
-            conensus_function = conensus_info['function']
-            # Apply the selected consensus method to the data
-            if conensus_type == 'rank':
-                consensus_dataframe = conensus_function(ranked_dataframe, selection_method, [col for col in ranked_dataframe.columns if col not in ['Pose ID', 'ID']])
-            elif conensus_type == 'score':
-                consensus_dataframe = conensus_function(standardized_dataframe, selection_method, [col for col in standardized_dataframe.columns if col not in ['Pose ID', 'ID']])
-            else:
-                raise ValueError(f"Invalid consensus method type: {conensus_type}")
+            consensus_dataframe = calculate_consensus(standardized_dataframe, ranked_dataframe, selection_method, consensus_method)
             # Drop the 'Pose ID' column and save the consensus results to a CSV file
             consensus_dataframe = consensus_dataframe.drop(columns="Pose ID", errors='ignore')
             consensus_dataframe = consensus_dataframe.sort_values(by='ID')
@@ -123,8 +159,10 @@ def apply_consensus_methods(w_dir : str, selection_method : str, consensus_metho
                 poses['ID'] = poses['Pose ID'].str.split('_').str[0]
                 poses = poses[['ID', 'Molecule']]
                 consensus_dataframe = pd.merge(consensus_dataframe, poses, on='ID', how='left')
+                consensus_dataframe = fan_out_duplicates(consensus_dataframe, w_dir)
                 PandasTools.WriteSDF(consensus_dataframe, str(w_dir / 'consensus' / f'{selection_method}_{consensus_method}_results.sdf'), molColName='Molecule', idName='ID', properties=list(consensus_dataframe.columns))
             else:
+                consensus_dataframe = fan_out_duplicates(consensus_dataframe, w_dir)
                 consensus_dataframe.to_csv(Path(w_dir) / 'consensus' / f'{selection_method}_{consensus_method}_results.csv', index=False)
         return
 
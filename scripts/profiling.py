@@ -0,0 +1,146 @@
+import contextlib
+import cProfile
+import itertools
+import multiprocessing.util
+import os
+import pstats
+import re
+import threading
+import time
+import warnings
+from pathlib import Path
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Profiling is enabled by setting DOCKM8_PROFILE_DIR (inherited by the pool workers). Each process writes its cProfile statistics to
+# <DOCKM8_PROFILE_DIR>/<stage>/, aggregate_profiles then merges them into one file per stage.
+
+_CURRENT_STAGE = threading.local()
+# Profiler of each stage in this worker process, accumulating the statistics of all the tasks the process runs for the stage
+_WORKER_PROFILERS = {}
+# Process owning _WORKER_PROFILERS (forked workers start with their own) and time of its last profile dump
+_WORKER_STATE = {'pid': None, 'last_dump': 0.0}
+# Minimum number of seconds between two dumps of the profiles of a worker, they are also dumped when the worker exits
+DUMP_INTERVAL = 30
+# Numbers the profiles of the main process, which may profile the same stage several times (e.g. in several threads)
+_MAIN_PROFILES = itertools.count()
+
+
+def profile_dir() -> Path:
+    """
+    Returns the profile folder, or None if profiling is not enabled.
+    """
+    return Path(os.environ['DOCKM8_PROFILE_DIR']) if os.environ.get('DOCKM8_PROFILE_DIR') else None
+
+
+def current_stage() -> str:
+    """
+    Returns the stage being run by this thread, used to attribute the profiles of the tasks it sends to the pool workers.
+    """
+    return getattr(_CURRENT_STAGE, 'name', 'dockm8')
+
+
+def stage_file(stage: str, name: str) -> Path:
+    """
+    Returns the path of a profile of the given stage, creating the stage folder if needed.
+    """
+    folder = profile_dir() / re.sub(r'[^\w.-]', '_', stage)
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder / f'{name}.prof'
+
+
+@contextlib.contextmanager
+def profile_stage(stage: str):
+    """
+    Runs a block as the given stage: tasks sent to the pool workers from this thread are attributed to the stage,
+    and if profiling is enabled the block itself is profiled (cProfile profiles the calling thread only).
+    """
+    previous = getattr(_CURRENT_STAGE, 'name', None)
+    _CURRENT_STAGE.name = stage
+    profiler = cProfile.Profile() if profile_dir() else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(stage_file(stage, f'main-{os.getpid()}-{next(_MAIN_PROFILES)}'))
+        _CURRENT_STAGE.name = previous
+
+
+def dump_worker_profiles():
+    """
+    Writes the profiles accumulated by this worker process.
+    """
+    for stage, profiler in _WORKER_PROFILERS.items():
+        profiler.dump_stats(stage_file(stage, f'worker-{os.getpid()}'))
+    _WORKER_STATE['last_dump'] = time.monotonic()
+
+
+def _worker_profiler(stage: str) -> cProfile.Profile:
+    """
+    Returns the profiler of a stage in this worker process. On first use in a process, the profiles are set to be dumped when the worker exits
+    (pool workers skip atexit handlers, but run multiprocessing finalizers when they are shut down).
+    """
+    if _WORKER_STATE['pid'] != os.getpid():
+        _WORKER_PROFILERS.clear()
+        _WORKER_STATE.update(pid=os.getpid(), last_dump=time.monotonic())
+        multiprocessing.util.Finalize(None, dump_worker_profiles, exitpriority=10)
+    return _WORKER_PROFILERS.setdefault(stage, cProfile.Profile())
+
+
+class ProfiledFunction:
+    """
+    Picklable wrapper profiling a function in the pool workers. The statistics of all the calls made by a worker for a stage are
+    accumulated, and written every DUMP_INTERVAL seconds and when the worker exits (the periodic dumps keep the profiles of workers that are killed).
+    """
+    def __init__(self, function, stage: str):
+        self.function = function
+        self.stage = stage
+        self.__name__ = getattr(function, '__name__', 'function')
+
+    def __call__(self, *args, **kwargs):
+        if profile_dir() is None:
+            # Distributed worker started without profiling
+            return self.function(*args, **kwargs)
+        profiler = _worker_profiler(self.stage)
+        profiler.enable()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            if time.monotonic() - _WORKER_STATE['last_dump'] > DUMP_INTERVAL:
+                dump_worker_profiles()
+
+
+def profiled(function):
+    """
+    Returns the function to send to the pool workers: wrapped to profile it in the workers if profiling is enabled, unchanged otherwise.
+    """
+    if profile_dir() is None or isinstance(function, ProfiledFunction):
+        return function
+    return ProfiledFunction(function, current_stage())
+
+
+def aggregate_profiles(folder: Path, top: int = 30):
+    """
+    Merges the profiles of the main process and of the workers into one file per stage (<stage>.prof) and for the whole run (all_stages.prof),
+    in the pstats format read by flame graph and call graph tools (e.g. flameprof, snakeviz, tuna, gprof2dot), and writes the functions with the
+    highest cumulative time of each stage to profile_summary.txt.
+    """
+    folder = Path(folder)
+    merged = []
+    with open(folder / 'profile_summary.txt', 'w') as summary:
+        for stage_folder in sorted(path for path in folder.iterdir() if path.is_dir()):
+            profiles = [str(path) for path in sorted(stage_folder.glob('*.prof'))]
+            if not profiles:
+                continue
+            stats = pstats.Stats(*profiles, stream=summary)
+            stats.dump_stats(folder / f'{stage_folder.name}.prof')
+            merged.extend(profiles)
+            summary.write(f'=== {stage_folder.name} ({len(profiles)} processes) ===\n')
+            stats.sort_stats('cumulative').print_stats(top)
+    if merged:
+        pstats.Stats(*merged).dump_stats(folder / 'all_stages.prof')
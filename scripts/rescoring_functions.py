@@ -1,4 +1,6 @@
+import concurrent.futures
 import os
+import shutil
 import subprocess
 import time
 import warnings
@@ -6,17 +8,31 @@ from pathlib import Path
 from subprocess import DEVNULL, STDOUT
 from typing import List
 
+import numpy as np
 import pandas as pd
+from oddt import toolkit as oddt_toolkit
+from oddt.scoring import scorer as oddt_scorer
+from meeko import MoleculePreparation, PDBQTWriterLegacy
 from pandas import DataFrame
-from rdkit import RDLogger
+from rdkit import Chem, RDLogger
 from rdkit.Chem import PandasTools
 from tqdm import tqdm
+from vina import Vina
 
+from scripts.artifact_cache import (
+    get_receptor_artifact,
+    ligand_cache_folder,
+    prepare_ligand_cache,
+    write_cached_mol2,
+)
+from scripts.profiling import profiled
+from scripts.scoring_server import get_scoring_server
+from scripts.telemetry import count_records, measure
 from scripts.utilities import (
-    convert_molecules,
     delete_files,
     parallel_executor,
     printlog,
+    read_sdf_properties,
     split_sdf_str,
 )
 
@@ -121,6 +137,93 @@ def gnina_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     return gnina_rescoring_results
 
 
+# Vina scoring function with the receptor maps kept resident in each worker process
+_VINA_SCORER = None
+
+
+def _init_vina_worker(receptor_pdbqt: Path, scoring_function: str, pocket_definition: dict):
+    """
+    Initializes a Vina worker process: loads the receptor and computes the grid maps of the pocket once.
+    """
+    global _VINA_SCORER
+    RDLogger.DisableLog('rdApp.*')
+    _VINA_SCORER = Vina(sf_name=scoring_function, cpu=1, verbosity=0)
+    _VINA_SCORER.set_receptor(str(receptor_pdbqt))
+    _VINA_SCORER.compute_vina_maps(center=list(pocket_definition['center']), box_size=list(pocket_definition['size']))
+
+
+def _vina_score_split(split_file: Path):
+    """
+    Computes the score-only energy of the poses of a split SDF file with the Vina scorer loaded in the current worker.
+
+    Returns:
+        tuple: The pose IDs and a numpy array with their scores (NaN for poses that could not be prepared).
+    """
+    preparator = MoleculePreparation()
+    pose_ids = []
+    scores = []
+    for mol in Chem.SDMolSupplier(str(split_file), removeHs=False):
+        if mol is None:
+            continue
+        pose_ids.append(mol.GetProp('_Name'))
+        try:
+            setup_list = preparator.prepare(Chem.AddHs(mol, addCoords=True))
+            pdbqt_string = PDBQTWriterLegacy.write_string(setup_list[0])[0]
+            _VINA_SCORER.set_ligand_from_string(pdbqt_string)
+            scores.append(_VINA_SCORER.score()[0])
+        except Exception as e:
+            printlog(f'ERROR: Could not score pose {pose_ids[-1]}: {e}')
+            scores.append(np.nan)
+    return pose_ids, np.asarray(scores, dtype=float)
+
+
+def vina_rescoring(sdf: str, ncpus: int, column_name: str, scoring_function: str, **kwargs) -> DataFrame:
+    """
+    Rescores poses in-process with the Vina python bindings (score only).
+    The receptor is converted to pdbqt once and each worker process computes the grid maps once, then scores its share of the splits.
+
+    Args:
+        sdf (str): The path to the input SDF file containing the poses to be rescored.
+        ncpus (int): The number of CPUs to be used for the rescoring process.
+        column_name (str): The name of the column in the output dataframe to store the scores.
+        scoring_function (str): The Vina scoring function to use ('vina' or 'vinardo').
+        **kwargs: Additional keyword arguments (rescoring_folder, protein_file, pocket_definition).
+
+    Returns:
+        DataFrame: A dataframe containing the 'Pose ID' and score columns for the rescored poses.
+    """
+    rescoring_folder = kwargs.get('rescoring_folder')
+    protein_file = kwargs.get('protein_file')
+    pocket_definition = kwargs.get('pocket_definition')
+
+    tic = time.perf_counter()
+    vina_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
+    vina_rescoring_folder.mkdir(parents=True, exist_ok=True)
+    receptor_pdbqt = get_receptor_artifact(protein_file, 'pdbqt')
+    split_files_folder = split_sdf_str(vina_rescoring_folder, sdf, ncpus)
+    split_files_sdfs = [split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
+    pose_ids = []
+    scores = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus,
+                                                initializer=_init_vina_worker,
+                                                initargs=(receptor_pdbqt, scoring_function, pocket_definition)) as executor:
+        jobs = [executor.submit(profiled(_vina_score_split), split_file) for split_file in split_files_sdfs]
+        for job in tqdm(concurrent.futures.as_completed(jobs), total=len(jobs), desc=f'Rescoring with {column_name}'):
+            try:
+                ids, values = job.result()
+            except Exception as e:
+                printlog(f'{column_name} rescoring of a split failed: {e}')
+                continue
+            pose_ids.extend(ids)
+            scores.append(values)
+    df = pd.DataFrame({'Pose ID': pose_ids, column_name: np.concatenate(scores) if scores else []})
+    df.to_csv(vina_rescoring_folder / f'{column_name}_scores.csv', index=False)
+    delete_files(vina_rescoring_folder, f'{column_name}_scores.csv')
+    toc = time.perf_counter()
+    printlog(f'Rescoring with {column_name} complete in {toc-tic:0.4f}!')
+    return df
+
+
 def vinardo_rescoring(sdf: str, ncpus: int, column_name: str,
                       **kwargs) -> DataFrame:
     """
@@ -134,99 +237,90 @@ def vinardo_rescoring(sdf: str, ncpus: int, column_name: str,
 
     Keyword Args:
         rescoring_folder (str): The path to the folder for storing the Vinardo rescoring results.
-        software (str): The path to the gnina software.
         protein_file (str): The path to the protein file.
         pocket_definition (dict): The pocket definition.
 
     Returns:
         DataFrame: A dataframe containing the 'Pose ID' and Vinardo score columns for the rescored poses.
     """
-    tic = time.perf_counter()
-
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-    pocket_definition = kwargs.get('pocket_definition')
-
-    split_files_folder = split_sdf_str(
-        rescoring_folder / f'{column_name}_rescoring', sdf, ncpus)
-    split_files_sdfs = [
-        split_files_folder / f for f in os.listdir(split_files_folder)
-        if f.endswith('.sdf')
-    ]
+    return vina_rescoring(sdf, ncpus, column_name, 'vinardo', **kwargs)
 
-    vinardo_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
-    vinardo_rescoring_folder.mkdir(parents=True, exist_ok=True)
-
-    global vinardo_rescoring_splitted
-
-    def vinardo_rescoring_splitted(split_file, protein_file,
-                                   pocket_definition):
-        vinardo_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
-        results = vinardo_rescoring_folder / f'{Path(split_file).stem}_{column_name}.sdf'
-        vinardo_cmd = (f"{software}/gnina"
-                       f" --receptor {protein_file}"
-                       f" --ligand {split_file}"
-                       f" --out {results}"
-                       f" --center_x {pocket_definition['center'][0]}"
-                       f" --center_y {pocket_definition['center'][1]}"
-                       f" --center_z {pocket_definition['center'][2]}"
-                       f" --size_x {pocket_definition['size'][0]}"
-                       f" --size_y {pocket_definition['size'][1]}"
-                       f" --size_z {pocket_definition['size'][2]}"
-                       " --score_only"
-                       " --scoring vinardo"
-                       " --cnn_scoring none")
-        try:
-            subprocess.call(
-                vinardo_cmd,
-                shell=True,
-                stdout=DEVNULL,
-                stderr=STDOUT,
-            )
-        except Exception as e:
-            printlog(f'{column_name} rescoring failed: ' + e)
-        return
 
-    parallel_executor(vinardo_rescoring_splitted,
-                      split_files_sdfs,
-                      ncpus,
-                      protein_file=protein_file,
-                      pocket_definition=pocket_definition)
+def score_only_splitted(split_file: Path, executable: str, scoring_function: str, protein_file: Path, pocket_definition: dict) -> DataFrame:
+    """
+    Runs a smina-type binary (gnina, smina) in score-only mode on a split SDF file.
 
+    Returns:
+        DataFrame: The 'Pose ID' and 'minimizedAffinity' of the poses, read from the output SDF headers.
+    """
+    results = split_file.parent.parent / f'{split_file.stem}_{scoring_function}.sdf'
+    score_only_cmd = (f'{executable}'
+                      f' --receptor {protein_file}'
+                      f' --ligand {split_file}'
+                      f' --out {results}'
+                      f' --center_x {pocket_definition["center"][0]}'
+                      f' --center_y {pocket_definition["center"][1]}'
+                      f' --center_z {pocket_definition["center"][2]}'
+                      f' --size_x {pocket_definition["size"][0]}'
+                      f' --size_y {pocket_definition["size"][1]}'
+                      f' --size_z {pocket_definition["size"][2]}'
+                      ' --cpu 1'
+                      f' --scoring {scoring_function}'
+                      ' --score_only')
+    if Path(executable).name == 'gnina':
+        score_only_cmd += ' --cnn_scoring none'
     try:
-        vinardo_dataframes = [
-            PandasTools.LoadSDF(str(rescoring_folder /
-                                    f'{column_name}_rescoring' / file),
-                                idName='Pose ID',
-                                molColName=None,
-                                includeFingerprints=False,
-                                embedProps=False,
-                                removeHs=False,
-                                strictParsing=True)
-            for file in os.listdir(rescoring_folder /
-                                   f'{column_name}_rescoring')
-            if file.startswith('split') and file.endswith('.sdf')
-        ]
+        subprocess.call(score_only_cmd, shell=True, stdout=DEVNULL, stderr=STDOUT)
+        return read_sdf_properties(results, ['minimizedAffinity'], idName='Pose ID')
     except Exception as e:
-        printlog(f'ERROR: Failed to Load {column_name} rescoring SDF file!')
-        printlog(e)
+        printlog(f'{scoring_function} rescoring failed: {e}')
+        return DataFrame(columns=['Pose ID', 'minimizedAffinity'])
+
+
+def score_only_rescoring(sdf: str, ncpus: int, column_name: str, executable: str, scoring_function: str, **kwargs) -> DataFrame:
+    """
+    Rescores poses with a smina-type binary in score-only mode, one process per split.
+    Scores are read directly from the output SDF headers instead of loading the output molecules.
+
+    Args:
+        sdf (str): The path to the input SDF file containing the poses to be rescored.
+        ncpus (int): The number of CPUs to be used for the rescoring process.
+        column_name (str): The name of the column in the output dataframe to store the scores.
+        executable (str): The path to the gnina or smina binary.
+        scoring_function (str): The name of the scoring function passed to --scoring.
+        **kwargs: Additional keyword arguments (rescoring_folder, protein_file, pocket_definition).
+
+    Returns:
+        DataFrame: A dataframe containing the 'Pose ID' and score columns for the rescored poses.
+    """
+    rescoring_folder = kwargs.get('rescoring_folder')
+    protein_file = kwargs.get('protein_file')
+    pocket_definition = kwargs.get('pocket_definition')
+
+    tic = time.perf_counter()
+    score_only_folder = rescoring_folder / f'{column_name}_rescoring'
+    score_only_folder.mkdir(parents=True, exist_ok=True)
+    split_files_folder = split_sdf_str(score_only_folder, sdf, ncpus)
+    split_files_sdfs = [split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
+    results = parallel_executor(score_only_splitted,
+                                split_files_sdfs,
+                                ncpus,
+                                executable=executable,
+                                scoring_function=scoring_function,
+                                protein_file=protein_file,
+                                pocket_definition=pocket_definition)
     try:
-        vinardo_rescoring_results = pd.concat(vinardo_dataframes)
+        rescoring_results = pd.concat(results, ignore_index=True)
     except Exception as e:
         printlog(f'ERROR: Could not combine {column_name} rescored poses')
         printlog(e)
-    vinardo_rescoring_results.rename(
-        columns={'minimizedAffinity': column_name}, inplace=True)
-    vinardo_rescoring_results = vinardo_rescoring_results[[
-        'Pose ID', column_name
-    ]]
-    vinardo_scores_path = vinardo_rescoring_folder / f'{column_name}_scores.csv'
-    vinardo_rescoring_results.to_csv(vinardo_scores_path, index=False)
-    delete_files(vinardo_rescoring_folder, f'{column_name}_scores.csv')
+        rescoring_results = DataFrame(columns=['Pose ID', 'minimizedAffinity'])
+    rescoring_results[column_name] = pd.to_numeric(rescoring_results.pop('minimizedAffinity'), errors='coerce')
+    rescoring_results.to_csv(score_only_folder / f'{column_name}_scores.csv', index=False)
+    delete_files(score_only_folder, f'{column_name}_scores.csv')
     toc = time.perf_counter()
-    printlog(f'Rescoring with Vinardo complete in {toc - tic:0.4f}!')
-    return vinardo_rescoring_results
+    printlog(f'Rescoring with {column_name} complete in {toc-tic:0.4f}!')
+    return rescoring_results
 
 
 def AD4_rescoring(sdf: str, ncpus: int, column_name: str,
@@ -238,100 +332,18 @@ def AD4_rescoring(sdf: str, ncpus: int, column_name: str,
         sdf (str): The path to the input SDF file containing the poses to be rescored.
         ncpus (int): The number of CPUs to be used for the rescoring process.
         column_name (str): The name of the column in the output dataframe to store the AD4 scores.
-        kwargs: Additional keyword arguments including rescoring_folder, software, protein_file, and pocket_de.
+        kwargs: Additional keyword arguments including rescoring_folder, software, protein_file, and pocket_definition.
 
     Returns:
         DataFrame: A dataframe containing the 'Pose ID' and AD4 score columns for the rescored poses.
     """
-    tic = time.perf_counter()
-
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-    pocket_definition = kwargs.get('pocket_definition')
-
-    split_files_folder = split_sdf_str(
-        rescoring_folder / f'{column_name}_rescoring', sdf, ncpus)
-    split_files_sdfs = [
-        split_files_folder / f for f in os.listdir(split_files_folder)
-        if f.endswith('.sdf')
-    ]
-
-    AD4_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
-    AD4_rescoring_folder.mkdir(parents=True, exist_ok=True)
-
-    global AD4_rescoring_splitted
-
-    def AD4_rescoring_splitted(split_file, protein_file, pocket_definition):
-        AD4_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
-        results = AD4_rescoring_folder / f'{Path(split_file).stem}_{column_name}.sdf'
-        AD4_cmd = (f"{software}/gnina"
-                   f" --receptor {protein_file}"
-                   f" --ligand {split_file}"
-                   f" --out {results}"
-                   f" --center_x {pocket_definition['center'][0]}"
-                   f" --center_y {pocket_definition['center'][1]}"
-                   f" --center_z {pocket_definition['center'][2]}"
-                   f" --size_x {pocket_definition['size'][0]}"
-                   f" --size_y {pocket_definition['size'][1]}"
-                   f" --size_z {pocket_definition['size'][2]}"
-                   " --score_only"
-                   " --scoring ad4_scoring"
-                   " --cnn_scoring none")
-        try:
-            subprocess.call(
-                AD4_cmd,
-                shell=True,
-                stdout=DEVNULL,
-                stderr=STDOUT,
-            )
-        except Exception as e:
-            printlog(f'{column_name} rescoring failed: ' + e)
-        return
-
-    parallel_executor(AD4_rescoring_splitted,
-                      split_files_sdfs,
-                      ncpus,
-                      protein_file=protein_file,
-                      pocket_definition=pocket_definition)
-
-    try:
-        AD4_dataframes = [
-            PandasTools.LoadSDF(str(rescoring_folder /
-                                    f'{column_name}_rescoring' / file),
-                                idName='Pose ID',
-                                molColName=None,
-                                includeFingerprints=False,
-                                embedProps=False,
-                                removeHs=False,
-                                strictParsing=True)
-            for file in os.listdir(rescoring_folder /
-                                   f'{column_name}_rescoring')
-            if file.startswith('split') and file.endswith('.sdf')
-        ]
-    except Exception as e:
-        printlog(f'ERROR: Failed to Load {column_name} rescoring SDF file!')
-        printlog(e)
-    try:
-        AD4_rescoring_results = pd.concat(AD4_dataframes)
-    except Exception as e:
-        printlog(f'ERROR: Could not combine {column_name} rescored poses')
-        printlog(e)
-
-    AD4_rescoring_results.rename(columns={'minimizedAffinity': column_name},
-                                 inplace=True)
-    AD4_rescoring_results = AD4_rescoring_results[['Pose ID', column_name]]
-    AD4_scores_file = AD4_rescoring_folder / f'{column_name}_scores.csv'
-    AD4_rescoring_results.to_csv(AD4_scores_file, index=False)
-    delete_files(AD4_rescoring_folder, f'{column_name}_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with AD4 complete in {toc-tic:0.4f}!')
-    return AD4_rescoring_results
+    return score_only_rescoring(sdf, ncpus, column_name, f'{kwargs.get("software")}/gnina', 'ad4_scoring', **kwargs)
 
 
 def rfscorevs_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     """
     Rescores poses in an SDF file using RFScoreVS and returns the results as a pandas DataFrame.
+    If software/models/RFScoreVS_v2.pickle exists, the poses are scored in-process with ODDT.
 
     Args:
         sdf (str): Path to the SDF file containing the poses to be rescored.
@@ -352,6 +364,11 @@ def rfscorevs_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     software = kwargs.get('software')
     protein_file = kwargs.get('protein_file')
 
+    # Score in-process when the pickled RF-Score-VS model is available, otherwise fall back to the binary
+    pickle_path = Path(f'{software}/models/RFScoreVS_v2.pickle')
+    if pickle_path.is_file():
+        return oddt_rescoring(sdf, ncpus, column_name, pickle_path, **kwargs)
+
     tic = time.perf_counter()
 
     rfscorevs_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
@@ -460,183 +477,224 @@ def rfscorevs_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     return rfscorevs_results
 
 
-def plp_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
+def plants_rescoring_splitted(split_file: Path, software: Path, protein_mol2: Path, pocket_definition: dict, scoring_function: str, ligand_cache: Path) -> Path:
     """
-    Rescores ligands using PLP scoring function.
+    Rescores the poses of a single split SDF file with PLANTS against a shared receptor mol2 file.
 
     Args:
-    sdf (str): Path to the input SDF file.
-    ncpus (int): Number of CPUs to use for docking.
-    column_name (str): Name of the column to store the PLP scores.
-    kwargs: Additional keyword arguments.
+        split_file (Path): The path to the split SDF file containing the poses to rescore.
+        software (Path): The path to the software folder containing the PLANTS binary.
+        protein_mol2 (Path): The path to the receptor in mol2 format, shared by all splits.
+        pocket_definition (dict): A dictionary containing the pocket center and size.
+        scoring_function (str): The PLANTS scoring function to use ('plp' or 'chemplp').
+        ligand_cache (Path): The path to the ligand cache folder holding the poses in mol2 format.
 
     Returns:
-    pandas.DataFrame: DataFrame containing the Pose ID and PLP scores.
+        Path: The path to the ranking.csv file written by PLANTS for this split.
     """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-    pocket_definition = kwargs.get('pocket_definition')
-
-    tic = time.perf_counter()
-
-    plants_search_speed = 'speed1'
-    ants = '20'
-    plp_rescoring_folder = Path(rescoring_folder) / f'{column_name}_rescoring'
-    plp_rescoring_folder.mkdir(parents=True, exist_ok=True)
-    # Convert protein file to .mol2 using open babel
-    plants_protein_mol2 = plp_rescoring_folder / 'protein.mol2'
-    convert_molecules(protein_file, plants_protein_mol2, 'pdb', 'mol2')
-    # Convert prepared ligand file to .mol2 using open babel
-    plants_ligands_mol2 = plp_rescoring_folder / 'ligands.mol2'
-    convert_molecules(sdf, plants_ligands_mol2, 'sdf', 'mol2')
-
-    # Generate plants config file
-    plp_rescoring_config_path_txt = plp_rescoring_folder / 'config.txt'
-    plp_config = [
-        '# search algorithm\n', 'search_speed ' + plants_search_speed + '\n',
-        'aco_ants ' + ants + '\n', 'flip_amide_bonds 0\n', 'flip_planar_n 1\n',
+    split_file = Path(split_file)
+    ligands_mol2 = write_cached_mol2(split_file, ligand_cache, split_file.with_suffix('.mol2'))
+    results_dir = split_file.parent / f'results_{split_file.stem}'
+    # PLANTS refuses to write into an existing output folder
+    shutil.rmtree(results_dir, ignore_errors=True)
+    config_path = split_file.parent / f'config_{split_file.stem}.config'
+    config = [
+        '# search algorithm\n', 'search_speed speed1\n', 'aco_ants 20\n',
+        'flip_amide_bonds 0\n', 'flip_planar_n 1\n',
         'force_flipped_bonds_planarity 0\n', 'force_planar_bond_rotation 1\n',
         'rescore_mode simplex\n', 'flip_ring_corners 0\n',
         '# scoring functions\n',
         '# Intermolecular (protein-ligand interaction scoring)\n',
-        'scoring_function plp\n', 'outside_binding_site_penalty 50.0\n',
+        f'scoring_function {scoring_function}\n', 'outside_binding_site_penalty 50.0\n',
         'enable_sulphur_acceptors 1\n', '# Intramolecular ligand scoring\n',
         'ligand_intra_score clash2\n', 'chemplp_clash_include_14 1\n',
         'chemplp_clash_include_HH 0\n', '# input\n',
-        'protein_file ' + str(plants_protein_mol2) + '\n',
-        'ligand_file ' + str(plants_ligands_mol2) + '\n', '# output\n',
-        'output_dir ' + str(plp_rescoring_folder / 'results') + '\n',
+        f'protein_file {protein_mol2}\n',
+        f'ligand_file {ligands_mol2}\n', '# output\n',
+        f'output_dir {results_dir}\n',
         '# write single mol2 files (e.g. for RMSD calculation)\n',
         'write_multi_mol2 1\n', '# binding site definition\n',
-        'bindingsite_center ' + str(pocket_definition["center"][0]) + ' ' +
-        str(pocket_definition["center"][1]) + ' ' +
-        str(pocket_definition["center"][2]) + '\n',
-        'bindingsite_radius ' + str(pocket_definition["size"][0] / 2) + '\n',
+        f'bindingsite_center {pocket_definition["center"][0]} {pocket_definition["center"][1]} {pocket_definition["center"][2]}\n',
+        f'bindingsite_radius {pocket_definition["size"][0] / 2}\n',
         '# cluster algorithm\n', 'cluster_structures 10\n',
         'cluster_rmsd 2.0\n', '# write\n', 'write_ranking_links 0\n',
-        'write_protein_bindingsite 1\n', 'write_protein_conformations 1\n',
-        'write_protein_splitted 1\n', 'write_merged_protein 0\n', '####\n'
+        'write_protein_bindingsite 0\n', 'write_protein_conformations 0\n',
+        'write_protein_splitted 0\n', 'write_merged_protein 0\n', '####\n'
     ]
-    plp_rescoring_config_path_config = plp_rescoring_config_path_txt.with_suffix(
-        '.config')
-    with plp_rescoring_config_path_config.open('w') as configwriter:
-        configwriter.writelines(plp_config)
-
-    # Run PLANTS docking
-    plp_rescoring_command = f'{software}/PLANTS --mode rescore {plp_rescoring_config_path_config}'
-    subprocess.call(
-        plp_rescoring_command,
-        shell=True,
-        stdout=DEVNULL,
-        stderr=STDOUT,
-    )
-
-    # Fetch results
-    results_csv_location = plp_rescoring_folder / 'results' / 'ranking.csv'
-    plp_results = pd.read_csv(results_csv_location, sep=',', header=0)
-    plp_results.rename(columns={'TOTAL_SCORE': column_name}, inplace=True)
-    for i, row in plp_results.iterrows():
-        split = row['LIGAND_ENTRY'].split('_')
-        plp_results.loc[i, ['Pose ID']] = f'{split[0]}_{split[1]}_{split[2]}'
-    plp_rescoring_output = plp_results[['Pose ID', column_name]]
-    plp_rescoring_output.to_csv(rescoring_folder / f'{column_name}_rescoring' /
-                                f'{column_name}_scores.csv',
-                                index=False)
-
-    # Remove files
-    plants_ligands_mol2.unlink()
-    delete_files(rescoring_folder / f'{column_name}_rescoring',
-                 f'{column_name}_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with PLP complete in {toc-tic:0.4f}!')
-    return plp_rescoring_output
+    with config_path.open('w') as configwriter:
+        configwriter.writelines(config)
+    try:
+        # Run from the split folder so that PLANTS .pid files do not collide between workers
+        subprocess.call(f'{software}/PLANTS --mode rescore {config_path}',
+                        shell=True,
+                        cwd=split_file.parent,
+                        stdout=DEVNULL,
+                        stderr=STDOUT)
+    except Exception as e:
+        printlog(f'PLANTS rescoring of {split_file.name} failed: {e}')
+    return results_dir / 'ranking.csv'
 
 
-def chemplp_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
+def plants_rescoring(sdf: str, ncpus: int, column_name: str, scoring_function: str, **kwargs) -> DataFrame:
+    """
+    Rescores poses with a PLANTS scoring function. The input SDF file is split into shards which are converted to mol2
+    and rescored in parallel against a single receptor mol2 file.
+
+    Args:
+        sdf (str): Path to the input SDF file.
+        ncpus (int): Number of CPUs to use for rescoring.
+        column_name (str): Name of the column to store the scores.
+        scoring_function (str): The PLANTS scoring function to use ('plp' or 'chemplp').
+        kwargs: Additional keyword arguments (rescoring_folder, software, protein_file, pocket_definition).
+
+    Returns:
+        pandas.DataFrame: DataFrame containing the Pose ID and the scores.
+    """
     rescoring_folder = kwargs.get('rescoring_folder')
     software = kwargs.get('software')
     protein_file = kwargs.get('protein_file')
+    pocket_definition = kwargs.get('pocket_definition')
 
     tic = time.perf_counter()
+    plants_rescoring_folder = Path(rescoring_folder) / f'{column_name}_rescoring'
+    plants_rescoring_folder.mkdir(parents=True, exist_ok=True)
+    # Receptor in .mol2 format, converted once per receptor and shared by all splits
+    plants_protein_mol2 = get_receptor_artifact(protein_file, 'mol2')
+    split_files_folder = split_sdf_str(plants_rescoring_folder, sdf, ncpus)
+    split_files_sdfs = [split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
+    # Poses converted to mol2 once are reused by PLP and CHEMPLP and across pose selection methods
+    ligand_cache = ligand_cache_folder(Path(rescoring_folder).parent)
+    prepare_ligand_cache(sdf, ligand_cache, ['mol2'], ncpus)
+
+    ranking_files = parallel_executor(plants_rescoring_splitted,
+                                      split_files_sdfs,
+                                      ncpus,
+                                      software=software,
+                                      protein_mol2=plants_protein_mol2,
+                                      pocket_definition=pocket_definition,
+                                      scoring_function=scoring_function,
+                                      ligand_cache=ligand_cache)
+    try:
+        plants_results = pd.concat([pd.read_csv(file, usecols=['LIGAND_ENTRY', 'TOTAL_SCORE']) for file in ranking_files if Path(file).is_file()])
+    except Exception as e:
+        # No split produced a ranking file: write an empty score table rather than failing on the missing results
+        printlog(f'ERROR: Could not combine {column_name} rescoring results')
+        printlog(e)
+        plants_results = pd.DataFrame(columns=['LIGAND_ENTRY', 'TOTAL_SCORE'])
+    # LIGAND_ENTRY is '<Pose ID>_entry_<n>_conf_<n>', Pose ID itself is '<ID>_<program>_<n>'
+    plants_results['Pose ID'] = plants_results['LIGAND_ENTRY'].str.split('_').str[:3].str.join('_')
+    plants_rescoring_output = plants_results.rename(columns={'TOTAL_SCORE': column_name})[['Pose ID', column_name]]
+    plants_rescoring_output.to_csv(plants_rescoring_folder / f'{column_name}_scores.csv', index=False)
+    delete_files(plants_rescoring_folder, f'{column_name}_scores.csv')
+    toc = time.perf_counter()
+    printlog(f'Rescoring with {column_name} complete in {toc-tic:0.4f}!')
+    return plants_rescoring_output
 
-    plants_search_speed = 'speed1'
-    ants = '20'
-    chemplp_rescoring_folder = kwargs.get(
-        'rescoring_folder') / f'{column_name}_rescoring'
-    chemplp_rescoring_folder.mkdir(parents=True, exist_ok=True)
-    # Convert protein file to .mol2 using open babel
-    plants_protein_mol2 = chemplp_rescoring_folder / 'protein.mol2'
-    convert_molecules(protein_file, plants_protein_mol2, 'pdb', 'mol2')
-    # Convert prepared ligand file to .mol2 using open babel
-    plants_ligands_mol2 = chemplp_rescoring_folder / 'ligands.mol2'
-    convert_molecules(sdf, plants_ligands_mol2, 'sdf', 'mol2')
-
-    chemplp_rescoring_config_path_txt = chemplp_rescoring_folder / 'config.txt'
-    chemplp_config = [
-        '# search algorithm\n', 'search_speed ' + plants_search_speed + '\n',
-        'aco_ants ' + ants + '\n', 'flip_amide_bonds 0\n', 'flip_planar_n 1\n',
-        'force_flipped_bonds_planarity 0\n', 'force_planar_bond_rotation 1\n',
-        'rescore_mode simplex\n', 'flip_ring_corners 0\n',
-        '# scoring functions\n',
-        '# Intermolecular (protein-ligand interaction scoring)\n',
-        'scoring_function chemplp\n', 'outside_binding_site_penalty 50.0\n',
-        'enable_sulphur_acceptors 1\n', '# Intramolecular ligand scoring\n',
-        'ligand_intra_score clash2\n', 'chemplp_clash_include_14 1\n',
-        'chemplp_clash_include_HH 0\n', '# input\n',
-        'protein_file ' + str(plants_protein_mol2) + '\n',
-        'ligand_file ' + str(plants_ligands_mol2) + '\n', '# output\n',
-        'output_dir ' + str(chemplp_rescoring_folder / 'results') + '\n',
-        '# write single mol2 files (e.g. for RMSD calculation)\n',
-        'write_multi_mol2 1\n', '# binding site definition\n',
-        'bindingsite_center ' +
-        str(kwargs.get('pocket_definition')["center"][0]) + ' ' +
-        str(kwargs.get('pocket_definition')["center"][1]) + ' ' +
-        str(kwargs.get('pocket_definition')["center"][2]) + '\n',
-        'bindingsite_radius ' +
-        str(kwargs.get('pocket_definition')["size"][0] / 2) + '\n',
-        '# cluster algorithm\n', 'cluster_structures 10\n',
-        'cluster_rmsd 2.0\n', '# write\n', 'write_ranking_links 0\n',
-        'write_protein_bindingsite 1\n', 'write_protein_conformations 1\n',
-        'write_protein_splitted 1\n', 'write_merged_protein 0\n', '####\n'
-    ]
-    # Write config file
-    chemplp_rescoring_config_path_config = chemplp_rescoring_config_path_txt.with_suffix(
-        '.config')
-    with chemplp_rescoring_config_path_config.open('w') as configwriter:
-        configwriter.writelines(chemplp_config)
-
-    # Run PLANTS docking
-    chemplp_rescoring_command = f'{software}/PLANTS --mode rescore {chemplp_rescoring_config_path_config}'
-    subprocess.call(
-        chemplp_rescoring_command,
-        shell=True,
-        stdout=DEVNULL,
-        stderr=STDOUT,
-    )
-
-    # Fetch results
-    results_csv_location = chemplp_rescoring_folder / 'results' / 'ranking.csv'
-    chemplp_results = pd.read_csv(results_csv_location, sep=',', header=0)
-    chemplp_results.rename(columns={'TOTAL_SCORE': column_name}, inplace=True)
-    for i, row in chemplp_results.iterrows():
-        split = row['LIGAND_ENTRY'].split('_')
-        chemplp_results.loc[i,
-                            ['Pose ID']] = f'{split[0]}_{split[1]}_{split[2]}'
-    chemplp_rescoring_output = chemplp_results[['Pose ID', column_name]]
-    chemplp_rescoring_output.to_csv(rescoring_folder /
-                                    f'{column_name}_rescoring' /
-                                    f'{column_name}_scores.csv',
-                                    index=False)
-
-    # Remove files
-    plants_ligands_mol2.unlink()
-    delete_files(rescoring_folder / f'{column_name}_rescoring',
-                 f'{column_name}_scores.csv')
 
+def plp_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
+    """
+    Rescores ligands using PLP scoring function.
+
+    Args:
+    sdf (str): Path to the input SDF file.
+    ncpus (int): Number of CPUs to use for docking.
+    column_name (str): Name of the column to store the PLP scores.
+    kwargs: Additional keyword arguments.
+
+    Returns:
+    pandas.DataFrame: DataFrame containing the Pose ID and PLP scores.
+    """
+    return plants_rescoring(sdf, ncpus, column_name, 'plp', **kwargs)
+
+
+def chemplp_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
+    """
+    Rescores ligands using CHEMPLP scoring function.
+
+    Args:
+    sdf (str): Path to the input SDF file.
+    ncpus (int): Number of CPUs to use for docking.
+    column_name (str): Name of the column to store the CHEMPLP scores.
+    kwargs: Additional keyword arguments.
+
+    Returns:
+    pandas.DataFrame: DataFrame containing the Pose ID and CHEMPLP scores.
+    """
+    return plants_rescoring(sdf, ncpus, column_name, 'chemplp', **kwargs)
+
+
+# Scoring function and receptor kept resident in each ODDT worker process
+_ODDT_SCORER = None
+
+
+def _init_oddt_worker(model_file: str, protein_file: str):
+    """
+    Initializes an ODDT worker process: loads the pickled scoring function and featurizes the receptor once.
+    """
+    global _ODDT_SCORER
+    RDLogger.DisableLog('rdApp.*')
+    _ODDT_SCORER = oddt_scorer.load(str(model_file))
+    protein = next(oddt_toolkit.readfile('pdb', str(protein_file)))
+    protein.protein = True
+    _ODDT_SCORER.set_protein(protein)
+
+
+def _oddt_score_split(split_file: Path):
+    """
+    Scores the poses of a split SDF file with the scoring function loaded in the current worker.
+
+    Returns:
+        tuple: The pose IDs and a numpy array with their scores.
+    """
+    ligands = [mol for mol in oddt_toolkit.readfile('sdf', str(split_file)) if mol is not None]
+    if not ligands:
+        return [], np.array([], dtype=float)
+    return [mol.title for mol in ligands], np.asarray(_ODDT_SCORER.predict(ligands), dtype=float)
+
+
+def oddt_rescoring(sdf: str, ncpus: int, column_name: str, model_file: str, **kwargs) -> DataFrame:
+    """
+    Rescores poses in-process with a pickled ODDT scoring function (NNScore, PLECScore, RFScoreVS).
+    Each worker process loads the model and featurizes the receptor once, then scores its share of the splits.
+
+    Args:
+        sdf (str): Path to the input SDF file.
+        ncpus (int): Number of CPUs to use for the rescoring.
+        column_name (str): Name of the column to store the rescored values in the output dataframe.
+        model_file (str): Path to the pickled ODDT scoring function.
+        **kwargs: Additional keyword arguments (rescoring_folder, protein_file).
+
+    Returns:
+        DataFrame: Dataframe with the pose IDs and the corresponding scores.
+    """
+    rescoring_folder = kwargs.get('rescoring_folder')
+    protein_file = kwargs.get('protein_file')
+
+    tic = time.perf_counter()
+    oddt_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
+    oddt_rescoring_folder.mkdir(parents=True, exist_ok=True)
+    split_files_folder = split_sdf_str(oddt_rescoring_folder, sdf, ncpus)
+    split_files_sdfs = [split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
+    pose_ids = []
+    scores = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus,
+                                                initializer=_init_oddt_worker,
+                                                initargs=(model_file, protein_file)) as executor:
+        jobs = [executor.submit(profiled(_oddt_score_split), split_file) for split_file in split_files_sdfs]
+        for job in tqdm(concurrent.futures.as_completed(jobs), total=len(jobs), desc=f'Rescoring with {column_name}'):
+            try:
+                ids, values = job.result()
+            except Exception as e:
+                printlog(f'{column_name} rescoring of a split failed: {e}')
+                continue
+            pose_ids.extend(ids)
+            scores.append(values)
+    df = pd.DataFrame({'Pose ID': pose_ids, column_name: np.concatenate(scores) if scores else []})
+    df.to_csv(oddt_rescoring_folder / f'{column_name}_scores.csv', index=False)
+    delete_files(oddt_rescoring_folder, f'{column_name}_scores.csv')
     toc = time.perf_counter()
-    printlog(f'Rescoring with CHEMPLP complete in {toc-tic:0.4f}!')
-    return chemplp_rescoring_output
+    printlog(f'Rescoring with {column_name} complete in {toc-tic:0.4f}!')
+    return df
 
 
 def oddt_nnscore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
@@ -652,39 +710,8 @@ def oddt_nnscore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     Returns:
     df (Pandas dataframe): Dataframe with the rescored values and the corresponding pose IDs.
     """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-
-    tic = time.perf_counter()
-
-    nnscore_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
-    nnscore_rescoring_folder.mkdir(parents=True, exist_ok=True)
-    pickle_path = f'{software}/models/NNScore_pdbbind2016.pickle'
-    results = nnscore_rescoring_folder / 'rescored_NNscore.sdf'
-    nnscore_rescoring_command = ('oddt_cli ' + str(sdf) + ' --receptor ' +
-                                 str(protein_file) + ' -n ' + str(ncpus) +
-                                 ' --score_file ' + str(pickle_path) + ' -O ' +
-                                 str(results))
-    subprocess.call(
-        nnscore_rescoring_command,
-        shell=True,
-        stdout=DEVNULL,
-        stderr=STDOUT,
-    )
-    df = PandasTools.LoadSDF(str(results),
-                             idName='Pose ID',
-                             molColName=None,
-                             includeFingerprints=False,
-                             removeHs=False)
-    df.rename(columns={'nnscore': column_name}, inplace=True)
-    df = df[['Pose ID', column_name]]
-    df.to_csv(nnscore_rescoring_folder / f'{column_name}_scores.csv',
-              index=False)
-    toc = time.perf_counter()
-    printlog(f'Rescoring with NNscore complete in {toc-tic:0.4f}!')
-    delete_files(nnscore_rescoring_folder, f'{column_name}_scores.csv')
-    return df
+    pickle_path = f'{kwargs.get("software")}/models/NNScore_pdbbind2016.pickle'
+    return oddt_rescoring(sdf, ncpus, column_name, pickle_path, **kwargs)
 
 
 def oddt_plecscore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
@@ -700,39 +727,14 @@ def oddt_plecscore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     Returns:
     - df (pandas.DataFrame): a DataFrame containing the rescoring results, with columns 'Pose ID' and 'column_name'
     """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-
-    tic = time.perf_counter()
-
-    plecscore_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
-    plecscore_rescoring_folder.mkdir(parents=True, exist_ok=True)
-    pickle_path = f'{software}/models/PLECnn_p5_l1_pdbbind2016_s65536.pickle'
-    results = plecscore_rescoring_folder / 'rescored_PLECnn.sdf'
-    plecscore_rescoring_command = ('oddt_cli ' + str(sdf) + ' --receptor ' +
-                                   str(protein_file) + ' -n ' + str(ncpus) +
-                                   ' --score_file ' + str(pickle_path) +
-                                   ' -O ' + str(results))
-    subprocess.call(plecscore_rescoring_command, shell=True)
-    df = PandasTools.LoadSDF(str(results),
-                             idName='Pose ID',
-                             molColName=None,
-                             includeFingerprints=False,
-                             removeHs=False)
-    df.rename(columns={'PLECnn_p5_l1_s65536': column_name}, inplace=True)
-    df = df[['Pose ID', column_name]]
-    df.to_csv(plecscore_rescoring_folder / f'{column_name}_scores.csv',
-              index=False)
-    toc = time.perf_counter()
-    printlog(f'Rescoring with PLECScore complete in {toc-tic:0.4f}!')
-    delete_files(plecscore_rescoring_folder, f'{column_name}_scores.csv')
-    return df
+    pickle_path = f'{kwargs.get("software")}/models/PLECnn_p5_l1_pdbbind2016_s65536.pickle'
+    return oddt_rescoring(sdf, ncpus, column_name, pickle_path, **kwargs)
 
 
 def SCORCH_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     """
     Rescores ligands in an SDF file using SCORCH and saves the results in a CSV file.
+    Batches of poses are sent to a long-lived SCORCH scoring server that keeps the models and receptor loaded.
 
     Args:
         sdf (str): Path to the SDF file containing the ligands to be rescored.
@@ -741,7 +743,7 @@ def SCORCH_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
         **kwargs: Additional keyword arguments.
 
     Returns:
-        None
+        DataFrame: A dataframe containing the 'Pose ID' and SCORCH score columns.
     """
     rescoring_folder = kwargs.get('rescoring_folder')
     software = kwargs.get('software')
@@ -750,42 +752,21 @@ def SCORCH_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     tic = time.perf_counter()
     SCORCH_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
     SCORCH_rescoring_folder.mkdir(parents=True, exist_ok=True)
-    SCORCH_protein = SCORCH_rescoring_folder / "protein.pdbqt"
-    convert_molecules(
-        str(protein_file).replace('.pdb', '_pocket.pdb'), SCORCH_protein,
-        'pdb', 'pdbqt')
-    # Convert ligands to pdbqt
-    split_files_folder = SCORCH_rescoring_folder / f'split_{sdf.stem}'
-    split_files_folder.mkdir(exist_ok=True)
-    convert_molecules(sdf, split_files_folder, 'sdf', 'pdbqt')
-    # Run SCORCH
-
-    SCORCH_command = f'python {software}/SCORCH-1.0.0/scorch.py --receptor {SCORCH_protein} --ligand {split_files_folder} --out {SCORCH_rescoring_folder}/scoring_results.csv --threads {ncpus} --return_pose_scores'
-    subprocess.call(
-        SCORCH_command,
-        shell=True,
-        stdout=DEVNULL,
-        stderr=STDOUT,
-    )
-    # Clean data
-    SCORCH_scores = pd.read_csv(SCORCH_rescoring_folder /
-                                'scoring_results.csv')
-    SCORCH_scores = SCORCH_scores.rename(columns={
-        'Ligand_ID': 'Pose ID',
-        'SCORCH_pose_score': column_name
-    })
-    SCORCH_scores = SCORCH_scores[[column_name, 'Pose ID']]
-    SCORCH_scores.to_csv(SCORCH_rescoring_folder / f'{column_name}_scores.csv',
-                         index=False)
+    split_files_folder = split_sdf_str(SCORCH_rescoring_folder, sdf, ncpus)
+    split_files_sdfs = sorted(split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf'))
+    server = get_scoring_server('SCORCH', software, protein_file, ncpus)
+    SCORCH_scores = server.score_batches(split_files_sdfs).rename(columns={'score': column_name})
+    SCORCH_scores.to_csv(SCORCH_rescoring_folder / f'{column_name}_scores.csv', index=False)
     delete_files(SCORCH_rescoring_folder, f'{column_name}_scores.csv')
     toc = time.perf_counter()
     printlog(f'Rescoring with SCORCH complete in {toc-tic:0.4f}!')
-    return
+    return SCORCH_scores
 
 
 def RTMScore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     """
     Rescores poses in an SDF file using RTMScore.
+    Batches of poses are sent to a long-lived RTMScore scoring server that keeps the model and receptor graph loaded.
 
     Args:
     - sdf (str): Path to the SDF file containing the poses to be rescored.
@@ -800,219 +781,31 @@ def RTMScore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     - pocket_definition (str): Path to the pocket definition file.
 
     Returns:
-    - None
+    - DataFrame: A dataframe containing the 'Pose ID' and RTMScore score columns.
     """
     rescoring_folder = kwargs.get('rescoring_folder')
     software = kwargs.get('software')
     protein_file = kwargs.get('protein_file')
 
     tic = time.perf_counter()
-    (rescoring_folder / f'{column_name}_rescoring').mkdir(parents=True,
-                                                          exist_ok=True)
-    output_file = str(rescoring_folder / f'{column_name}_rescoring' /
-                      f'{column_name}_scores.csv')
+    RTMScore_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
+    RTMScore_rescoring_folder.mkdir(parents=True, exist_ok=True)
+    split_files_folder = split_sdf_str(RTMScore_rescoring_folder, sdf, ncpus)
+    split_files_sdfs = sorted(split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf'))
     try:
-        RTMScore_command = (
-            f'cd {rescoring_folder / "RTMScore_rescoring"} && python {software}/RTMScore-main/example/rtmscore.py'
-            + f' -p {str(protein_file)}' + f' -l {sdf}' +
-            ' -o RTMScore_scores' + ' -pl'
-            f' -m {software}/RTMScore-main/trained_models/rtmscore_model1.pth')
-        subprocess.call(
-            RTMScore_command,
-            shell=True,
-            stdout=DEVNULL,
-            stderr=STDOUT,
-        )
+        server = get_scoring_server('RTMScore', software, protein_file, ncpus)
     except Exception as e:
-        if not os.path.exists(
-                os.path.join(software, 'RTMScore-main', 'example',
-                             'rtmscore.py')):
-            printlog(
-                'ERROR: Failed to run RTMScore! The software folder does not contain rtmscore.py, please reinstall RTMScore.'
-            )
+        if not os.path.exists(os.path.join(software, 'RTMScore-main', 'example', 'rtmscore.py')):
+            printlog('ERROR: Failed to run RTMScore! The software folder does not contain rtmscore.py, please reinstall RTMScore.')
         else:
-            printlog(
-                f'ERROR: Failed to run RTMScore! This was likely caused by a failure in generating the pocket graph : {e}.'
-            )
-    df = pd.read_csv(output_file)
-    df = df.rename(columns={'id': 'Pose ID', 'score': f'{column_name}'})
-    df['Pose ID'] = df['Pose ID'].str.rsplit('-', n=1).str[0]
-    df.to_csv(output_file, index=False)
-    delete_files(rescoring_folder / f'{column_name}_rescoring',
-                 f'{column_name}_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with RTMScore complete in {toc-tic:0.4f}!')
-    return
-
-    #def RTMScore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
-    """
-    Rescores poses in an SDF file using RTMScore.
-
-    Args:
-    - sdf (str): Path to the SDF file containing the poses to be rescored.
-    - ncpus (int): Number of CPUs to use for parallel execution.
-    - column_name (str): Name of the column in the output CSV file that will contain the RTMScore scores.
-    - **kwargs: Additional keyword arguments.
-
-    Keyword Args:
-    - rescoring_folder (str): Path to the folder where the rescoring results will be saved.
-    - software (str): Path to the RTMScore software.
-    - protein_file (str): Path to the protein file.
-    - pocket_definition (str): Path to the pocket definition file.
-
-    Returns:
-    - None
-    """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-
-    tic = time.perf_counter()
-
-    split_files_folder = split_sdf_str(
-        rescoring_folder / f'{column_name}_rescoring', sdf, ncpus * 2)
-    split_files_sdfs = [
-        split_files_folder / f for f in os.listdir(split_files_folder)
-        if f.endswith('.sdf')
-    ]
-
-    (rescoring_folder / f'{column_name}_rescoring').mkdir(parents=True,
-                                                          exist_ok=True)
-
-    global RTMScore_rescoring_splitted
-
-    def RTMScore_rescoring_splitted(split_file, protein_file):
-        RTMScore_command = (
-            f'cd {rescoring_folder / "RTMScore_rescoring"} && python {software}/RTMScore-main/example/rtmscore.py'
-            + f' -p {str(protein_file).replace(".pdb", "_pocket.pdb")}' +
-            f' -l {split_file}' + f' -o RTMScore_scores_{split_file.stem}' +
-            f' -m {software}/RTMScore-main/trained_models/rtmscore_model1.pth')
-        subprocess.call(
-            RTMScore_command,
-            shell=True,
-            stdout=DEVNULL,
-            stderr=STDOUT,
-        )
-        return
-
-    parallel_executor(RTMScore_rescoring_splitted,
-                      split_files_sdfs,
-                      3,
-                      protein_file=protein_file)
-
-    try:
-        score_dfs = []
-        for file in os.listdir(rescoring_folder / 'RTMScore_rescoring'):
-            if file.startswith('RTMScore_scores_') and file.endswith('.csv'):
-                df = pd.read_csv(rescoring_folder / 'RTMScore_rescoring' /
-                                 file)
-                df = df.rename(columns={
-                    'id': 'Pose ID',
-                    'score': f'{column_name}'
-                })
-                df['Pose ID'] = df['Pose ID'].str.rsplit('-', n=1).str[0]
-                score_dfs.append(df)
-        RTMScore_rescoring_results = pd.concat(score_dfs)
-    except Exception as e:
-        printlog(f'Failed to combine {column_name} score files!')
-        printlog(e)
-
-    try:
-        output_file = str(rescoring_folder / f'{column_name}_rescoring' /
-                          f'{column_name}_scores.csv')
-        RTMScore_rescoring_results.to_csv(output_file, index=False)
-    except Exception as e:
-        printlog(f'ERROR: Could not write {column_name} combined scores')
-        printlog(e)
-
-    delete_files(rescoring_folder / f'{column_name}_rescoring',
-                 f'{column_name}_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with RTMScore complete in {toc-tic:0.4f}!')
-    return
-
-    #def RTMScore_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
-    """
-    Rescores poses in an SDF file using RTMScore.
-
-    Args:
-    - sdf (str): Path to the SDF file containing the poses to be rescored.
-    - ncpus (int): Number of CPUs to use for parallel execution.
-    - column_name (str): Name of the column in the output CSV file that will contain the RTMScore scores.
-    - **kwargs: Additional keyword arguments.
-
-    Keyword Args:
-    - rescoring_folder (str): Path to the folder where the rescoring results will be saved.
-    - software (str): Path to the RTMScore software.
-    - protein_file (str): Path to the protein file.
-    - pocket_definition (str): Path to the pocket definition file.
-
-    Returns:
-    - None
-    """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-
-    tic = time.perf_counter()
-
-    split_files_folder = split_sdf_str(
-        rescoring_folder / f'{column_name}_rescoring', sdf, ncpus * 2)
-    split_files_sdfs = [
-        split_files_folder / f for f in os.listdir(split_files_folder)
-        if f.endswith('.sdf')
-    ]
-
-    (rescoring_folder / f'{column_name}_rescoring').mkdir(parents=True,
-                                                          exist_ok=True)
-    for file in tqdm(split_files_sdfs):
-        try:
-            RTMScore_command = (
-                f'cd {rescoring_folder / "RTMScore_rescoring"} && python {software}/RTMScore-main/example/rtmscore.py'
-                + f' -p {str(protein_file).replace(".pdb", "_pocket.pdb")}' +
-                f' -l {file}' + f' -o RTMScore_scores_{file.stem}' + ' -pl'
-                f' -m {software}/RTMScore-main/trained_models/rtmscore_model1.pth'
-            )
-            subprocess.call(
-                RTMScore_command,
-                shell=True,
-                stdout=DEVNULL,
-                stderr=STDOUT,
-            )
-        except Exception as e:
-            printlog(f'Failed to run RTMScore on {file}!')
-            printlog(e)
-
-    try:
-        score_dfs = []
-        for file in os.listdir(rescoring_folder / 'RTMScore_rescoring'):
-            if file.startswith('RTMScore_scores_') and file.endswith('.csv'):
-                df = pd.read_csv(rescoring_folder / 'RTMScore_rescoring' /
-                                 file)
-                df = df.rename(columns={
-                    'id': 'Pose ID',
-                    'score': f'{column_name}'
-                })
-                df['Pose ID'] = df['Pose ID'].str.rsplit('-', n=1).str[0]
-                score_dfs.append(df)
-        RTMScore_rescoring_results = pd.concat(score_dfs)
-    except Exception as e:
-        printlog(f'Failed to combine {column_name} score files!')
-        printlog(e)
-
-    try:
-        output_file = str(rescoring_folder / f'{column_name}_rescoring' /
-                          f'{column_name}_scores.csv')
-        RTMScore_rescoring_results.to_csv(output_file, index=False)
-    except Exception as e:
-        printlog(f'ERROR: Could not write {column_name} combined scores')
-        printlog(e)
-
-    delete_files(rescoring_folder / f'{column_name}_rescoring',
-                 f'{column_name}_scores.csv')
+            printlog(f'ERROR: Failed to run RTMScore! This was likely caused by a failure in generating the pocket graph : {e}.')
+        raise
+    RTMScore_scores = server.score_batches(split_files_sdfs).rename(columns={'score': column_name})
+    RTMScore_scores.to_csv(RTMScore_rescoring_folder / f'{column_name}_scores.csv', index=False)
+    delete_files(RTMScore_rescoring_folder, f'{column_name}_scores.csv')
     toc = time.perf_counter()
     printlog(f'Rescoring with RTMScore complete in {toc-tic:0.4f}!')
-    return
+    return RTMScore_scores
 
 
 def LinF9_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
@@ -1034,86 +827,7 @@ def LinF9_rescoring(sdf: str, ncpus: int, column_name: str, **kwargs):
     Returns:
     pandas.DataFrame: A DataFrame containing the rescoring results, with columns 'Pose ID' and the specified column name.
     """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-    pocket_definition = kwargs.get('pocket_definition')
-
-    tic = time.perf_counter()
-    (rescoring_folder / f'{column_name}_rescoring').mkdir(parents=True,
-                                                          exist_ok=True)
-    split_files_folder = split_sdf_str(
-        rescoring_folder / f'{column_name}_rescoring', sdf, ncpus)
-    split_files_sdfs = [
-        Path(split_files_folder) / f for f in os.listdir(split_files_folder)
-        if f.endswith('.sdf')
-    ]
-
-    global LinF9_rescoring_splitted
-
-    def LinF9_rescoring_splitted(split_file, protein_file, pocket_definition):
-        LinF9_folder = rescoring_folder / 'LinF9_rescoring'
-        results = LinF9_folder / f'{split_file.stem}_LinF9.sdf'
-        LinF9_cmd = (f'{software}/smina.static' +
-                     f' --receptor {protein_file}' +
-                     f' --ligand {split_file}' + f' --out {results}' +
-                     f' --center_x {pocket_definition["center"][0]}' +
-                     f' --center_y {pocket_definition["center"][1]}' +
-                     f' --center_z {pocket_definition["center"][2]}' +
-                     f' --size_x {pocket_definition["size"][0]}' +
-                     f' --size_y {pocket_definition["size"][1]}' +
-                     f' --size_z {pocket_definition["size"][2]}' + ' --cpu 1' +
-                     ' --scoring Lin_F9 --score_only')
-        try:
-            subprocess.call(
-                LinF9_cmd,
-                shell=True,
-                stdout=DEVNULL,
-                stderr=STDOUT,
-            )
-        except Exception as e:
-            printlog(f'LinF9 rescoring failed: {e}')
-        return
-
-    parallel_executor(LinF9_rescoring_splitted,
-                      split_files_sdfs,
-                      ncpus,
-                      protein_file=protein_file,
-                      pocket_definition=pocket_definition)
-
-    try:
-        LinF9_dataframes = [
-            PandasTools.LoadSDF(str(rescoring_folder / 'LinF9_rescoring' /
-                                    file),
-                                idName='Pose ID',
-                                molColName=None,
-                                includeFingerprints=False,
-                                embedProps=False,
-                                removeHs=False,
-                                strictParsing=True)
-            for file in os.listdir(rescoring_folder / 'LinF9_rescoring')
-            if file.startswith('split') and file.endswith('_LinF9.sdf')
-        ]
-    except Exception as e:
-        printlog('ERROR: Failed to Load LinF9 rescoring SDF file!')
-        printlog(e)
-
-    try:
-        LinF9_rescoring_results = pd.concat(LinF9_dataframes)
-    except Exception as e:
-        printlog('ERROR: Could not combine LinF9 rescored poses')
-        printlog(e)
-
-    LinF9_rescoring_results.rename(columns={'minimizedAffinity': column_name},
-                                   inplace=True)
-    LinF9_rescoring_results = LinF9_rescoring_results[['Pose ID', column_name]]
-    LinF9_rescoring_results.to_csv(rescoring_folder / 'LinF9_rescoring' /
-                                   'LinF9_scores.csv',
-                                   index=False)
-    delete_files(rescoring_folder / 'LinF9_rescoring', 'LinF9_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with LinF9 complete in {toc-tic:0.4f}!')
-    return LinF9_rescoring_results
+    return score_only_rescoring(sdf, ncpus, column_name, f'{kwargs.get("software")}/smina.static', 'Lin_F9', **kwargs)
 
 
 def AAScore_rescoring(sdf: str, ncpus: int, column_name: str,
@@ -1207,6 +921,62 @@ def AAScore_rescoring(sdf: str, ncpus: int, column_name: str,
         printlog(f'Rescoring with AAScore complete in {toc - tic:0.4f}!')
         return AAScore_rescoring_results
 
+def stdout_scores_splitted(split_file: Path, command: str) -> DataFrame:
+    """
+    Runs a scoring binary on a split SDF file and collects the 'model' score records from its stdout as they are printed.
+    Scores are matched in order to the pose IDs read from the SDF record titles. The records carry no pose identifier, so if their number
+    does not match the number of poses the scores cannot be assigned and the whole split is left unscored.
+
+    Returns:
+        DataFrame: The 'Pose ID' and 'score' of the poses of the split (NaN for all poses if the score records do not match the poses).
+    """
+    pose_ids = read_sdf_properties(split_file, idName='Pose ID')['Pose ID'].tolist()
+    scores = []
+    with subprocess.Popen(command.format(split_file=split_file), stdout=subprocess.PIPE, stderr=DEVNULL, shell=True, text=True) as process:
+        for line in process.stdout:
+            if line.startswith('model'):
+                scores.append(round(float(line.split(',')[1].split('=')[1]), 2))
+    if len(scores) != len(pose_ids):
+        printlog(f'ERROR: {len(scores)} scores were returned for the {len(pose_ids)} poses of {split_file}, the poses of this split are not scored')
+        scores = [np.nan] * len(pose_ids)
+    return DataFrame({'Pose ID': pose_ids, 'score': scores})
+
+
+def stdout_rescoring(sdf: str, ncpus: int, column_name: str, command: str, **kwargs) -> DataFrame:
+    """
+    Rescores poses with a binary that prints one 'model' score record per pose on stdout, one process per split.
+    The scores of all splits are collected into a single table, no intermediate file is written per split.
+
+    Args:
+        sdf (str): The path to the input SDF file containing the poses to be rescored.
+        ncpus (int): The number of CPUs to use for parallel processing.
+        column_name (str): The name of the column to store the scores in.
+        command (str): The command to run, with a {split_file} placeholder for the ligand file.
+        **kwargs: Additional keyword arguments (rescoring_folder).
+
+    Returns:
+        DataFrame: A dataframe containing the 'Pose ID' and score columns for the rescored poses.
+    """
+    rescoring_folder = kwargs.get('rescoring_folder')
+
+    tic = time.perf_counter()
+    stdout_rescoring_folder = rescoring_folder / f'{column_name}_rescoring'
+    stdout_rescoring_folder.mkdir(parents=True, exist_ok=True)
+    split_files_folder = split_sdf_str(stdout_rescoring_folder, sdf, ncpus)
+    split_files_sdfs = [split_files_folder / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
+    results = parallel_executor(stdout_scores_splitted, split_files_sdfs, ncpus, command=command)
+    if results:
+        rescoring_results = pd.concat(results, ignore_index=True).rename(columns={'score': column_name})
+    else:
+        printlog(f'ERROR: No split was scored with {column_name}!')
+        rescoring_results = DataFrame(columns=['Pose ID', column_name])
+    rescoring_results.to_csv(stdout_rescoring_folder / f'{column_name}_scores.csv', index=False)
+    delete_files(stdout_rescoring_folder, f'{column_name}_scores.csv')
+    toc = time.perf_counter()
+    printlog(f'Rescoring with {column_name} complete in {toc-tic:0.4f}!')
+    return rescoring_results
+
+
 def KORPL_rescoring(sdf : str, ncpus : int, column_name : str, **kwargs):
     """
     Rescores a given SDF file using KORP-PL software and saves the results to a CSV file.
@@ -1221,57 +991,11 @@ def KORPL_rescoring(sdf : str, ncpus : int, column_name : str, **kwargs):
     - pocket_definition (str): The path to the pocket definition file.
 
     Returns:
-    - None
+    - DataFrame: A dataframe containing the 'Pose ID' and KORP-PL score columns.
     """
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
+    command = f'{kwargs.get("software")}/KORP-PL --receptor {kwargs.get("protein_file")} --ligand {{split_file}} --sdf'
+    return stdout_rescoring(sdf, ncpus, column_name, command, **kwargs)
 
-    tic = time.perf_counter()
-    (rescoring_folder / f'{column_name}_rescoring').mkdir(parents=True, exist_ok=True)
-    split_files_folder = split_sdf_str((rescoring_folder / f'{column_name}_rescoring'), sdf, ncpus)
-    split_files_sdfs = [Path(split_files_folder) / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
-    global KORPL_rescoring_splitted
-
-    def KORPL_rescoring_splitted(split_file, protein_file):
-        df = PandasTools.LoadSDF(str(split_file), idName='Pose ID', molColName=None)
-        df = df[['Pose ID']]
-        korpl_command = (f'{software}/KORP-PL' +
-                        ' --receptor ' + str(protein_file) +
-                        ' --ligand ' + str(split_file) +
-                        ' --sdf')
-        process = subprocess.Popen(korpl_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        stdout, stderr = process.communicate()
-        energies = []
-        output = stdout.decode().splitlines()
-        for line in output:
-            if line.startswith('model'):
-                parts = line.split(',')
-                energy = round(float(parts[1].split('=')[1]), 2)
-                energies.append(energy)
-        df[column_name] = energies
-        output_csv = str(rescoring_folder / f'{column_name}_rescoring' / (str(split_file.stem) + '_scores.csv'))
-        df.to_csv(output_csv, index=False)
-        return
-
-    parallel_executor(KORPL_rescoring_splitted, split_files_sdfs, ncpus, protein_file=protein_file)
-
-    print('Combining KORPL scores')
-    scores_folder = rescoring_folder / f'{column_name}_rescoring'
-    # Get a list of all files with names ending in "_scores.csv"
-    score_files = list(scores_folder.glob('*_scores.csv'))
-    if not score_files:
-        print("No CSV files found with names ending in '_scores.csv' in the specified folder.")
-    else:
-        # Read and concatenate the CSV files into a single DataFrame
-        combined_scores_df = pd.concat([pd.read_csv(file) for file in score_files], ignore_index=True)
-        # Save the combined scores to a single CSV file
-        combined_scores_csv = scores_folder / f'{column_name}_scores.csv'
-        combined_scores_df.to_csv(combined_scores_csv, index=False)
-    delete_files(rescoring_folder / f'{column_name}_rescoring', f'{column_name}_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with KORPL complete in {toc-tic:0.4f}!')
-    return
 
 def ConvexPLR_rescoring(sdf : str, ncpus : int, column_name : str, **kwargs):
     """
@@ -1287,52 +1011,10 @@ def ConvexPLR_rescoring(sdf : str, ncpus : int, column_name : str, **kwargs):
         - pocket_definition (str): path to the pocket definition file
 
     Returns:
-        - None
+        - DataFrame: A dataframe containing the 'Pose ID' and ConvexPLR score columns.
     """
-
-    tic = time.perf_counter()
-    rescoring_folder = kwargs.get('rescoring_folder')
-    software = kwargs.get('software')
-    protein_file = kwargs.get('protein_file')
-
-    (rescoring_folder / f'{column_name}_rescoring').mkdir(parents=True, exist_ok=True)
-    split_files_folder = split_sdf_str((rescoring_folder / f'{column_name}_rescoring'), sdf, ncpus)
-    split_files_sdfs = [Path(split_files_folder) / f for f in os.listdir(split_files_folder) if f.endswith('.sdf')]
-    global ConvexPLR_rescoring_splitted
-    def ConvexPLR_rescoring_splitted(split_file, protein_file):
-        df = PandasTools.LoadSDF(str(split_file), idName='Pose ID', molColName=None)
-        df = df[['Pose ID']]
-        ConvexPLR_command = (f'{software}/Convex-PL' +
-                            f' --receptor {protein_file}' +
-                            f' --ligand {split_file}' +
-                            ' --sdf --regscore')
-        process = subprocess.Popen(ConvexPLR_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        stdout, stderr = process.communicate()
-        energies = []
-        output = stdout.decode().splitlines()
-        for line in output:
-            if line.startswith('model'):
-                parts = line.split(',')
-                energy = round(float(parts[1].split('=')[1]), 2)
-                energies.append(energy)
-        df[column_name] = energies
-        output_csv = str(rescoring_folder / f'{column_name}_rescoring' / (str(split_file.stem) + '_scores.csv'))
-        df.to_csv(output_csv, index=False)
-        return
-
-    parallel_executor(ConvexPLR_rescoring_splitted, split_files_sdfs, ncpus, protein_file=protein_file)
-
-    # Get a list of all files with names ending in "_scores.csv"
-    score_files = list((rescoring_folder / f'{column_name}_rescoring').glob('*_scores.csv'))
-    # Read and concatenate the CSV files into a single DataFrame
-    combined_scores_df = pd.concat([pd.read_csv(file) for file in score_files], ignore_index=True)
-    # Save the combined scores to a single CSV file
-    combined_scores_csv = rescoring_folder / f'{column_name}_rescoring' / f'{column_name}_scores.csv'
-    combined_scores_df.to_csv(combined_scores_csv, index=False)
-    delete_files(rescoring_folder / f'{column_name}_rescoring', f'{column_name}_scores.csv')
-    toc = time.perf_counter()
-    printlog(f'Rescoring with ConvexPLR complete in {toc-tic:0.4f}!')
-    return
+    command = f'{kwargs.get("software")}/Convex-PL --receptor {kwargs.get("protein_file")} --ligand {{split_file}} --sdf --regscore'
+    return stdout_rescoring(sdf, ncpus, column_name, command, **kwargs)
 
 #add new scoring functions here!
 # Dict key: (function, column_name, min or max ordering, min value for scaled standardisation, max value for scaled standardisation)
@@ -1357,6 +1039,17 @@ RESCORING_FUNCTIONS = {
 }
 
 
+def run_rescoring_function(function: str, clustered_sdf: Path, ncpus: int, protein_file: Path, pocket_definition: dict, software: Path, rescoring_folder: Path) -> None:
+    """
+    Runs one rescoring function on the poses of an SDF file, writing {function}_scores.csv in the rescoring folder, and records its telemetry.
+    A function finishing without writing its scores is recorded as a failure.
+    """
+    function_info = RESCORING_FUNCTIONS[function]
+    score_file = Path(rescoring_folder) / f'{function}_rescoring' / f'{function}_scores.csv'
+    with measure('rescoring', function, items=count_records(clustered_sdf), poses=Path(clustered_sdf).stem) as metrics:
+        function_info['function'](clustered_sdf, ncpus, function_info['column_name'], protein_file=protein_file, pocket_definition=pocket_definition, software=software, rescoring_folder=rescoring_folder)
+        metrics['failures'] = int(not score_file.is_file())
+
 def rescore_poses(w_dir: Path, protein_file: Path, pocket_definition: dict, software: Path, clustered_sdf: Path, functions: List[str], ncpus: int) -> None:
     """
     Rescores ligand poses using the specified software and scoring functions. The function splits the input SDF file into
@@ -1383,10 +1076,9 @@ def rescore_poses(w_dir: Path, protein_file: Path, pocket_definition: dict, soft
 
     skipped_functions = []
     for function in functions:
-        function_info = RESCORING_FUNCTIONS.get(function)
         if not (rescoring_folder / f'{function}_rescoring' / f'{function}_scores.csv').is_file():
             try:
-                function_info['function'](clustered_sdf, ncpus, function_info['column_name'], protein_file=protein_file, pocket_definition=pocket_definition, software=software, rescoring_folder=rescoring_folder)
+                run_rescoring_function(function, clustered_sdf, ncpus, protein_file, pocket_definition, software, rescoring_folder)
             except Exception as e:
                 printlog(e)
                 printlog(f'Failed for {function}')
@@ -0,0 +1,237 @@
+import atexit
+import functools
+import importlib.util
+import multiprocessing
+import secrets
+import sys
+import threading
+import time
+import warnings
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts.artifact_cache import get_receptor_artifact
+from scripts.utilities import convert_molecules, printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+
+def _import_script(module_name: str, script_path: Path):
+    """
+    Imports a standalone python script (e.g. rtmscore.py) as a module so that its functions can be called in-process.
+    """
+    sys.path.insert(0, str(script_path.parent.parent))
+    sys.path.insert(0, str(script_path.parent))
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _first_call_cache(function):
+    """
+    Caches the result of the first call of a function and returns it for all later calls, whatever their arguments.
+    """
+    result = []
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not result:
+            result.append(function(*args, **kwargs))
+        return result[0]
+    return wrapper
+
+
+class RTMScoreBackend:
+    """
+    Keeps the RTMScore model and the receptor graph loaded between batches.
+    """
+    def __init__(self, software: Path, protein_file: Path, ncpus: int):
+        import torch as th
+        from torch.utils.data import DataLoader
+        th.set_num_threads(ncpus)
+        self.th = th
+        self.DataLoader = DataLoader
+        self.protein = str(protein_file)
+        self.rtmscore = _import_script('rtmscore', Path(software) / 'RTMScore-main' / 'example' / 'rtmscore.py')
+        self.args = dict(self.rtmscore.args)
+        self.args['device'] = 'cpu'
+        self.args['num_workers'] = 0
+        # A server scores a single receptor, so its graph is built on the first batch and kept, keyed by the protein file and cutoff
+        # (the receptor molecule itself is loaded again for each batch and cannot serve as a key)
+        data_module = sys.modules[self.rtmscore.VSDataset.__module__]
+        if hasattr(data_module, 'prot_to_graph'):
+            self.receptor_graphs = {}
+            prot_to_graph = data_module.prot_to_graph
+
+            @functools.wraps(prot_to_graph)
+            def cached_prot_to_graph(prot, cutoff, *args, **kwargs):
+                key = (self.protein, cutoff)
+                if key not in self.receptor_graphs:
+                    self.receptor_graphs[key] = prot_to_graph(prot, cutoff, *args, **kwargs)
+                return self.receptor_graphs[key]
+            data_module.prot_to_graph = cached_prot_to_graph
+        args = self.args
+        ligmodel = self.rtmscore.DGLGraphTransformer(in_channels=args['num_node_featsl'], edge_features=args['num_edge_featsl'], num_hidden_channels=args['hidden_dim0'], activ_fn=th.nn.SiLU(), transformer_residual=True, num_attention_heads=4, norm_to_apply='batch', dropout_rate=0.15, num_layers=6)
+        protmodel = self.rtmscore.DGLGraphTransformer(in_channels=args['num_node_featsp'], edge_features=args['num_edge_featsp'], num_hidden_channels=args['hidden_dim0'], activ_fn=th.nn.SiLU(), transformer_residual=True, num_attention_heads=4, norm_to_apply='batch', dropout_rate=0.15, num_layers=6)
+        self.model = self.rtmscore.RTMScore(ligmodel, protmodel, in_channels=args['hidden_dim0'], hidden_dim=args['hidden_dim'], n_gaussians=args['n_gaussians'], dropout_rate=args['dropout_rate'], dist_threhold=args['dist_threhold']).to('cpu')
+        checkpoint = th.load(Path(software) / 'RTMScore-main' / 'trained_models' / 'rtmscore_model1.pth', map_location=th.device('cpu'))
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+
+    def score(self, sdf_file: Path) -> pd.DataFrame:
+        data = self.rtmscore.VSDataset(ligs=str(sdf_file), prot=self.protein, cutoff=10.0, explicit_H=False, use_chirality=True, parallel=False)
+        loader = self.DataLoader(dataset=data, batch_size=self.args['batch_size'], shuffle=False, num_workers=0, collate_fn=self.rtmscore.collate)
+        preds = self.rtmscore.run_an_eval_epoch(self.model, loader, pred=True, dist_threhold=self.args['dist_threhold'], device='cpu')
+        df = pd.DataFrame({'Pose ID': list(data.ids), 'score': np.asarray(preds, dtype=float).ravel()})
+        df['Pose ID'] = df['Pose ID'].str.rsplit('-', n=1).str[0]
+        return df
+
+
+class SCORCHBackend:
+    """
+    Keeps the SCORCH module (tensorflow and xgboost imports), its models and the receptor pdbqt loaded between batches.
+    """
+    def __init__(self, software: Path, protein_file: Path, ncpus: int):
+        self.work_dir = Path(protein_file).parent / 'SCORCH_server'
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.receptor = get_receptor_artifact(str(protein_file).replace('.pdb', '_pocket.pdb'), 'pdbqt')
+        self.ncpus = ncpus
+        self.scorch = _import_script('scorch', Path(software) / 'SCORCH-1.0.0' / 'scorch.py')
+        # Models do not depend on the ligands, load them on the first batch only
+        if hasattr(self.scorch, 'prepare_models'):
+            self.scorch.prepare_models = _first_call_cache(self.scorch.prepare_models)
+
+    def score(self, sdf_file: Path) -> pd.DataFrame:
+        ligand_folder = self.work_dir / Path(sdf_file).stem
+        ligand_folder.mkdir(parents=True, exist_ok=True)
+        convert_molecules(sdf_file, ligand_folder, 'sdf', 'pdbqt')
+        params = {'receptor': str(self.receptor), 'ligand': str(ligand_folder), 'out': None, 'threads': self.ncpus, 'return_pose_scores': True, 'verbose': False}
+        results = self.scorch.scoring(params)
+        for file in ligand_folder.iterdir():
+            file.unlink()
+        ligand_folder.rmdir()
+        return results.rename(columns={'Ligand_ID': 'Pose ID', 'SCORCH_pose_score': 'score'})[['Pose ID', 'score']]
+
+
+SCORING_BACKENDS = {'RTMScore': RTMScoreBackend, 'SCORCH': SCORCHBackend}
+
+
+def _serve(backend_name: str, software: Path, protein_file: Path, ncpus: int, authkey: bytes, address_conn):
+    """
+    Entry point of the scoring server process. Loads the backend once and answers scoring requests until stopped.
+    """
+    with Listener(('localhost', 0), authkey=authkey) as listener:
+        try:
+            backend = SCORING_BACKENDS[backend_name](software, protein_file, ncpus)
+        except Exception as e:
+            address_conn.send(('error', str(e)))
+            return
+        address_conn.send(('ready', listener.address))
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        request = conn.recv()
+                    except EOFError:
+                        break
+                    if request[0] == 'stop':
+                        return
+                    try:
+                        conn.send(('ok', backend.score(request[1])))
+                    except Exception as e:
+                        conn.send(('error', str(e)))
+
+
+class ScoringServer:
+    """
+    A local, long-lived CPU scoring worker for deep-learning rescoring functions.
+    The model and receptor are loaded once in a separate process, batches of poses are sent over a local socket.
+    """
+    def __init__(self, backend_name: str, software: Path, protein_file: Path, ncpus: int):
+        self.backend_name = backend_name
+        self.authkey = secrets.token_bytes(16)
+        tic = time.perf_counter()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(backend_name, software, protein_file, ncpus, self.authkey, child_conn))
+        # Not a daemon, so that the backend can start its own worker processes (e.g. SCORCH threads), it is stopped at exit by stop_scoring_servers
+        self.process.start()
+        status, payload = parent_conn.recv()
+        if status != 'ready':
+            self.process.join()
+            raise RuntimeError(f'{backend_name} scoring server failed to start: {payload}')
+        self.conn = Client(payload, authkey=self.authkey)
+        # The connection is shared by the rescoring stages running concurrently, each request and its reply must not interleave with another's
+        self.lock = threading.Lock()
+        self.startup_time = time.perf_counter() - tic
+        printlog(f'{backend_name} scoring server ready in {self.startup_time:0.4f}s (pid {self.process.pid})')
+
+    def score(self, sdf_file: Path) -> pd.DataFrame:
+        with self.lock:
+            self.conn.send(('score', str(sdf_file)))
+            status, payload = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f'{self.backend_name} scoring failed for {sdf_file}: {payload}')
+        return payload
+
+    def score_batches(self, sdf_files: list) -> pd.DataFrame:
+        """
+        Scores a list of SDF batches and reports first-pose and per-pose latencies.
+        """
+        tic = time.perf_counter()
+        first_pose_latency = None
+        results = []
+        for sdf_file in sdf_files:
+            try:
+                results.append(self.score(sdf_file))
+            except Exception as e:
+                printlog(str(e))
+                continue
+            if first_pose_latency is None:
+                first_pose_latency = time.perf_counter() - tic
+        total = time.perf_counter() - tic
+        scores = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['Pose ID', 'score'])
+        if len(scores):
+            printlog(f'{self.backend_name} server scored {len(scores)} poses in {total:0.4f}s: first-pose latency {first_pose_latency:0.4f}s, per-pose latency {1000 * total / len(scores):0.2f}ms')
+        return scores
+
+    def stop(self):
+        try:
+            with self.lock:
+                self.conn.send(('stop',))
+                self.conn.close()
+        except (OSError, EOFError):
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+# Servers stay alive for the whole run and are shared by all rescoring calls on the same receptor
+_SERVERS = {}
+_SERVERS_LOCK = threading.Lock()
+
+
+def get_scoring_server(backend_name: str, software: Path, protein_file: Path, ncpus: int) -> ScoringServer:
+    """
+    Returns the running scoring server for this backend and receptor, starting it if needed.
+    """
+    key = (backend_name, str(Path(protein_file).resolve()))
+    # Held while starting a server, so that concurrent rescoring stages do not start two servers for the same key
+    with _SERVERS_LOCK:
+        server = _SERVERS.get(key)
+        if server is None or not server.process.is_alive():
+            server = ScoringServer(backend_name, software, protein_file, ncpus)
+            _SERVERS[key] = server
+    return server
+
+
+@atexit.register
+def stop_scoring_servers():
+    with _SERVERS_LOCK:
+        for server in _SERVERS.values():
+            server.stop()
+        _SERVERS.clear()
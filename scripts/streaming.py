@@ -0,0 +1,122 @@
+import concurrent.futures
+import shutil
+import time
+import traceback
+import warnings
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.clustering_functions import select_poses
+from scripts.docking_functions import concat_all_poses, docking, load_poses
+from scripts.profiling import profile_stage
+from scripts.rescoring_functions import rescore_poses
+from scripts.telemetry import measure
+from scripts.utilities import printlog
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Share of the CPUs given to the pose selection and rescoring of the docked shards, the docking pool gets the rest
+SHARD_CPU_FRACTION = 0.25
+
+
+def process_shard(shard_dir: Path, poses: str, protein_file: Path, pocket_definition: dict, software: Path,
+                  pose_selection: list, clustering_method: str, rescoring: list, bust_poses: bool, ncpus: int):
+    """
+    Selects and rescores the poses of one docked shard in its own folder, laid out like a working directory.
+
+    Args:
+        shard_dir (Path): The folder of the shard.
+        poses (str): The SDF text of the poses of the shard from all docking programs.
+        The other arguments are those of dockm8.
+    """
+    with measure('streaming_shard', shard_dir.name, items=poses.count('$$$$')), profile_stage('streaming_shards'):
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        (shard_dir / 'allposes.sdf').write_text(poses)
+        all_poses = load_poses(shard_dir / 'allposes.sdf', protein_file, ncpus, bust_poses)
+        for method in pose_selection:
+            select_poses(method, clustering_method, shard_dir, protein_file, pocket_definition, software, all_poses.copy(), ncpus)
+            rescore_poses(shard_dir, protein_file, pocket_definition, software, shard_dir / 'clustering' / f'{method}_clustered.sdf', rescoring, ncpus)
+
+
+def merge_shards(w_dir: Path, shard_dirs: list, pose_selection: list):
+    """
+    Combines the selected poses and the rescoring results of the shards into the working directory, where the consensus is calculated.
+    """
+    (w_dir / 'clustering').mkdir(parents=True, exist_ok=True)
+    for method in pose_selection:
+        with open(w_dir / 'clustering' / f'{method}_clustered.sdf', 'w') as outfile:
+            for shard_dir in shard_dirs:
+                clustered_sdf = shard_dir / 'clustering' / f'{method}_clustered.sdf'
+                if clustered_sdf.is_file():
+                    with open(clustered_sdf) as infile:
+                        shutil.copyfileobj(infile, outfile)
+        score_files = [shard_dir / f'rescoring_{method}_clustered' / 'allposes_rescored.csv' for shard_dir in shard_dirs]
+        scores = [pd.read_csv(score_file) for score_file in score_files if score_file.is_file()]
+        rescoring_folder = w_dir / f'rescoring_{method}_clustered'
+        rescoring_folder.mkdir(parents=True, exist_ok=True)
+        if scores:
+            pd.concat(scores, ignore_index=True).to_csv(rescoring_folder / 'allposes_rescored.csv', index=False)
+        else:
+            printlog(f'ERROR: No shard was rescored for {method}!')
+
+
+def run_streaming(w_dir: Path, protein_file: Path, pocket_definition: dict, software: Path, docking_programs: list, exhaustiveness: int,
+                  n_poses: int, ncpus: int, job_manager: str, bust_poses: bool, pose_selection: list, clustering_method: str, rescoring: list):
+    """
+    Docks the library and selects and rescores the poses shard by shard: as soon as all docking programs are done with a split file,
+    its poses are selected and rescored while the other shards are still docking. The shard results are then combined for the consensus,
+    the only step needing all compounds (the scores are standardized over the whole library).
+    The combined allposes.sdf is not written, and the shard folders are removed once combined.
+    The CPUs are split between the docking pool and the shard processing (SHARD_CPU_FRACTION), so that together they use at most ncpus.
+
+    Args:
+        w_dir (Path): The working directory.
+        The other arguments are those of dockm8.
+    """
+    tic = time.perf_counter()
+    shard_cpus = max(1, round(ncpus * SHARD_CPU_FRACTION))
+    docking_cpus = ncpus - shard_cpus
+    # The sharded docking needs at least two CPUs left after the shard processing share
+    if docking_cpus < 2 or any((w_dir / program.lower() / f'{program.lower()}_poses.sdf').is_file() for program in docking_programs):
+        # Shards can only be streamed while docking the split library: resume an interrupted run, or run on too few CPUs, without streaming
+        printlog('Selecting and rescoring poses without streaming...')
+        docking(w_dir, protein_file, pocket_definition, software, docking_programs, exhaustiveness, n_poses, ncpus, job_manager)
+        all_poses = concat_all_poses(w_dir, docking_programs, protein_file, ncpus, bust_poses)
+        for method in pose_selection:
+            select_poses(method, clustering_method, w_dir, protein_file, pocket_definition, software, all_poses.copy(), ncpus)
+            rescore_poses(w_dir, protein_file, pocket_definition, software, w_dir / 'clustering' / f'{method}_clustered.sdf', rescoring, ncpus)
+        return
+    streaming_folder = w_dir / 'streaming'
+    shutil.rmtree(streaming_folder, ignore_errors=True)
+    shard_dirs = []
+    first_results = []
+
+    def shard_processed(job, shard_dir):
+        try:
+            job.result()
+        except Exception:
+            printlog(f'ERROR: Failed to select and rescore the poses of {shard_dir.name}!')
+            printlog(traceback.format_exc())
+            return
+        if not first_results:
+            first_results.append(time.perf_counter() - tic)
+            printlog(f'First shard rescored after {first_results[0]:0.4f}')
+
+    printlog(f'Streaming with {docking_cpus} CPUs for docking and {shard_cpus} CPUs for pose selection and rescoring...')
+    # Shards are processed one at a time in the background, each with its own process pools
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        def shard_docked(split_file, poses):
+            shard_dir = streaming_folder / split_file.stem
+            shard_dirs.append(shard_dir)
+            job = executor.submit(process_shard, shard_dir, poses, protein_file, pocket_definition, software,
+                                  pose_selection, clustering_method, rescoring, bust_poses, shard_cpus)
+            job.add_done_callback(lambda job: shard_processed(job, shard_dir))
+
+        docking(w_dir, protein_file, pocket_definition, software, docking_programs, exhaustiveness, n_poses, docking_cpus, job_manager,
+                on_shard_docked=shard_docked)
+    merge_shards(w_dir, shard_dirs, pose_selection)
+    shutil.rmtree(streaming_folder, ignore_errors=True)
+    toc = time.perf_counter()
+    printlog(f'Streaming docking, pose selection and rescoring finished in {toc - tic:0.4f}!')
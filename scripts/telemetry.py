@@ -0,0 +1,178 @@
+import contextlib
+import datetime
+import json
+import os
+import resource
+import socket
+import threading
+import time
+import uuid
+import warnings
+from pathlib import Path
+
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+# Telemetry is configured through environment variables, so that it is inherited by the pool workers:
+#   DOCKM8_TELEMETRY             the run report (JSON Lines) the measurements are appended to, telemetry is disabled if unset
+#   DOCKM8_RUN_ID                the identifier of the run, added to each measurement
+#   DOCKM8_PROMETHEUS_TEXTFILE   optional Prometheus textfile (e.g. for the node_exporter textfile collector) summarizing the run
+
+# Measurements open in this process, with the thread running them. CPU time is only measured per process, so a measurement
+# that overlapped a measurement of another thread (e.g. concurrent pipeline stages) cannot be given its own CPU time.
+_OPEN_MEASUREMENTS = []
+_OPEN_MEASUREMENTS_LOCK = threading.Lock()
+
+
+def start_run(report_file: Path) -> str:
+    """
+    Enables telemetry for a new run, appending to the given run report.
+
+    Returns:
+        str: The identifier of the run.
+    """
+    run_id = uuid.uuid4().hex[:12]
+    os.environ['DOCKM8_TELEMETRY'] = str(Path(report_file).resolve())
+    os.environ['DOCKM8_RUN_ID'] = run_id
+    return run_id
+
+
+def cpu_seconds() -> float:
+    """
+    Returns the CPU time used by this process and its terminated child processes (e.g. docking programs and pool workers).
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident memory of this process or of its largest terminated child process, in MB. This is a high-water mark over the lifetime
+    of the process, not specific to the work being measured.
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def count_records(sdf: Path) -> int:
+    """
+    Returns the number of records of an SDF file, or 0 if it does not exist.
+    """
+    try:
+        with open(sdf) as f:
+            return sum(1 for line in f if line.startswith('$$$$'))
+    except FileNotFoundError:
+        return 0
+
+
+def record(kind: str, name: str, wall_s: float, cpu_s: float, items: int = None, failures: int = 0, **labels):
+    """
+    Appends a measurement to the run report. Does nothing if telemetry is not enabled.
+
+    Args:
+        kind (str): The kind of work measured ('stage', 'program', 'shard', 'rescoring', ...).
+        name (str): The name of the stage, docking program, rescoring function, etc.
+        wall_s (float): The wall time in seconds.
+        cpu_s (float): The CPU time in seconds, or None if it could not be attributed to this work.
+        items (int): The number of items processed (compounds or poses).
+        failures (int): The number of failures.
+        **labels: Additional labels (e.g. the shard or the pose selection method).
+    """
+    report_file = os.environ.get('DOCKM8_TELEMETRY')
+    if not report_file:
+        return
+    measurement = {'run_id': os.environ.get('DOCKM8_RUN_ID'),
+                   'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'host': socket.gethostname(),
+                   'pid': os.getpid(),
+                   'kind': kind,
+                   'name': name,
+                   'labels': {key: str(value) for key, value in labels.items()},
+                   'wall_s': round(wall_s, 4),
+                   'cpu_s': round(cpu_s, 4) if cpu_s is not None else None,
+                   'items': items,
+                   'throughput_per_s': round(items / wall_s, 4) if items and wall_s > 0 else None,
+                   'failures': failures,
+                   # Peak memory of the recording process so far (see peak_rss_mb), not of this measurement
+                   'process_peak_rss_mb': round(peak_rss_mb(), 1)}
+    # A single write in append mode, so that lines of concurrent processes are not interleaved
+    with open(report_file, 'a') as f:
+        f.write(json.dumps(measurement) + '\n')
+
+
+@contextlib.contextmanager
+def measure(kind: str, name: str, items: int = None, **labels):
+    """
+    Measures the wall time and CPU time of a block and records them (see record). The block can set the 'items' and 'failures'
+    of the yielded dictionary; an exception raised by the block is recorded as a failure.
+    The CPU time of the process and its terminated children is only recorded if no other thread of the process was measuring at the same time,
+    otherwise it would include the work of the other thread (cpu_s is then None).
+    """
+    metrics = {'items': items, 'failures': 0}
+    measurement = {'thread': threading.get_ident(), 'overlapped': False}
+    with _OPEN_MEASUREMENTS_LOCK:
+        for other in _OPEN_MEASUREMENTS:
+            if other['thread'] != measurement['thread']:
+                other['overlapped'] = measurement['overlapped'] = True
+        _OPEN_MEASUREMENTS.append(measurement)
+    tic = time.perf_counter()
+    cpu_tic = cpu_seconds()
+    try:
+        yield metrics
+    except Exception:
+        metrics['failures'] += 1
+        raise
+    finally:
+        cpu_time = cpu_seconds() - cpu_tic
+        with _OPEN_MEASUREMENTS_LOCK:
+            _OPEN_MEASUREMENTS.remove(measurement)
+        record(kind, name, time.perf_counter() - tic, None if measurement['overlapped'] else cpu_time, metrics['items'], metrics['failures'], **labels)
+
+
+def read_report(report_file: Path, run_id: str = None) -> list:
+    """
+    Reads the measurements of a run report, optionally only those of one run.
+    """
+    if not Path(report_file).is_file():
+        return []
+    with open(report_file) as f:
+        measurements = [json.loads(line) for line in f if line.strip()]
+    return [measurement for measurement in measurements if run_id is None or measurement['run_id'] == run_id]
+
+
+def write_prometheus_textfile(report_file: Path, textfile: Path, run_id: str = None):
+    """
+    Summarizes the measurements of a run per kind and name in the Prometheus text format. The file is written under a temporary name and renamed,
+    as expected by the node_exporter textfile collector.
+    CPU time is summed over the measurements that have one. The peak memory is reported once for the run, as it is measured per process and not per stage.
+    """
+    totals = {}
+    peak_rss = 0.0
+    for measurement in read_report(report_file, run_id):
+        key = (measurement['kind'], measurement['name'])
+        total = totals.setdefault(key, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0, 'failures': 0, 'measurements': 0})
+        total['wall_seconds'] += measurement['wall_s']
+        total['cpu_seconds'] += measurement['cpu_s'] or 0.0
+        total['items'] += measurement['items'] or 0
+        total['failures'] += measurement['failures']
+        total['measurements'] += 1
+        peak_rss = max(peak_rss, measurement.get('process_peak_rss_mb', 0.0))
+    # Values of the last run, exported as gauges (the run identifier is left out of the labels to keep the number of series constant)
+    metrics = [('wall_seconds', 'Wall time spent in the last run'),
+               ('cpu_seconds', 'CPU time spent in the last run, by the measurements that did not overlap another stage'),
+               ('items', 'Items (compounds or poses) processed in the last run'),
+               ('failures', 'Failures in the last run'),
+               ('measurements', 'Number of measurements in the last run')]
+    lines = []
+    for metric, description in metrics:
+        lines.append(f'# HELP dockm8_{metric} {description}')
+        lines.append(f'# TYPE dockm8_{metric} gauge')
+        for (kind, name), total in sorted(totals.items()):
+            lines.append(f'dockm8_{metric}{{kind="{kind}",name="{name}"}} {total[metric]}')
+    lines.append('# HELP dockm8_peak_rss_mb Peak resident memory in MB of the DockM8 processes in the last run')
+    lines.append('# TYPE dockm8_peak_rss_mb gauge')
+    lines.append(f'dockm8_peak_rss_mb {peak_rss}')
+    textfile = Path(textfile)
+    tmp_file = textfile.with_name(f'.{textfile.name}.tmp')
+    tmp_file.write_text('\n'.join(lines) + '\n')
+    tmp_file.replace(textfile)
@@ -1,6 +1,8 @@
 import argparse
+import collections
 import concurrent.futures
 import datetime
+import itertools
 import math
 import os
 import warnings
@@ -16,6 +18,8 @@ from rdkit import Chem
 from rdkit.Chem import PandasTools
 from tqdm import tqdm
 
+from scripts.profiling import profiled
+
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -335,7 +339,7 @@ def delete_files(folder_path: str, save_file: str) -> None:
             if not any(item.iterdir()) and item.name != save_file:
                 item.rmdir()
                 
-def parallel_executor(function, list_of_objects : list, ncpus : int, backend = 'concurrent_process', **kwargs):
+def parallel_executor(function, list_of_objects : list, ncpus : int, backend = None, on_result = None, **kwargs):
     
     """
     Executes a function in parallel using multiple processes.
@@ -344,25 +348,47 @@ def parallel_executor(function, list_of_objects : list, ncpus : int, backend = '
         function (function): The function to execute in parallel.
         split_files_sdfs (list): A list of input arguments to pass to the function.
         ncpus (int): The number of CPUs to use for parallel execution.
+        backend (str): The backend to use, defaults to $DOCKM8_BACKEND or 'concurrent_process'. The 'distributed' backend publishes the tasks
+            to the queue folder $DOCKM8_QUEUE_DIR, where workers on any host pull them (see scripts/distributed.py).
+        on_result (function): Optional function called in the main process with each result, in completion order for the concurrent and distributed backends.
         **kwargs: Additional keyword arguments to pass to the function.
 
     Returns:
         The result of the function execution.
     """
+    if backend is None:
+        backend = os.environ.get('DOCKM8_BACKEND', 'concurrent_process')
+    function = profiled(function)
+
+    def collect(jobs, progress=True):
+        results = []
+        completed = concurrent.futures.as_completed(jobs)
+        for job in (tqdm(completed, total=len(list_of_objects), desc=f"Running {function}") if progress else completed):
+            results.append(job.result())
+            if on_result is not None:
+                on_result(results[-1])
+        return results
+
+    if backend == 'distributed':
+        # Imported here as scripts.distributed is also run as a standalone worker script
+        from scripts.distributed import distributed_map
+        results = distributed_map(function, list_of_objects, Path(os.environ['DOCKM8_QUEUE_DIR']), local_workers=int(os.environ.get('DOCKM8_LOCAL_WORKERS', 0)), on_result=on_result, **kwargs)
+        return results
+
     if backend == "concurrent_process":
         with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus) as executor:
             jobs = [executor.submit(function, obj, **kwargs) for obj in list_of_objects]
-            results = [job.result() for job in tqdm(concurrent.futures.as_completed(jobs), total=len(list_of_objects), desc=f"Running {function}")]
+            return collect(jobs)
     
     if backend == "concurrent_process_silent":
         with concurrent.futures.ProcessPoolExecutor(max_workers=ncpus) as executor:
             jobs = [executor.submit(function, obj, **kwargs) for obj in list_of_objects]
-            results = [job.result() for job in concurrent.futures.as_completed(jobs)]
+            return collect(jobs, progress=False)
     
     if backend == "concurrent_thread":
         with concurrent.futures.ThreadPoolExecutor(max_workers=ncpus) as executor:
             jobs = [executor.submit(function, obj, **kwargs) for obj in list_of_objects]
-            results = [job.result() for job in tqdm(concurrent.futures.as_completed(jobs), total=len(list_of_objects), desc=f"Running {function}")]
+            return collect(jobs)
     
     if backend == 'joblib':
         jobs = [delayed(function)(obj, **kwargs) for obj in list_of_objects]
@@ -378,6 +404,9 @@ def parallel_executor(function, list_of_objects : list, ncpus : int, backend = '
         with pebble.ThreadPool(max_workers=ncpus) as executor:
             jobs = [executor.schedule(function, args=(obj,), kwargs = kwargs) for obj in list_of_objects]
             results = [job.result() for job in jobs]
+    if on_result is not None:
+        for result in results:
+            on_result(result)
     return results
 
 def str2bool(v):
@@ -432,3 +461,109 @@ def parallel_SDF_loader(sdf_path : Path, molcolName : str, idName : str, ncpus =
     except Exception as e:
         printlog(f"Error occurred during loading of SDF file: {str(e)}")
     return df
+
+def iter_sdf_records(sdf_file: Path):
+    """
+    Iterates over the records of an SDF file without parsing the molecules.
+
+    Args:
+        sdf_file (Path): The path to the SDF file.
+
+    Yields:
+        tuple: The title and the full text of each record.
+    """
+    record = []
+    with open(sdf_file, 'r') as infile:
+        for line in infile:
+            record.append(line)
+            if line.startswith('$$$$'):
+                yield record[0].strip(), ''.join(record)
+                record = []
+
+def read_sdf_properties(sdf_file: Path, properties: list = (), idName: str = 'ID') -> pd.DataFrame:
+    """
+    Reads the record titles and selected data fields of an SDF file without parsing the molecules.
+
+    Args:
+        sdf_file (Path): The path to the SDF file.
+        properties (list): The names of the data fields to read.
+        idName (str): The name of the column holding the record titles.
+
+    Returns:
+        pd.DataFrame: A DataFrame with one row per record, holding the title and the requested fields as strings (None if missing).
+    """
+    wanted = set(properties)
+    records = []
+    record = None
+    field = None
+    with open(sdf_file, 'r') as infile:
+        for line in infile:
+            if record is None:
+                record = {idName: line.strip()}
+            elif line.startswith('$$$$'):
+                records.append(record)
+                record = None
+                field = None
+            elif field is not None:
+                record[field] = line.strip()
+                field = None
+            elif line.startswith('>'):
+                start = line.find('<')
+                end = line.find('>', start)
+                name = line[start + 1:end] if start != -1 and end != -1 else None
+                if name in wanted:
+                    field = name
+    return pd.DataFrame.from_records(records, columns=[idName] + list(properties))
+
+
+def map_sdf_batches(records, batch_function, ncpus: int, batch_size: int, desc: str, timeout: float = None, **kwargs):
+    """
+    Runs a batch function over (title, record) pairs in worker processes and yields the results in input order.
+    Only a bounded number of batches is in flight at any time, so memory use does not depend on the library size.
+
+    Args:
+        records (iterator): The (title, record) pairs to process.
+        batch_function (function): Function taking a list of (title, record) pairs.
+        ncpus (int): The number of worker processes.
+        batch_size (int): The number of records per batch.
+        desc (str): The description of the progress bar.
+        timeout (float): Time limit in seconds per record. A batch running over its limit is retried record by record and records running over the limit are skipped.
+        **kwargs: Additional keyword arguments passed to the batch function.
+
+    Yields:
+        tuple: Each batch and the list of its results (one result, or one per record when the batch was retried record by record).
+    """
+    records = iter(records)
+    batch_function = profiled(batch_function)
+    pending = collections.deque()
+    with pebble.ProcessPool(max_workers=ncpus) as pool, tqdm(desc=desc, unit='mol') as progress:
+
+        def submit(batch):
+            return pool.schedule(batch_function, args=(batch,), kwargs=kwargs, timeout=timeout * len(batch) if timeout else None)
+
+        def collect(batch, job):
+            try:
+                return [job.result()]
+            except concurrent.futures.TimeoutError:
+                if len(batch) == 1:
+                    printlog(f'ERROR: Processing of {batch[0][0]} timed out after {timeout} seconds, skipping it.')
+                    return []
+                # Find the offending records by running the batch again one record per task
+                jobs = [([record], submit([record])) for record in batch]
+                return [result for single, single_job in jobs for result in collect(single, single_job)]
+            except Exception as e:
+                printlog(f'ERROR: Failed to process a batch of {len(batch)} molecules: {e}')
+                return []
+
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if batch:
+                pending.append((batch, submit(batch)))
+            # Hand over the oldest batch once enough batches are queued, or when the input is exhausted
+            while pending and (len(pending) >= 2 * ncpus or not batch):
+                done_batch, job = pending.popleft()
+                results = collect(done_batch, job)
+                progress.update(len(done_batch))
+                yield done_batch, results
+            if not batch:
+                break